@@ -0,0 +1,1281 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals
+from __future__ import print_function
+
+import sys
+import os
+import io
+import shutil
+import pickle
+import struct
+import tempfile
+import unittest
+
+package_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, package_directory)
+
+import rbql
+from rbql import rbql_engine
+from rbql import rbql_csv
+
+
+def run_table_query(query_text, input_table, join_table=None, user_init_code='', input_column_names=None):
+    # Returns (output_table, warnings) tuple or (error_type, error_msg) tuple if the query failed.
+    output_table = []
+    warnings = []
+    try:
+        rbql.query_table(query_text, input_table, output_table, warnings, join_table=join_table, input_column_names=input_column_names, user_init_code=user_init_code)
+    except Exception as e:
+        return rbql.exception_to_error_info(e)
+    return (output_table, warnings)
+
+
+class OptimizationsDisabled(object):
+    # Query results with AST-based optimizations (subexpression elimination, adaptive WHERE, input prefilters) disabled are the reference results.
+    def __enter__(self):
+        self.cse_supported = rbql_engine.cse_supported
+        rbql_engine.cse_supported = False
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        rbql_engine.cse_supported = self.cse_supported
+
+
+class CSVTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_table(self, table_name, lines):
+        table_path = os.path.join(self.tmp_dir, table_name)
+        with open(table_path, 'wb') as f:
+            f.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+        return table_path
+
+    def read_table(self, table_path):
+        with open(table_path, 'rb') as f:
+            return f.read().decode('utf-8').splitlines()
+
+    def run_csv_query(self, query_text, input_path, with_headers=False, delim=',', policy='quoted', **kwargs):
+        # Returns (output_lines, warnings) tuple or (error_type, error_msg) tuple if the query failed.
+        output_path = os.path.join(self.tmp_dir, 'output.csv')
+        warnings = []
+        try:
+            rbql_csv.query_csv(query_text, input_path, delim, policy, output_path, delim, policy, 'utf-8', warnings, with_headers, **kwargs)
+        except Exception as e:
+            return rbql.exception_to_error_info(e)
+        return (self.read_table(output_path), warnings)
+
+    def assert_same_as_reference(self, query_text, input_path, with_headers=False, delim=',', policy='quoted', **kwargs):
+        with OptimizationsDisabled():
+            expected = self.run_csv_query(query_text, input_path, with_headers, delim, policy)
+        actual = self.run_csv_query(query_text, input_path, with_headers, delim, policy, **kwargs)
+        self.assertEqual(expected, actual)
+        return actual
+
+
+class TestCommonSubexpressions(unittest.TestCase):
+    def setUp(self):
+        self.table = [['x', '12', 'a'], ['y', 'n/a', 'b'], ['z', '7', 'c'], ['w', '30', 'a']]
+
+    def assert_same_as_reference(self, query_text, user_init_code=''):
+        with OptimizationsDisabled():
+            expected = run_table_query(query_text, self.table, user_init_code=user_init_code)
+        actual = run_table_query(query_text, self.table, user_init_code=user_init_code)
+        self.assertEqual(expected, actual)
+        return actual
+
+    def test_repeated_subexpressions(self):
+        output, warnings = self.assert_same_as_reference('select a1.upper(), int(a2) * 2 where a2.isdigit() and int(a2) > 10 order by int(a2) desc')
+        self.assertEqual([['W', 60], ['X', 24]], output)
+
+    def test_subexpressions_are_evaluated_once(self):
+        prepared_query = rbql.prepare('select int(a2) * 2 where a2.isdigit() and int(a2) > 10 order by int(a2)', rbql_engine.TableIterator(self.table))
+        query_context = prepared_query.query_context
+        self.assertEqual('__rbql_cse_var_0 = int(a2)', query_context.post_where_cse_code)
+        self.assertEqual('(__rbql_cse_var_0)', query_context.sort_key_expression)
+
+    def test_guarded_subexpression_is_not_evaluated_early(self):
+        # `int(a2)` is repeated in SELECT and ORDER BY, but must not be evaluated for records rejected by WHERE.
+        output, warnings = self.assert_same_as_reference('select a1, int(a2) where a2 != "n/a" order by int(a2)')
+        self.assertEqual([['z', 7], ['x', 12], ['w', 30]], output)
+
+    def test_conditionally_evaluated_subexpression(self):
+        output, warnings = self.assert_same_as_reference('select a1, int(a2) if a2.isdigit() else -1, int(a2) if a2.isdigit() else -1')
+        self.assertEqual(['y', -1, -1], output[1])
+
+    def test_guarded_operand_of_chained_comparison(self):
+        # `int(a2)` is evaluated only if `len(a2) > 0` is true.
+        self.table = [['x', ''], ['y', '5'], ['z', '20']]
+        output, warnings = self.assert_same_as_reference('select a1, int(a2) where len(a2) > 0 < int(a2)')
+        self.assertEqual([['y', 5], ['z', 20]], output)
+
+    def test_aggregate_query(self):
+        output, warnings = self.assert_same_as_reference('select a3.upper(), count(*) where len(a3.upper()) == 1 group by a3.upper()')
+        self.assertEqual(sorted([['A', 2], ['B', 1], ['C', 1]]), sorted(output))
+
+    def test_redefined_builtin_in_init_code(self):
+        # Functions redefined by the user can have side effects, so their calls are never merged.
+        user_init_code = 'num_calls = [0]\ndef abs(value):\n    num_calls[0] += 1\n    return num_calls[0]\n'
+        output, warnings = self.assert_same_as_reference('select abs(a1), abs(a1)', user_init_code)
+        self.assertEqual([1, 2], output[0])
+
+    def test_runtime_error_is_preserved(self):
+        error_type, error_msg = self.assert_same_as_reference('select int(a2) + int(a2)')
+        self.assertEqual('query execution', error_type)
+        self.assertTrue(error_msg.find('At record 2') != -1)
+
+
+class TestPreparedQueries(CSVTestCase):
+    def test_execute_multiple_times(self):
+        prepared_query = rbql.prepare('select a1, int(a2) * 10 where a1 != "x" order by a1', rbql_engine.TableIterator([['x', '1']]))
+        results = []
+        for input_table in [[['b', '1'], ['a', '2']], [['x', '3'], ['c', '4']]]:
+            output_table = []
+            warnings = []
+            prepared_query.execute(rbql_engine.TableIterator(input_table), rbql_engine.TableWriter(output_table), warnings)
+            results.append(output_table)
+        self.assertEqual([[['a', 20], ['b', 10]], [['c', 40]]], results)
+
+    def test_input_header_mismatch(self):
+        prepared_query = rbql.prepare('select a.name', rbql_engine.TableIterator([['x']], column_names=['name']))
+        with self.assertRaises(rbql_engine.RbqlIOHandlingError):
+            prepared_query.execute(rbql_engine.TableIterator([['x']], column_names=['id']), rbql_engine.TableWriter([]), [])
+
+    def test_batch_query_with_join(self):
+        input_paths = [self.write_table('day1.csv', ['1,x', '2,y']), self.write_table('day2.csv', ['3,z', '1,w'])]
+        self.write_table('users.csv', ['1,alice', '3,bob'])
+        output_paths = [os.path.join(self.tmp_dir, 'out1.csv'), os.path.join(self.tmp_dir, 'out2.csv')]
+        warnings = []
+        rbql_csv.query_csv_batch('select a2, b2 join users.csv on a1 == b1', input_paths, ',', 'quoted', output_paths, ',', 'quoted', 'utf-8', warnings, False)
+        self.assertEqual(['x,alice'], self.read_table(output_paths[0]))
+        self.assertEqual(['z,bob', 'w,alice'], self.read_table(output_paths[1]))
+
+    def test_batch_query_rejects_ambiguous_output_paths(self):
+        input_paths = [self.write_table('day1.csv', ['1']), self.write_table('day2.csv', ['2'])]
+        output_path = os.path.join(self.tmp_dir, 'out.csv')
+        with self.assertRaises(rbql_engine.RbqlIOHandlingError):
+            rbql_csv.query_csv_batch('select *', input_paths, ',', 'quoted', [output_path, output_path], ',', 'quoted', 'utf-8', [], False)
+        with self.assertRaises(rbql_engine.RbqlIOHandlingError):
+            rbql_csv.query_csv_batch('select *', input_paths, ',', 'quoted', [input_paths[1], output_path], ',', 'quoted', 'utf-8', [], False)
+        self.assertEqual(['2'], self.read_table(input_paths[1]))
+
+    def test_cli_rejects_duplicate_batch_file_names(self):
+        import subprocess
+        os.makedirs(os.path.join(self.tmp_dir, 'd1'))
+        os.makedirs(os.path.join(self.tmp_dir, 'd2'))
+        input_paths = [self.write_table(os.path.join('d1', 'x.csv'), ['1']), self.write_table(os.path.join('d2', 'x.csv'), ['2'])]
+        cmd = [sys.executable, '-m', 'rbql', '--delim', ',', '--query', 'select *', '--batch-input'] + input_paths + ['--batch-output-dir', self.tmp_dir]
+        pobj = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=package_directory)
+        out_data, err_data = pobj.communicate()
+        self.assertEqual(1, pobj.returncode)
+        self.assertTrue(err_data.decode('utf-8').find('"x.csv"') != -1)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'x.csv')))
+
+
+class TestAdaptiveWhere(unittest.TestCase):
+    def setUp(self):
+        countries = ['US', 'UK', 'DE', 'FR']
+        self.table = [[str(i), str(i % 31), countries[i % len(countries)]] for i in range(3000)]
+
+    def assert_same_as_reference(self, query_text, input_table):
+        with OptimizationsDisabled():
+            expected = run_table_query(query_text, input_table)
+        actual = run_table_query(query_text, input_table)
+        self.assertEqual(expected, actual)
+        return actual
+
+    def test_conjuncts_are_reordered(self):
+        query_text = 'select a1 where like(a3, "%S") and a1.endswith("8") and a3 != "UK"'
+        prepared_query = rbql.prepare(query_text, rbql_engine.TableIterator(self.table))
+        self.assertEqual([True, True, True], [reorderable for _, reorderable in prepared_query.query_context.where_conjuncts])
+        output, warnings = self.assert_same_as_reference(query_text, self.table)
+        self.assertEqual(150, len(output))
+
+    def test_conjuncts_which_can_fail_are_not_reordered(self):
+        self.table[2500][1] = 'n/a'
+        query_text = 'select a1 where int(a2) > 10 and a3.startswith("U")'
+        prepared_query = rbql.prepare(query_text, rbql_engine.TableIterator(self.table))
+        self.assertEqual(None, prepared_query.query_context.where_conjuncts)
+        error_type, error_msg = self.assert_same_as_reference(query_text, self.table)
+        self.assertTrue(error_msg.startswith('At record 2501,'))
+
+    def test_reordering_stops_at_conjuncts_which_can_fail(self):
+        self.table[2500][1] = 'n/a'
+        query_text = 'select a1 where a3.startswith("U") and a1 != "" and int(a2) > 10 and a1.endswith("7") and a1 == "-1"'
+        prepared_query = rbql.prepare(query_text, rbql_engine.TableIterator(self.table))
+        self.assertEqual([True, True, False, True, True], [reorderable for _, reorderable in prepared_query.query_context.where_conjuncts])
+        error_type, error_msg = self.assert_same_as_reference(query_text, self.table)
+        self.assertTrue(error_msg.startswith('At record 2501,'))
+
+    def test_records_with_missing_fields_use_original_order(self):
+        # `a1 == "-1"` rejects all records and is moved first, but for the short record `a2.startswith()` must still fail.
+        self.table[2500] = ['2500']
+        error_type, error_msg = self.assert_same_as_reference('select a1 where a2.startswith("1") and a1 == "-1"', self.table)
+        self.assertTrue(error_msg.startswith('At record 2501,'))
+
+
+class TestRawLinePrefilter(CSVTestCase):
+    def setUp(self):
+        super(TestRawLinePrefilter, self).setUp()
+        countries = ['US', 'UK', 'DE', 'FR']
+        self.lines = ['id,val,country,name'] + ['{},{},{},n{}'.format(i, i % 31, countries[i % 4], i % 10) for i in range(1, 101)]
+
+    def test_prefilter_is_used(self):
+        input_path = self.write_table('input.csv', self.lines)
+        prepared_query = rbql.prepare('select a.id where a.country == "UK" and like(a.name, "n3%")', rbql_csv.CSVRecordIterator(open(input_path, 'rb'), 'utf-8', ',', 'quoted', has_header=True))
+        self.assertEqual(['UK', 'n3'], prepared_query.query_context.raw_line_prefilter)
+        output, warnings = self.assert_same_as_reference('select a.id where a.country == "UK" and like(a.name, "n3%")', input_path, with_headers=True)
+        self.assertEqual(['id', '13', '33', '53', '73', '93'], output)
+
+    def test_errors_of_other_conjuncts_are_preserved(self):
+        self.lines[25] = '25,n/a,UK,n5'
+        input_path = self.write_table('input.csv', self.lines)
+        error_type, error_msg = self.assert_same_as_reference('select a.id where int(a.val) > 10 and a.country == "US"', input_path, with_headers=True)
+        self.assertTrue(error_msg.startswith('At record 25,'))
+
+    def test_records_with_missing_fields_are_not_skipped(self):
+        self.lines[25] = '25,3'
+        input_path = self.write_table('input.csv', self.lines)
+        error_type, error_msg = self.assert_same_as_reference('select a.id where "n7" in a.name', input_path, with_headers=True)
+        self.assertTrue(error_msg.startswith('At record 25,'))
+
+    def test_warnings_of_skipped_records(self):
+        self.lines[25] = '25,3,UK,n5,extra'
+        self.lines[30] = '30,3,"U"K,n5'
+        input_path = self.write_table('input.csv', self.lines)
+        output, warnings = self.assert_same_as_reference('select a.id where a.country == "DE"', input_path, with_headers=True)
+        self.assertEqual(25, len(output))
+        self.assertEqual(2, len(warnings))
+
+
+class TestMergeJoin(CSVTestCase):
+    def setUp(self):
+        super(TestMergeJoin, self).setUp()
+        self.input_path = self.write_table('input.csv', ['k{:03d},{}'.format(i // 2, i) for i in range(40)])
+        self.join_path = self.write_table('join.csv', ['k{:03d},b{}'.format(i // 3, i) for i in range(0, 60, 2)])
+
+    def test_sorted_join_matches_hash_join(self):
+        for join_type in ['join', 'left join']:
+            query_text = 'select a2, b2 {} {} on a1 == b1'.format(join_type, self.join_path)
+            expected = self.run_csv_query(query_text, self.input_path)
+            actual = self.run_csv_query(query_text + ' with (sorted)', self.input_path)
+            self.assertEqual(expected, actual)
+            self.assertTrue(len(actual[0]) > 0)
+
+    def test_merge_join_map_is_used(self):
+        for query_text in ['select a2, b2 join B on a1 == b1 with (sorted)', 'select a2, b2 join B on NR == bNR']:
+            join_tables_registry = rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', [['k1', 'x']], None)])
+            prepared_query = rbql.prepare(query_text, rbql_engine.TableIterator([['k1', '1']]), join_tables_registry, single_execution=True)
+            self.assertTrue(isinstance(prepared_query.query_context.join_map_impl, rbql_engine.MergeJoinMap))
+            # Prepared queries which can be executed multiple times can't consume the join table.
+            prepared_query = rbql.prepare(query_text, rbql_engine.TableIterator([['k1', '1']]), join_tables_registry)
+            self.assertTrue(isinstance(prepared_query.query_context.join_map_impl, rbql_engine.HashJoinMap))
+
+    def test_left_join_with_ragged_join_records(self):
+        # Null records of unmatched A records are as long as the longest B record, which is not the first one.
+        join_path = self.write_table('ragged.csv', ['k001,x', 'k002', 'k003,y,z,w'])
+        for query_text in ['select * left join {} on a1 == b1', 'select a2, b2, bNF left join {} on a1 == b1']:
+            query_text = query_text.format(join_path)
+            expected = self.run_csv_query(query_text, self.input_path)
+            actual = self.run_csv_query(query_text + ' with (sorted)', self.input_path)
+            self.assertEqual(expected, actual)
+            self.assertTrue(actual[0][0] in ['k000,0,,,,', '0,,4'])
+        join_tables_registry = rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', [['k1', 'x']], None)])
+        prepared_query = rbql.prepare('select a2, b2 left join B on a1 == b1 with (sorted)', rbql_engine.TableIterator([['k1', '1']]), join_tables_registry, single_execution=True)
+        self.assertTrue(isinstance(prepared_query.query_context.join_map_impl, rbql_engine.MergeJoinMap))
+
+    def test_record_number_left_join_with_ragged_join_records(self):
+        input_path = self.write_table('a.csv', ['a{}'.format(i) for i in range(5)])
+        join_path = self.write_table('b2.csv', ['x,1', 'y', 'z,3,4,5'])
+        output, warnings = self.run_csv_query('select * left join {} on NR == bNR'.format(join_path), input_path)
+        self.assertEqual(['a0,x,1', 'a1,y', 'a2,z,3,4,5', 'a3,,,,', 'a4,,,,'], output)
+
+    def test_record_number_join_in_batch_mode(self):
+        join_path = self.write_table('bt.csv', ['id,score'] + ['{},{}'.format(i, i * 10) for i in range(5)])
+        input_paths = [self.write_table('f{}.csv'.format(i), ['id'] + [str(i * 100 + j) for j in range(3)]) for i in range(2)]
+        output_paths = [os.path.join(self.tmp_dir, 'out{}.csv'.format(i)) for i in range(2)]
+        warnings = []
+        rbql_csv.query_csv_batch('select a.id, b.score join {} on NR == bNR'.format(join_path), input_paths, ',', 'quoted', output_paths, ',', 'quoted', 'utf-8', warnings, True)
+        self.assertEqual(['id,score', '0,0', '1,10', '2,20'], self.read_table(output_paths[0]))
+        self.assertEqual(['id,score', '100,0', '101,10', '102,20'], self.read_table(output_paths[1]))
+
+    def test_unsorted_tables_are_reported(self):
+        unsorted_join_path = self.write_table('unsorted.csv', ['k005,x', 'k001,y'])
+        error_type, error_msg = self.run_csv_query('select a2, b2 join {} on a1 == b1 with (sorted)'.format(unsorted_join_path), self.input_path)
+        self.assertTrue(error_msg.find('Join table B is not sorted by the join key') != -1)
+        unsorted_input_path = self.write_table('unsorted_input.csv', ['k005,1', 'k001,2'])
+        error_type, error_msg = self.run_csv_query('select a2, b2 join {} on a1 == b1 with (sorted)'.format(self.join_path), unsorted_input_path)
+        self.assertTrue(error_msg.find('Input table A is not sorted by the join key') != -1)
+
+
+class TestPartitionedJoin(CSVTestCase):
+    def setUp(self):
+        super(TestPartitionedJoin, self).setUp()
+        self.input_path = self.write_table('input.csv', ['{},{},{}'.format(i % 700, i % 3, i) for i in range(3000)])
+        self.join_path = self.write_table('join.csv', ['{},{},b{},{}'.format(i % 900, i % 3, i, 'x' * 20) for i in range(5000)])
+        self.grace_join_max_partitions = rbql_engine.grace_join_max_partitions
+
+    def tearDown(self):
+        rbql_engine.grace_join_max_partitions = self.grace_join_max_partitions
+        super(TestPartitionedJoin, self).tearDown()
+
+    def assert_same_as_in_memory_join(self, query_text, join_memory_budget):
+        expected_output, expected_warnings = self.run_csv_query(query_text, self.input_path)
+        actual_output, actual_warnings = self.run_csv_query(query_text, self.input_path, join_memory_budget=join_memory_budget)
+        # Partitioned join doesn't preserve the input order.
+        self.assertEqual(sorted(expected_output), sorted(actual_output))
+        self.assertEqual(expected_warnings, actual_warnings)
+        return actual_output
+
+    def prepare_join_query(self, query_text, join_memory_budget):
+        join_tables_registry = rbql_csv.FileSystemCSVRegistry(self.tmp_dir, ',', 'quoted', 'utf-8', False, None)
+        input_iterator = rbql_csv.CSVRecordIterator(open(self.input_path, 'rb'), 'utf-8', ',', 'quoted')
+        return rbql.prepare(query_text, input_iterator, join_tables_registry, join_memory_budget=join_memory_budget), input_iterator, join_tables_registry
+
+    def test_partitioned_join_matches_in_memory_join(self):
+        for join_type in ['join', 'left join']:
+            output = self.assert_same_as_in_memory_join('select a3, b3, bNR {} {} on a1 == b1 and a2 == b2'.format(join_type, self.join_path), 2000)
+            self.assertTrue(len(output) > 3000)
+        unique_join_path = self.write_table('unique.csv', ['{},b{}'.format(i, i) for i in range(700)])
+        output = self.assert_same_as_in_memory_join('select a3, b2 strict left join {} on a1 == b1'.format(unique_join_path), 2000)
+        self.assertEqual(3000, len(output))
+
+    def test_number_of_partitions_depends_on_table_size(self):
+        prepared_query, input_iterator, join_tables_registry = self.prepare_join_query('select a3, b3 join {} on a1 == b1'.format(self.join_path), 100000)
+        small_num_partitions = prepared_query.query_context.join_map_impl.num_partitions
+        prepared_query.finish()
+        join_tables_registry.finish()
+        input_iterator.stream.close()
+        prepared_query, input_iterator, join_tables_registry = self.prepare_join_query('select a3, b3 join {} on a1 == b1'.format(self.join_path), 10000)
+        large_num_partitions = prepared_query.query_context.join_map_impl.num_partitions
+        prepared_query.finish()
+        join_tables_registry.finish()
+        input_iterator.stream.close()
+        self.assertTrue(2 <= small_num_partitions < large_num_partitions)
+
+    def test_large_partitions_are_split_recursively(self):
+        rbql_engine.grace_join_max_partitions = 2
+        query_text = 'select a3, b3 join {} on a1 == b1'.format(self.join_path)
+        self.assert_same_as_in_memory_join(query_text, 5000)
+        prepared_query, input_iterator, join_tables_registry = self.prepare_join_query(query_text, 5000)
+        output_table = []
+        prepared_query.execute(input_iterator, rbql_engine.TableWriter(output_table), [])
+        join_map = prepared_query.query_context.join_map_impl
+        self.assertEqual(2, join_map.num_partitions)
+        self.assertTrue(max(join_map.subpartitions.values()) > 0)
+        spill_dir = join_map.spill_storage.tmp_dir
+        self.assertTrue(os.path.isdir(spill_dir))
+        prepared_query.finish()
+        join_tables_registry.finish()
+        input_iterator.stream.close()
+        self.assertFalse(os.path.exists(spill_dir))
+
+    def test_join_without_spill_storage_ignores_budget(self):
+        input_table = [[str(i % 7), str(i)] for i in range(100)]
+        join_table = [[str(i % 7), 'b' + str(i)] for i in range(100)]
+        join_tables_registry = rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', join_table, None)])
+        prepared_query = rbql.prepare('select a2, b2 join B on a1 == b1', rbql_engine.TableIterator(input_table), join_tables_registry, join_memory_budget=100)
+        self.assertFalse(prepared_query.query_context.join_map_impl.is_partitioned())
+
+
+class PickledFileCreator(object):
+    # Unpickling this object creates a file, it is used to check that cache files are never unpickled.
+    def __init__(self, path):
+        self.path = path
+
+    def __reduce__(self):
+        return (open, (self.path, 'w'))
+
+
+class TestJoinIndexCache(CSVTestCase):
+    def setUp(self):
+        super(TestJoinIndexCache, self).setUp()
+        self.input_path = self.write_table('input.csv', ['{},{}'.format(i % 50, i) for i in range(200)])
+        self.join_path = self.write_table('join.csv', ['{},b{}'.format(i % 70, i) for i in range(300)])
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.query_text = 'select a2, b2, bNR left join {} on a1 == b1'.format(self.join_path)
+        self.expected = self.run_csv_query(self.query_text, self.input_path)
+
+    def get_index_paths(self):
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)]
+
+    def test_index_is_reused(self):
+        self.assertEqual(self.expected, self.run_csv_query(self.query_text, self.input_path, join_index_cache_dir=self.cache_dir))
+        index_paths = self.get_index_paths()
+        self.assertEqual(1, len(index_paths))
+        self.assertTrue(index_paths[0].endswith('.json'))
+        self.assertEqual(self.expected, self.run_csv_query(self.query_text, self.input_path, join_index_cache_dir=self.cache_dir))
+        self.assertEqual(index_paths, self.get_index_paths())
+
+    def test_invalid_index_is_rebuilt(self):
+        self.run_csv_query(self.query_text, self.input_path, join_index_cache_dir=self.cache_dir)
+        index_path = self.get_index_paths()[0]
+        marker_path = os.path.join(self.tmp_dir, 'marker')
+        invalid_indexes = [b'garbage', b'{"offsets": 5}', b'{"offsets": [["1", [[1, "x"]]]], "max_record_len": 2, "warnings": []}', pickle.dumps(PickledFileCreator(marker_path))]
+        for invalid_index in invalid_indexes:
+            with open(index_path, 'wb') as f:
+                f.write(invalid_index)
+            self.assertEqual(self.expected, self.run_csv_query(self.query_text, self.input_path, join_index_cache_dir=self.cache_dir))
+        self.assertFalse(os.path.exists(marker_path))
+
+    @unittest.skipIf(not hasattr(os, 'getuid'), 'POSIX permissions are required')
+    def test_shared_cache_dir_is_not_used(self):
+        os.mkdir(self.cache_dir)
+        os.chmod(self.cache_dir, 0o777)
+        output, warnings = self.run_csv_query(self.query_text, self.input_path, join_index_cache_dir=self.cache_dir)
+        self.assertEqual(self.expected[0], output)
+        self.assertEqual(1, len(warnings))
+        self.assertTrue(warnings[0].find('is not private to the current user') != -1)
+        self.assertEqual([], self.get_index_paths())
+
+
+class TestJoinProjection(CSVTestCase):
+    def setUp(self):
+        super(TestJoinProjection, self).setUp()
+        self.input_table = [['k1'], ['k2'], ['k3']]
+        self.join_table = [['k1', 'x', 'y', 'z'], ['k2', 'p', 'q']]
+
+    def prepare_join_query(self, query_text):
+        join_tables_registry = rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', self.join_table, None)])
+        return rbql.prepare(query_text, rbql_engine.TableIterator(self.input_table), join_tables_registry)
+
+    def test_only_referenced_fields_are_stored(self):
+        prepared_query = self.prepare_join_query('select a1, b3, bNF join B on a1 == b1')
+        self.assertEqual([0, 2], prepared_query.query_context.join_map_impl.projection)
+        output, warnings = run_table_query('select a1, b3, bNF join B on a1 == b1', self.input_table, self.join_table)
+        self.assertEqual([['k1', 'y', 4], ['k2', 'q', 3]], output)
+        output, warnings = run_table_query('select a1, b4 left join B on a1 == b1', self.input_table, self.join_table)
+        self.assertEqual([['k1', 'z'], ['k2', None], ['k3', None]], output)
+
+    def test_star_expressions_use_full_records(self):
+        for query_text in ['select a1, b.* join B on a1 == b1', 'select * join B on a1 == b1']:
+            self.assertEqual(None, self.prepare_join_query(query_text).query_context.join_map_impl.projection)
+            output, warnings = run_table_query(query_text, self.input_table, self.join_table)
+            self.assertEqual([['k1', 'k1', 'x', 'y', 'z'], ['k2', 'k2', 'p', 'q']], output)
+
+    def test_csv_join_projection(self):
+        input_path = self.write_table('input.csv', ['id,value', '1,a', '2,b', '3,c'])
+        join_path = self.write_table('join.csv', ['id,name,score,comment', '2,bob,10,x', '1,alice,20', '2,bill,30,y'])
+        query_text = 'select a.value, b.score, b.comment join {} on a.id == b.id'.format(join_path)
+        output, warnings = self.run_csv_query(query_text, input_path, with_headers=True)
+        self.assertEqual(['value,score,comment', 'a,20,', 'b,10,x', 'b,30,y'], output)
+        self.assertEqual((output, warnings), self.run_csv_query(query_text, input_path, with_headers=True, join_index_cache_dir=os.path.join(self.tmp_dir, 'cache')))
+
+
+class TestLazyJoinRecords(CSVTestCase):
+    def setUp(self):
+        super(TestLazyJoinRecords, self).setUp()
+        self.input_path = self.write_table('input.csv', ['k{},{}'.format(i % 5, i) for i in range(20)])
+        join_lines = ['k{},"b,{}",{}'.format(i, i, i * 10) for i in range(100)]
+        join_lines[3] = 'k3,"b""3",30,extra'
+        join_lines[50] = 'k50,b"50,500'
+        self.join_path = self.write_table('join.csv', join_lines)
+
+    def test_lazy_join_matches_eager_join(self):
+        for join_type in ['join', 'left join']:
+            query_text = 'select a2, b2, b3, bNF {} {} on a1 == b1'.format(join_type, self.join_path)
+            # Joins with a memory budget store split records.
+            expected = self.run_csv_query(query_text, self.input_path, join_memory_budget=1 << 30)
+            self.assertEqual(expected, self.run_csv_query(query_text, self.input_path))
+            self.assertEqual(2, len(expected[1]))
+
+    def test_only_matched_records_are_split(self):
+        join_tables_registry = rbql_csv.FileSystemCSVRegistry(self.tmp_dir, ',', 'quoted', 'utf-8', False, None)
+        input_iterator = rbql_csv.CSVRecordIterator(open(self.input_path, 'rb'), 'utf-8', ',', 'quoted')
+        prepared_query = rbql.prepare('select a2, b2 join {} on a1 == b1'.format(self.join_path), input_iterator, join_tables_registry)
+        join_map = prepared_query.query_context.join_map_impl
+        self.assertEqual(100, len(join_map.raw_map))
+        output_table = []
+        prepared_query.execute(input_iterator, rbql_engine.TableWriter(output_table), [])
+        input_iterator.stream.close()
+        join_tables_registry.finish()
+        self.assertEqual(20, len(output_table))
+        self.assertEqual(['k0', 'k1', 'k2', 'k3', 'k4'], sorted(join_map.hash_map.keys()))
+
+
+class TestSemiAntiJoin(unittest.TestCase):
+    def setUp(self):
+        self.input_table = [[str(i % 10), str(i)] for i in range(30)]
+        self.join_table = [[str(i % 4), 'b' + str(i)] for i in range(12)]
+        self.join_keys = set([r[0] for r in self.join_table])
+
+    def test_semi_join(self):
+        output, warnings = run_table_query('select * semi join B on a1 == b1', self.input_table, self.join_table)
+        # Each input record is emitted at most once even though B has multiple matches.
+        self.assertEqual([r for r in self.input_table if r[0] in self.join_keys], output)
+
+    def test_anti_join(self):
+        output, warnings = run_table_query('select a2 anti join B on a1 == b1', self.input_table, self.join_table)
+        self.assertEqual([[r[1]] for r in self.input_table if r[0] not in self.join_keys], output)
+
+    def test_join_variables_outside_of_on_expression(self):
+        error_type, error_msg = run_table_query('select a1, b2 semi join B on a1 == b1', self.input_table, self.join_table)
+        self.assertEqual('query parsing', error_type)
+        self.assertTrue(error_msg.find('can only be used in "ON" expression') != -1)
+
+    def test_only_keys_are_stored(self):
+        join_tables_registry = rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', self.join_table, None)])
+        prepared_query = rbql.prepare('select a1 semi join B on a1 == b1', rbql_engine.TableIterator(self.input_table), join_tables_registry)
+        join_map = prepared_query.query_context.join_map_impl
+        self.assertTrue(isinstance(join_map, rbql_engine.KeySetJoinMap))
+        self.assertEqual(self.join_keys, set(join_map.get_key_filter()))
+
+
+class TestJoinKeyPrefilter(CSVTestCase):
+    def setUp(self):
+        super(TestJoinKeyPrefilter, self).setUp()
+        input_lines = ['k{},{},x'.format(i % 40, i) for i in range(200)]
+        input_lines[10] = '"k1",10,x'
+        input_lines[20] = 'k33,20,x,extra'
+        input_lines[30] = 'k35'
+        input_lines[50] = 'k2,"5"0",x'
+        self.input_path = self.write_table('input.csv', input_lines)
+        self.join_path = self.write_table('join.csv', ['k{},b{}'.format(i, i) for i in range(0, 40, 7)])
+
+    def run_without_prefilter(self, query_text):
+        set_join_key_prefilter = rbql_csv.CSVRecordIterator.set_join_key_prefilter
+        rbql_csv.CSVRecordIterator.set_join_key_prefilter = rbql_engine.RBQLInputIterator.set_join_key_prefilter
+        try:
+            return self.run_csv_query(query_text, self.input_path)
+        finally:
+            rbql_csv.CSVRecordIterator.set_join_key_prefilter = set_join_key_prefilter
+
+    def test_prefilter_preserves_results_and_warnings(self):
+        for query_text in ['select NR, a2, b2 join {} on a1 == b1', 'select NR, a2 semi join {} on a1 == b1']:
+            query_text = query_text.format(self.join_path)
+            expected = self.run_without_prefilter(query_text)
+            self.assertEqual(expected, self.run_csv_query(query_text, self.input_path))
+            self.assertTrue(expected[1][0].startswith('Inconsistent double quote escaping'))
+            self.assertTrue(expected[1][1].startswith('Number of fields in "input" table is not consistent'))
+        query_text = 'select NR, a2, b2 join {} on a1 == b1 where int(a2) > 5'.format(self.join_path)
+        expected = self.run_without_prefilter(query_text)
+        self.assertEqual(('query execution', 'At record 31,'), (expected[0], expected[1][:13]))
+        self.assertEqual(expected, self.run_csv_query(query_text, self.input_path))
+
+    def test_missing_key_field_is_reported(self):
+        query_text = 'select NR, a2, b2 join {} on a2 == b1'.format(self.join_path)
+        expected = self.run_without_prefilter(query_text)
+        self.assertEqual('query execution', expected[0])
+        self.assertEqual(expected, self.run_csv_query(query_text, self.input_path))
+
+    def test_records_are_skipped(self):
+        join_tables_registry = rbql_csv.FileSystemCSVRegistry(self.tmp_dir, ',', 'quoted', 'utf-8', False, None)
+        input_iterator = rbql_csv.CSVRecordIterator(open(self.input_path, 'rb'), 'utf-8', ',', 'quoted')
+        prepared_query = rbql.prepare('select a2 join {} on a1 == b1'.format(self.join_path), input_iterator, join_tables_registry)
+        self.assertEqual(0, prepared_query.query_context.join_key_prefilter_index)
+        record_numbers = []
+        get_record = input_iterator.get_record
+        def get_record_with_numbers():
+            record = get_record()
+            if record is not None:
+                record_numbers.append(input_iterator.NR)
+            return record
+        input_iterator.get_record = get_record_with_numbers
+        prepared_query.execute(input_iterator, rbql_engine.TableWriter([]), [])
+        input_iterator.stream.close()
+        join_tables_registry.finish()
+        self.assertTrue(len(record_numbers) < 60)
+
+    def test_bloom_filter(self):
+        bloom_filter = rbql_engine.BloomFilter(1 << 12)
+        keys = ['k{}'.format(i) for i in range(200)] + [17, ('a', 'b')]
+        for key in keys:
+            bloom_filter.add(key)
+        self.assertTrue(all([key in bloom_filter for key in keys]))
+        self.assertTrue(sum([1 for i in range(1000) if 'x{}'.format(i) in bloom_filter]) < 100)
+
+
+class TestSwappedJoin(CSVTestCase):
+    def setUp(self):
+        super(TestSwappedJoin, self).setUp()
+        self.input_path = self.write_table('input.csv', ['k{},{}'.format(i % 7, i % 3) for i in range(20)])
+        self.join_path = self.write_table('join.csv', ['k{},b{},{}'.format(i % 11, i, 'x' * 10) for i in range(300)])
+        self.swapped_join_size_ratio = rbql_engine.swapped_join_size_ratio
+
+    def tearDown(self):
+        rbql_engine.swapped_join_size_ratio = self.swapped_join_size_ratio
+        super(TestSwappedJoin, self).tearDown()
+
+    def get_join_map(self, query_text):
+        join_tables_registry = rbql_csv.FileSystemCSVRegistry(self.tmp_dir, ',', 'quoted', 'utf-8', False, None)
+        with open(self.input_path, 'rb') as input_stream:
+            prepared_query = rbql.prepare(query_text.format(self.join_path), rbql_csv.CSVRecordIterator(input_stream, 'utf-8', ',', 'quoted'), join_tables_registry, single_execution=True)
+            join_map = prepared_query.query_context.join_map_impl
+        join_tables_registry.finish()
+        return join_map
+
+    def test_swapped_join_is_used_only_with_order_by(self):
+        self.assertTrue(isinstance(self.get_join_map('select a2, b2 join {} on a1 == b1 order by a2'), rbql_engine.SwappedJoinMap))
+        # Without ORDER BY swapped join would have to buffer and sort the whole output to restore the input order.
+        self.assertTrue(isinstance(self.get_join_map('select a2, b2 join {} on a1 == b1'), rbql_engine.HashJoinMap))
+
+    def test_swapped_join_output(self):
+        for query_text in ['select NR, a2, b2 join {} on a1 == b1 order by a2', 'select NR, a2, b2 join {} on a1 == b1 order by a2 desc limit 30', 'select a2, b2 join {} on a1 == b1 order by a2 desc']:
+            query_text = query_text.format(self.join_path)
+            swapped_output = self.run_csv_query(query_text, self.input_path)
+            rbql_engine.swapped_join_size_ratio = 1000000
+            self.assertEqual(self.run_csv_query(query_text, self.input_path), swapped_output)
+            rbql_engine.swapped_join_size_ratio = self.swapped_join_size_ratio
+
+
+class TestSqliteJoin(unittest.TestCase):
+    def setUp(self):
+        import sqlite3
+        self.db_connection = sqlite3.connect(':memory:')
+        self.db_connection.execute('CREATE TABLE input_table (id TEXT, value INTEGER)')
+        self.db_connection.executemany('INSERT INTO input_table VALUES (?, ?)', [('k{}'.format(i % 7), i) for i in range(30)] + [('K1', 100)])
+        self.db_connection.execute('CREATE TABLE "order" (id TEXT, name TEXT)')
+        self.db_connection.executemany('INSERT INTO "order" VALUES (?, ?)', [('k{}'.format(i % 5), 'n{}'.format(i)) for i in range(20)])
+        self.db_connection.commit()
+        self.query_text = 'select a.value, b.name, bNR join order on a.id == b.id'
+
+    def tearDown(self):
+        self.db_connection.close()
+
+    def get_schema(self):
+        return self.db_connection.execute('SELECT type, name FROM sqlite_master ORDER BY name').fetchall()
+
+    def run_sqlite_query(self):
+        from rbql import rbql_sqlite
+        join_tables_registry = rbql_sqlite.SqliteDbRegistry(self.db_connection)
+        output_table = []
+        warnings = []
+        try:
+            rbql_engine.query(self.query_text, rbql_sqlite.SqliteRecordIterator(self.db_connection, 'input_table'), rbql_engine.TableWriter(output_table), warnings, join_tables_registry)
+        finally:
+            join_maps = list(join_tables_registry.join_maps)
+            join_tables_registry.finish()
+        return output_table, join_maps
+
+    def test_table_without_index_is_not_modified(self):
+        schema = self.get_schema()
+        output_table, join_maps = self.run_sqlite_query()
+        self.assertEqual(schema, self.get_schema())
+        self.assertEqual([], join_maps)
+        self.assertEqual(88, len(output_table))
+
+    def test_existing_index_is_used(self):
+        expected_output, join_maps = self.run_sqlite_query()
+        self.db_connection.execute('CREATE INDEX order_id_index ON "order" (id)')
+        output_table, join_maps = self.run_sqlite_query()
+        self.assertEqual(1, len(join_maps))
+        self.assertEqual(expected_output, output_table)
+
+    def test_record_numbers_after_deletion(self):
+        # "bNR" is the position of the join record, not its rowid.
+        self.db_connection.execute('DELETE FROM "order" WHERE name == "n0"')
+        expected_output, join_maps = self.run_sqlite_query()
+        self.assertEqual([0, 'n5', 5], expected_output[0])
+        self.db_connection.execute('CREATE INDEX order_id_index ON "order" (id)')
+        output_table, join_maps = self.run_sqlite_query()
+        self.assertEqual([], join_maps)
+        self.assertEqual(expected_output, output_table)
+
+    def test_index_with_other_collation_is_not_used(self):
+        expected_output, join_maps = self.run_sqlite_query()
+        self.db_connection.execute('CREATE INDEX order_id_index ON "order" (id COLLATE NOCASE)')
+        output_table, join_maps = self.run_sqlite_query()
+        self.assertEqual([], join_maps)
+        self.assertEqual(expected_output, output_table)
+
+
+class TestMultipleJoins(CSVTestCase):
+    def setUp(self):
+        super(TestMultipleJoins, self).setUp()
+        self.input_table = [['k{}'.format(i % 4), 'm{}'.format(i % 3), str(i)] for i in range(12)]
+        self.b_table = [['k{}'.format(i % 3), 'b{}'.format(i)] for i in range(6)]
+        self.c_table = [['m{}'.format(i), 'c{}'.format(i)] for i in range(2)]
+
+    def run_multi_join_query(self, query_text):
+        join_tables_registry = rbql_engine.ListTableRegistry([rbql_engine.ListTableInfo('B', self.b_table, None), rbql_engine.ListTableInfo('C', self.c_table, None)])
+        output_table = []
+        warnings = []
+        rbql_engine.query(query_text, rbql_engine.TableIterator(self.input_table), rbql_engine.TableWriter(output_table), warnings, join_tables_registry)
+        return output_table
+
+    def test_multiple_joins_match_consecutive_joins(self):
+        output_table = self.run_multi_join_query('select a3, b2, c2, cNR join B on a1 == b1 left join C on a2 == c1')
+        intermediate_table, warnings = run_table_query('select a3, b2, a2 join B on a1 == b1', self.input_table, self.b_table)
+        expected_table, warnings = run_table_query('select a1, a2, b2, bNR left join B on a3 == b1', intermediate_table, self.c_table)
+        self.assertEqual(expected_table, output_table)
+        self.assertTrue(len(output_table) > 0)
+
+    def test_star_expression(self):
+        output_table = self.run_multi_join_query('select * join B on a1 == b1 join C on a2 == c1')
+        self.assertTrue(len(output_table) > 0)
+        for record in output_table:
+            self.assertEqual(7, len(record))
+            self.assertEqual((record[0], record[1]), (record[3], record[5]))
+
+    def test_csv_multiple_joins(self):
+        input_path = self.write_table('input.csv', [','.join(r) for r in self.input_table])
+        b_path = self.write_table('b.csv', [','.join(r) for r in self.b_table])
+        c_path = self.write_table('c.csv', [','.join(r) for r in self.c_table])
+        output, warnings = self.run_csv_query('select a3, b2, c2 join {} on a1 == b1 join {} on a2 == c1'.format(b_path, c_path), input_path)
+        self.assertEqual([','.join(r[:3]) for r in self.run_multi_join_query('select a3, b2, c2 join B on a1 == b1 join C on a2 == c1')], output)
+
+    def test_update_with_multiple_joins(self):
+        error_type, error_msg = run_table_query('update set a3 = b2 join B on a1 == b1 join B on a2 == c1', self.input_table, self.b_table)
+        self.assertEqual('query parsing', error_type)
+
+
+class TestRecordIndex(CSVTestCase):
+    def setUp(self):
+        super(TestRecordIndex, self).setUp()
+        self.lines = ['id,val,country,name'] + ['{},{},{},n{}'.format(i, i % 31, ['US', 'UK'][i % 2], i % 10) for i in range(1, 3001)]
+        self.lines[24] = '24,bad,UK,n4'
+        self.lines[100] = '100,7,US'
+
+    def build_index(self, input_path):
+        return rbql_csv.build_csv_record_index(input_path, 'utf-8', ',', 'quoted', step=100)
+
+    def test_results_errors_and_warnings_are_preserved(self):
+        input_path = self.write_table('input.csv', self.lines)
+        self.build_index(input_path)
+        queries = ['select a.id where NR > 2500 and NR <= 2510', 'select a.id where int(a.val) > 0 and NR <= 20', 'select a.id where a.name in ("n5", "n7") and NR < 300', 'select a.id where NR > 150 and NR < 160']
+        for query_text in queries:
+            self.assert_same_as_reference(query_text, input_path, with_headers=True)
+        error_type, error_msg = self.run_csv_query('select a.id where int(a.val) > 0 and NR <= 20', input_path, with_headers=True)
+        self.assertTrue(error_msg.startswith('At record 24,'))
+        output, warnings = self.run_csv_query('select a.id where NR > 2500 and NR <= 2510', input_path, with_headers=True)
+        self.assertEqual(10, len(output) - 1)
+        self.assertEqual(1, len(warnings))
+
+    def test_blocks_are_skipped(self):
+        input_path = self.write_table('input.csv', self.lines)
+        self.build_index(input_path)
+        input_iterator = rbql_csv.CSVRecordIterator(open(input_path, 'rb'), 'utf-8', ',', 'quoted', has_header=True)
+        rbql_csv.set_table_indexes(input_iterator, input_path, 'utf-8', ',', 'quoted', None)
+        input_iterator.set_record_number_range(2501, 2510)
+        read_lines = []
+        get_row = input_iterator.polymorphic_get_row
+        input_iterator.polymorphic_get_row = lambda: read_lines.append(1) or get_row()
+        self.assertEqual(10, len(input_iterator.get_all_records()))
+        # Only the rest of the first block (with the header) and the block with the requested records are read.
+        self.assertEqual(199, len(read_lines) - 1)
+        self.assertEqual(2990, input_iterator.pop_num_skipped_records())
+        self.assertEqual(1, len(input_iterator.get_warnings()))
+
+    def test_invalid_index_is_ignored(self):
+        input_path = self.write_table('input.csv', self.lines)
+        self.build_index(input_path)
+        index_path = rbql_csv.get_record_index_path(input_path)
+        marker_path = os.path.join(self.tmp_dir, 'marker')
+        with open(index_path, 'rb') as f:
+            valid_index = f.read()
+        invalid_indexes = [b'garbage', b'[1, 2]', valid_index.replace(b'"entries": [[', b'"entries": [["x", '), valid_index.replace(b'"block_fields_info": [[', b'"block_fields_info": [5, ['), pickle.dumps(PickledFileCreator(marker_path))]
+        for invalid_index in invalid_indexes:
+            with open(index_path, 'wb') as f:
+                f.write(invalid_index)
+            self.assertEqual(None, rbql_csv.load_csv_record_index(input_path, 'utf-8', ',', 'quoted'))
+            self.assert_same_as_reference('select a.id where NR > 2500 and NR <= 2510', input_path, with_headers=True)
+        self.assertFalse(os.path.exists(marker_path))
+        # The index is valid only for the same dialect.
+        self.build_index(input_path)
+        self.assertTrue(rbql_csv.load_csv_record_index(input_path, 'utf-8', ',', 'quoted') is not None)
+        self.assertEqual(None, rbql_csv.load_csv_record_index(input_path, 'utf-8', ';', 'quoted'))
+
+
+class TestZoneMaps(CSVTestCase):
+    def setUp(self):
+        super(TestZoneMaps, self).setUp()
+        self.lines = ['id,val,country,name'] + ['{},{},{},n{}'.format(i, i % 31, ['US', 'UK'][i % 2], i // 300) for i in range(1, 3000)]
+        self.lines[24] = '24,bad,UK,n0'
+        self.lines[1000] = '1000,7,US,n3,extra'
+
+    def run_with_line_counter(self, query_text, input_path):
+        input_iterator = rbql_csv.CSVRecordIterator(open(input_path, 'rb'), 'utf-8', ',', 'quoted', has_header=True)
+        rbql_csv.set_table_indexes(input_iterator, input_path, 'utf-8', ',', 'quoted', None)
+        read_lines = []
+        get_row = input_iterator.polymorphic_get_row
+        input_iterator.polymorphic_get_row = lambda: read_lines.append(1) or get_row()
+        output_table = []
+        rbql.query(query_text, input_iterator, rbql_engine.TableWriter(output_table), [])
+        return (output_table, len(read_lines))
+
+    def test_results_errors_and_warnings_are_preserved(self):
+        input_path = self.write_table('input.csv', self.lines)
+        rbql_csv.build_csv_record_index(input_path, 'utf-8', ',', 'quoted', step=100, with_zone_maps=True)
+        self.assertTrue(rbql_csv.load_csv_zone_maps(input_path, 'utf-8', ',', 'quoted') is not None)
+        queries = ['select a.id where a.name >= "n9"', 'select a.id where int(a.val) > 10 and a.name >= "n9"', 'select a.id where float(a.val) < 5 and a.name == "n5"', 'select a.id where a.country == "US" and a.name in ("n3", "n4")', 'select a.id where len(a.name) > 1 and a.name == "n2"']
+        for query_text in queries:
+            self.assert_same_as_reference(query_text, input_path, with_headers=True)
+        error_type, error_msg = self.run_csv_query('select a.id where int(a.val) > 10 and a.name >= "n9"', input_path, with_headers=True)
+        self.assertTrue(error_msg.startswith('At record 24,'))
+        output, warnings = self.run_csv_query('select a.id where a.name >= "n9"', input_path, with_headers=True)
+        self.assertEqual(1, len(warnings))
+        # Blocks with records which don't have all of the fields are never skipped.
+        self.lines[1000] = '1000,7,US'
+        input_path = self.write_table('input.csv', self.lines)
+        rbql_csv.build_csv_record_index(input_path, 'utf-8', ',', 'quoted', step=100, with_zone_maps=True)
+        error_type, error_msg = self.assert_same_as_reference('select a.id where a.name >= "n9"', input_path, with_headers=True)
+        self.assertTrue(error_msg.startswith('At record 1000,'))
+
+    def test_blocks_are_skipped(self):
+        self.lines[24] = '24,3,UK,n0'
+        input_path = self.write_table('input.csv', self.lines)
+        rbql_csv.build_csv_record_index(input_path, 'utf-8', ',', 'quoted', step=100, with_zone_maps=True)
+        output_table, num_read_lines = self.run_with_line_counter('select a.id where a.name == "n5"', input_path)
+        self.assertEqual(300, len(output_table))
+        self.assertTrue(num_read_lines < 600)
+        output_table, num_read_lines = self.run_with_line_counter('select a.id where int(a.val) == 3 and a.name == "n5"', input_path)
+        self.assertEqual(9, len(output_table))
+        self.assertTrue(num_read_lines < 600)
+        # Values of the "name" field can't be converted to int, so blocks are not skipped even though "country" field never matches.
+        output_table, num_read_lines = self.run_with_line_counter('select a.id where a.country == "FR" and int(a.name) == 3', input_path)
+        self.assertEqual([], output_table)
+        self.assertEqual(3000, num_read_lines)
+
+    def test_invalid_zone_maps_are_ignored(self):
+        input_path = self.write_table('input.csv', self.lines)
+        rbql_csv.build_csv_record_index(input_path, 'utf-8', ',', 'quoted', step=100, with_zone_maps=True)
+        zone_maps_path = rbql_csv.get_zone_maps_path(input_path)
+        marker_path = os.path.join(self.tmp_dir, 'marker')
+        with open(zone_maps_path, 'rb') as f:
+            valid_zone_maps = f.read()
+        invalid_zone_maps = [b'garbage', valid_zone_maps.replace(b'"block_stats": [[[', b'"block_stats": [[[5, '), pickle.dumps(PickledFileCreator(marker_path))]
+        for zone_maps in invalid_zone_maps:
+            with open(zone_maps_path, 'wb') as f:
+                f.write(zone_maps)
+            self.assertEqual(None, rbql_csv.load_csv_zone_maps(input_path, 'utf-8', ',', 'quoted'))
+            self.assert_same_as_reference('select a.id where a.name >= "n9"', input_path, with_headers=True)
+        self.assertFalse(os.path.exists(marker_path))
+
+
+class TestColumnarCache(CSVTestCase):
+    def setUp(self):
+        super(TestColumnarCache, self).setUp()
+        self.lines = ['id,val,country,name'] + ['{},{},{},n{}'.format(i, i % 31, ['US', 'UK'][i % 2], i // 300) for i in range(1, 3000)]
+        self.lines[24] = '24,bad,UK,n0'
+        self.lines[1000] = '1000,7,US,n3,extra'
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+
+    def get_cache_entries(self):
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_results_errors_and_warnings_are_preserved(self):
+        input_path = self.write_table('input.csv', self.lines)
+        queries = ['select a.id where NR > 2500 and NR <= 2510', 'select a.id where int(a.val) > 0 and NR <= 20', 'select a.id where a.name >= "n9"', 'select a.id where int(a.val) > 10 and a.name >= "n9"', 'select a.id where a.country == "FR" and int(a.name) == 3', 'select top 5 a.id where a.name == "n5"']
+        for query_text in queries:
+            self.assert_same_as_reference(query_text, input_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+        output, warnings = self.run_csv_query('select a.id where NR > 2500 and NR <= 2510', input_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+        self.assertEqual(10, len(output) - 1)
+        self.assertEqual(1, len(warnings))
+        self.lines[1000] = '1000,7,US'
+        input_path = self.write_table('input.csv', self.lines)
+        for query_text in ['select a.id where a.name >= "n0" and NR > 2500 and NR <= 2510', 'select a.id where a.name >= "n5"']:
+            error_type, error_msg = self.assert_same_as_reference(query_text, input_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+            self.assertTrue(error_msg.startswith('At record 1000,'))
+
+    def test_chunks_outside_of_record_number_range_are_not_read(self):
+        input_path = self.write_table('input.csv', self.lines)
+        chunk_size, read_values = rbql_csv.columnar_cache_chunk_size, rbql_csv.ColumnReader.read_values
+        read_chunks = []
+        rbql_csv.columnar_cache_chunk_size = 100
+        rbql_csv.ColumnReader.read_values = lambda reader, num_values: read_chunks.append(num_values) or read_values(reader, num_values)
+        try:
+            self.run_csv_query('select a.id', input_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+            del read_chunks[:]
+            output, warnings = self.assert_same_as_reference('select a.id where NR > 2500 and NR <= 2510', input_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+        finally:
+            rbql_csv.columnar_cache_chunk_size, rbql_csv.ColumnReader.read_values = chunk_size, read_values
+        self.assertEqual(10, len(output) - 1)
+        self.assertEqual(1, len(warnings))
+        self.assertEqual([100], read_chunks)
+
+    def test_single_entry_per_table(self):
+        input_path = self.write_table('input.csv', self.lines)
+        other_path = self.write_table('other.csv', self.lines[:100])
+        self.run_csv_query('select a.id', input_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+        self.run_csv_query('select a.id', other_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+        cache_entries = self.get_cache_entries()
+        self.assertEqual(2, len(cache_entries))
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, cache_entries[0], 'metadata.json')))
+        self.lines[5] = '5,3,US,n7'
+        input_path = self.write_table('input.csv', self.lines)
+        self.assert_same_as_reference('select a.id where a.name == "n7"', input_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+        self.assert_same_as_reference('select a.id where a1 == "5"', input_path, delim=';', columnar_cache_dir=self.cache_dir)
+        self.assertEqual(cache_entries, self.get_cache_entries())
+        # Entries of deleted tables are removed.
+        os.remove(other_path)
+        self.run_csv_query('select a.id', input_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+        self.assertEqual([os.path.basename(rbql_csv.get_columnar_cache_path(self.cache_dir, input_path))], self.get_cache_entries())
+
+    def test_invalid_metadata_is_ignored(self):
+        input_path = self.write_table('input.csv', self.lines)
+        expected = self.run_csv_query('select a.id where a.name == "n7"', input_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+        metadata_path = os.path.join(rbql_csv.get_columnar_cache_path(self.cache_dir, input_path), 'metadata.json')
+        marker_path = os.path.join(self.tmp_dir, 'marker')
+        with open(metadata_path, 'rb') as f:
+            valid_metadata = f.read()
+        invalid_metadata = [b'garbage', valid_metadata.replace(b'"column_types": [', b'"column_types": [5, '), pickle.dumps(PickledFileCreator(marker_path))]
+        for metadata in invalid_metadata:
+            with open(metadata_path, 'wb') as f:
+                f.write(metadata)
+            self.assertEqual(expected, self.run_csv_query('select a.id where a.name == "n7"', input_path, with_headers=True, columnar_cache_dir=self.cache_dir))
+            with open(metadata_path, 'rb') as f:
+                self.assertEqual(valid_metadata, f.read())
+        self.assertFalse(os.path.exists(marker_path))
+
+    @unittest.skipIf(not hasattr(os, 'getuid'), 'POSIX permissions are required')
+    def test_shared_cache_dir_is_not_used(self):
+        input_path = self.write_table('input.csv', self.lines)
+        os.mkdir(self.cache_dir)
+        os.chmod(self.cache_dir, 0o777)
+        output, warnings = self.run_csv_query('select a.id where a.name == "n7"', input_path, with_headers=True, columnar_cache_dir=self.cache_dir)
+        self.assertEqual(2, len(warnings))
+        self.assertTrue(warnings[0].find('is not private to the current user') != -1)
+        self.assertEqual([], self.get_cache_entries())
+
+
+class TestKeyIndex(CSVTestCase):
+    def setUp(self):
+        super(TestKeyIndex, self).setUp()
+        self.lines = ['id,val,country,name'] + ['{},{},{},n{}'.format(i, i % 31, ['US', 'UK'][i % 2], i % 10) for i in range(1, 3000)]
+        self.lines[24] = '24,bad,UK,n4'
+        self.lines[1000] = '1000,7,US,n0,extra'
+
+    def run_with_line_counter(self, query_text, input_path):
+        input_iterator = rbql_csv.CSVRecordIterator(open(input_path, 'rb'), 'utf-8', ',', 'quoted', has_header=True)
+        rbql_csv.set_table_indexes(input_iterator, input_path, 'utf-8', ',', 'quoted', None)
+        read_lines = []
+        get_row = input_iterator.polymorphic_get_row
+        input_iterator.polymorphic_get_row = lambda: read_lines.append(1) or get_row()
+        output_table = []
+        warnings = []
+        rbql.query(query_text, input_iterator, rbql_engine.TableWriter(output_table), warnings)
+        return (output_table, warnings, len(read_lines))
+
+    def test_results_errors_and_warnings_are_preserved(self):
+        input_path = self.write_table('input.csv', self.lines)
+        self.assertEqual(3000, rbql_csv.build_csv_key_index(input_path, 'utf-8', ',', 'quoted', 0))
+        queries = ['select a.name where a.id == "2500"', 'select a.id where a.id in ("5", "1500", "2999")', 'select top 1 a.id where a.id in ("5", "1500")', 'select a.id where int(a.val) > 0 and a.id == "2500"']
+        for query_text in queries:
+            self.assert_same_as_reference(query_text, input_path, with_headers=True)
+        output_table, warnings, num_read_lines = self.run_with_line_counter('select a.name where a.id == "2500"', input_path)
+        self.assertEqual([['n0']], output_table)
+        self.assertEqual(1, len(warnings))
+        self.assertTrue(num_read_lines < 5)
+        # Conversions of records which are not read could fail.
+        error_type, error_msg = self.run_csv_query('select a.id where int(a.val) > 0 and a.id == "2500"', input_path, with_headers=True)
+        self.assertTrue(error_msg.startswith('At record 24,'))
+
+    def test_records_with_missing_fields_are_not_skipped(self):
+        self.lines[1000] = '1000,7,US'
+        input_path = self.write_table('input.csv', self.lines)
+        rbql_csv.build_csv_key_index(input_path, 'utf-8', ',', 'quoted', 0)
+        error_type, error_msg = self.assert_same_as_reference('select a.id where a.name >= "n0" and a.id == "2500"', input_path, with_headers=True)
+        self.assertTrue(error_msg.startswith('At record 1000,'))
+        output_table, warnings, num_read_lines = self.run_with_line_counter('select a.val where a.id == "2500"', input_path)
+        self.assertEqual([['20']], output_table)
+        self.assertTrue(num_read_lines < 5)
+
+    def test_invalid_index_is_ignored(self):
+        input_path = self.write_table('input.csv', self.lines)
+        rbql_csv.build_csv_key_index(input_path, 'utf-8', ',', 'quoted', 0)
+        index_path = rbql_csv.get_key_index_path(input_path, 0)
+        marker_path = os.path.join(self.tmp_dir, 'marker')
+        with open(index_path, 'rb') as f:
+            valid_index = f.read()
+        pickled_metadata = pickle.dumps(PickledFileCreator(marker_path))
+        invalid_indexes = [b'garbage', valid_index[:-1], valid_index.replace(b'"num_entries": 3000', b'"num_entries": 3001'), struct.pack('<q', len(pickled_metadata)) + pickled_metadata]
+        for invalid_index in invalid_indexes:
+            with open(index_path, 'wb') as f:
+                f.write(invalid_index)
+            self.assertEqual(dict(), rbql_csv.load_csv_key_indexes(input_path, 'utf-8', ',', 'quoted'))
+            self.assert_same_as_reference('select a.name where a.id == "2500"', input_path, with_headers=True)
+        self.assertFalse(os.path.exists(marker_path))
+
+
+class TestIncrementalState(CSVTestCase):
+    def setUp(self):
+        super(TestIncrementalState, self).setUp()
+        self.state_dir = os.path.join(self.tmp_dir, 'state')
+        self.lines = ['id,val,country,name'] + ['{},{},{},n{}'.format(i, i % 31, ['US', 'UK'][i % 2], i % 3) for i in range(1, 300)]
+
+    def append_lines(self, input_path, lines, line_separator='\n'):
+        with open(input_path, 'ab') as f:
+            f.write(''.join(line + line_separator for line in lines).encode('utf-8'))
+
+    def get_state_paths(self):
+        return [os.path.join(self.state_dir, name) for name in os.listdir(self.state_dir)]
+
+    def test_appended_records_are_aggregated(self):
+        query_text = 'select a.country, a.name, count(*), avg(a.val), median(a.val), max(a.id) group by a.country, a.name'
+        input_path = self.write_table('input.csv', self.lines[:100])
+        self.run_csv_query(query_text, input_path, with_headers=True, incremental_state_dir=self.state_dir)
+        self.assertTrue(self.get_state_paths()[0].endswith('.json'))
+        self.append_lines(input_path, self.lines[100:])
+        actual = self.run_csv_query(query_text, input_path, with_headers=True, incremental_state_dir=self.state_dir)
+        expected = self.run_csv_query(query_text, self.write_table('full.csv', self.lines), with_headers=True)
+        self.assertEqual(expected, actual)
+
+    def test_incomplete_multiline_record_is_not_consumed(self):
+        query_text = 'select a.country, count(*), max(len(a.name)) group by a.country'
+        input_path = self.write_table('input.csv', self.lines[:100])
+        self.run_csv_query(query_text, input_path, with_headers=True, policy='quoted_rfc', incremental_state_dir=self.state_dir)
+        # The multiline record is being written, its first line is already complete.
+        self.append_lines(input_path, ['1000,5,US,"first line'])
+        output, warnings = self.run_csv_query(query_text, input_path, with_headers=True, policy='quoted_rfc', incremental_state_dir=self.state_dir)
+        self.assertEqual(self.run_csv_query(query_text, self.write_table('head.csv', self.lines[:100]), with_headers=True, policy='quoted_rfc'), (output, warnings))
+        self.append_lines(input_path, ['second line"'] + self.lines[100:])
+        actual = self.run_csv_query(query_text, input_path, with_headers=True, policy='quoted_rfc', incremental_state_dir=self.state_dir)
+        expected = self.run_csv_query(query_text, input_path, with_headers=True, policy='quoted_rfc')
+        self.assertEqual(expected, actual)
+        self.assertEqual(['country,col2,col3', 'UK,150,2', 'US,150,22'], actual[0])
+
+    def test_invalid_state_is_ignored(self):
+        query_text = 'select a.country, a.name, count(*), avg(a.val) group by a.country, a.name'
+        input_path = self.write_table('input.csv', self.lines)
+        expected = self.run_csv_query(query_text, input_path, with_headers=True, incremental_state_dir=self.state_dir)
+        state_path = self.get_state_paths()[0]
+        marker_path = os.path.join(self.tmp_dir, 'marker')
+        with open(state_path, 'rb') as f:
+            valid_state = f.read()
+        invalid_states = [b'garbage', valid_state.replace(b'"tuple"', b'"list"'), valid_state.replace(b'"AvgAggregator"', b'"CountAggregator"').replace(b'"CountAggregator"', b'"AvgAggregator"', 1), pickle.dumps(PickledFileCreator(marker_path))]
+        for invalid_state in invalid_states:
+            with open(state_path, 'wb') as f:
+                f.write(invalid_state)
+            self.assertEqual(expected, self.run_csv_query(query_text, input_path, with_headers=True, incremental_state_dir=self.state_dir))
+        self.assertFalse(os.path.exists(marker_path))
+
+
+class AppendedChunksStream(object):
+    # Input stream of a growing table: an empty chunk means that nothing was appended yet when the reader reached EOF.
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def read(self, size):
+        return self.chunks.pop(0) if len(self.chunks) else ''
+
+
+class TestFollowMode(unittest.TestCase):
+    def setUp(self):
+        self.follow_poll_interval = rbql_csv.follow_poll_interval
+        rbql_csv.follow_poll_interval = 0
+
+    def tearDown(self):
+        rbql_csv.follow_poll_interval = self.follow_poll_interval
+
+    def run_follow_query(self, query_text, chunks):
+        input_iterator = rbql_csv.CSVRecordIterator(AppendedChunksStream(chunks), None, ',', 'quoted', follow=True, follow_idle_timeout=0)
+        output_stream = io.StringIO()
+        warnings = []
+        rbql.query(query_text, input_iterator, rbql_csv.CSVWriter(output_stream, False, None, ',', 'quoted'), warnings)
+        return output_stream.getvalue().split('\n')
+
+    def test_aggregate_snapshots_are_separated(self):
+        # Nothing is aggregated from "x,7" so there is no snapshot after it, the final result is the same as the last snapshot and isn't repeated.
+        output = self.run_follow_query('select a1, sum(int(a2)) where a1 != "x" group by a1', ['a,1\nb,2\n', '', 'x,7\n', '', 'a,3\n'])
+        self.assertEqual(['a,1', 'b,2', '', 'a,4', 'b,2', ''], output)
+
+    def test_top_snapshots_are_separated(self):
+        output = self.run_follow_query('select top 1 a1, count(*) group by a1', ['b,1\n', '', 'a,2\n'])
+        self.assertEqual(['b,1', '', 'a,1', ''], output)
+
+
+class TestSharedScan(CSVTestCase):
+    def setUp(self):
+        super(TestSharedScan, self).setUp()
+        self.lines = ['id,val,country'] + ['{},{},{}'.format(i, i % 17, ['US', 'UK', 'FR'][i % 3]) for i in range(1, 1000)]
+
+    def run_shared_scan(self, query_texts, input_path):
+        input_iterator = rbql_csv.CSVRecordIterator(open(input_path, 'rb'), 'utf-8', ',', 'quoted', has_header=True)
+        read_lines = []
+        get_row = input_iterator.polymorphic_get_row
+        input_iterator.polymorphic_get_row = lambda: read_lines.append(1) or get_row()
+        output_tables = [[] for _ in query_texts]
+        rbql_engine.query_shared_scan(query_texts, input_iterator, [rbql_engine.TableWriter(t) for t in output_tables], [])
+        return (output_tables, len(read_lines))
+
+    def test_results_are_the_same_as_separate_queries(self):
+        input_path = self.write_table('input.csv', self.lines)
+        query_texts = ['select a.id, a.val where int(a.val) > 10', 'select a.country, count(*), sum(int(a.val)) group by a.country', 'select distinct a.val order by int(a.val) desc', 'select top 5 * where a.country == "FR"', 'update set a.val = a.country']
+        output_paths = [os.path.join(self.tmp_dir, 'output_{}.csv'.format(i)) for i in range(len(query_texts))]
+        warnings = []
+        rbql_csv.query_csv_shared_scan(query_texts, input_path, ',', 'quoted', output_paths, ',', 'quoted', 'utf-8', warnings, True)
+        for query_text, output_path in zip(query_texts, output_paths):
+            expected = self.run_csv_query(query_text, input_path, with_headers=True)
+            self.assertEqual(expected[0], self.read_table(output_path))
+
+    def test_input_is_read_once(self):
+        input_path = self.write_table('input.csv', self.lines)
+        output_tables, num_read_lines = self.run_shared_scan(['select a.id', 'select a.country, max(int(a.val)) group by a.country', 'select a.val order by a.id'], input_path)
+        self.assertEqual([999, 3, 999], [len(t) for t in output_tables])
+        # Each record is read once, the header was read by the iterator constructor and the last call reports EOF.
+        self.assertEqual(len(self.lines) - 1, num_read_lines - 1)
+
+    def test_queries_with_limit_drop_out_early(self):
+        input_path = self.write_table('input.csv', self.lines)
+        output_tables, num_read_lines = self.run_shared_scan(['select top 3 a.id', 'select top 10 a.id where a.country == "US"'], input_path)
+        self.assertEqual([[['1'], ['2'], ['3']], [[str(i)] for i in range(3, 31, 3)]], output_tables)
+        self.assertTrue(num_read_lines < 40)
+
+    def test_different_modifiers_are_rejected(self):
+        input_path = self.write_table('input.csv', self.lines)
+        output_paths = [os.path.join(self.tmp_dir, 'output_1.csv'), os.path.join(self.tmp_dir, 'output_2.csv')]
+        with self.assertRaises(rbql_engine.RbqlParsingError):
+            rbql_csv.query_csv_shared_scan(['select a1', 'select a1 with (header)'], input_path, ',', 'quoted', output_paths, ',', 'quoted', 'utf-8', [], False)
+
+
+class TestPartitionedOutput(CSVTestCase):
+    def setUp(self):
+        super(TestPartitionedOutput, self).setUp()
+        self.output_dir = os.path.join(self.tmp_dir, 'partitions')
+        os.mkdir(self.output_dir)
+        self.lines = ['id,val,region'] + ['{},{},r{}'.format(i, i % 7, i % 20) for i in range(1, 1000)]
+
+    def read_partitions(self):
+        return {name: self.read_table(os.path.join(self.output_dir, name)) for name in os.listdir(self.output_dir)}
+
+    def test_partitions_match_filtered_queries(self):
+        input_path = self.write_table('input.csv', self.lines)
+        query_text = 'select a.region, a.id, int(a.val) * 2 where int(a.id) % 3 != 0'
+        warnings = []
+        rbql_csv.query_csv(query_text, input_path, ',', 'quoted', self.output_dir, ',', 'quoted', 'utf-8', warnings, True, partition_by='region')
+        partitions = self.read_partitions()
+        self.assertEqual(['r{}.csv'.format(i) for i in range(20)], sorted(partitions.keys(), key=lambda name: int(name[1:-4])))
+        for i in range(20):
+            expected = self.run_csv_query(query_text + ' and a.region == "r{}"'.format(i), input_path, with_headers=True)
+            self.assertEqual(expected[0], partitions['r{}.csv'.format(i)])
+
+    def test_files_are_reopened_for_appending(self):
+        input_path = self.write_table('input.csv', self.lines)
+        input_iterator = rbql_csv.CSVRecordIterator(open(input_path, 'rb'), 'utf-8', ',', 'quoted', has_header=True)
+        output_writer = rbql_csv.PartitionedCSVWriter(self.output_dir, '3', 'utf-8', ',', 'quoted', max_open_files=3, partition_buffer_size=10)
+        rbql.query('select a.id, a.val, a.region', input_iterator, output_writer, [])
+        partitions = self.read_partitions()
+        self.assertEqual(20, len(partitions))
+        for i in range(20):
+            self.assertEqual(['id,val,region'] + [line for line in self.lines[1:] if line.endswith(',r{}'.format(i))], partitions['r{}.csv'.format(i)])
+
+    def test_partition_file_names_are_safe_and_unique(self):
+        input_path = self.write_table('input.csv', ['a/b,1', 'a_b,2', ',3', '..x,4', 'A_B,5'])
+        rbql_csv.query_csv('select a1, a2', input_path, ',', 'quoted', self.output_dir, ',', 'quoted', 'utf-8', [], False, partition_by='1')
+        self.assertEqual({'a_b.csv': ['a/b,1'], 'a_b_2.csv': ['a_b,2'], '_.csv': [',3'], 'x.csv': ['..x,4'], 'A_B_3.csv': ['A_B,5']}, self.read_partitions())
+
+    def test_output_directory_must_exist_and_be_empty(self):
+        input_path = self.write_table('input.csv', self.lines)
+        missing_dir = os.path.join(self.tmp_dir, 'missing')
+        with open(os.path.join(self.output_dir, 'old.csv'), 'wb') as f:
+            f.write(b'id,val,region\n')
+        for output_dir in [missing_dir, self.output_dir]:
+            with self.assertRaises(rbql_engine.RbqlIOHandlingError):
+                rbql_csv.query_csv('select *', input_path, ',', 'quoted', output_dir, ',', 'quoted', 'utf-8', [], True, partition_by='region')
+        self.assertFalse(os.path.exists(missing_dir))
+        self.assertEqual(['old.csv'], os.listdir(self.output_dir))
+
+    def test_missing_partition_column(self):
+        input_path = self.write_table('input.csv', self.lines)
+        with self.assertRaises(rbql_engine.RbqlIOHandlingError) as context:
+            rbql_csv.query_csv('select a.id, a.val', input_path, ',', 'quoted', self.output_dir, ',', 'quoted', 'utf-8', [], True, partition_by='region')
+        self.assertTrue(str(context.exception).find('Unable to find partition column') != -1)
+
+
+class TestCommonTableExpressions(CSVTestCase):
+    def setUp(self):
+        super(TestCommonTableExpressions, self).setUp()
+        self.lines = ['id,val,country'] + ['{},{},{}'.format(i, i % 13, ['US', 'UK', 'FR', 'DE'][i % 4]) for i in range(1, 500)]
+
+    def test_results_are_the_same_as_with_temporary_files(self):
+        input_path = self.write_table('input.csv', self.lines)
+        expected_stats = self.run_csv_query('select a.country, count(*) as n, sum(int(a.val)) as s group by a.country', input_path, with_headers=True)
+        stats_path = self.write_table('stats.csv', expected_stats[0])
+        expected = self.run_csv_query('select a.id, b.n, b.s join {} on a.country == b.country where int(a.val) > 10'.format(stats_path), input_path, with_headers=True)
+        actual = self.run_csv_query('with stats as (select a.country, count(*) as n, sum(int(a.val)) as s group by a.country) select a.id, b.n, b.s join stats on a.country == b.country where int(a.val) > 10', input_path, with_headers=True)
+        self.assertEqual(expected[0], actual[0])
+
+    def test_statements_can_read_previous_results(self):
+        input_table = [['x', '1'], ['y', '2'], ['x', '3'], ['z', '5']]
+        query_text = 'with t as (select a1, sum(int(a2)) group by a1), u as (select a2 * 10 from t where a2 > 2) select * from u order by a1'
+        self.assertEqual(([[40], [50]], []), run_table_query(query_text, input_table))
+
+    def test_input_table_is_read_once(self):
+        input_path = self.write_table('input.csv', self.lines)
+        input_iterator = rbql_csv.CSVRecordIterator(open(input_path, 'rb'), 'utf-8', ',', 'quoted', has_header=True)
+        read_lines = []
+        get_row = input_iterator.polymorphic_get_row
+        input_iterator.polymorphic_get_row = lambda: read_lines.append(1) or get_row()
+        output_table = []
+        rbql.query('with us as (select a.id where a.country == "US") select a.id, a.val join us on a.id == b.id', input_iterator, rbql_engine.TableWriter(output_table), [])
+        self.assertEqual([[str(i), str(i % 13)] for i in range(4, 500, 4)], output_table)
+        self.assertEqual(len(self.lines) - 1, len(read_lines) - 1)
+
+    def test_invalid_common_table_expressions(self):
+        input_table = [['x', '1']]
+        self.assertEqual(('query parsing', 'Invalid common table expression name: "a"'), run_table_query('with a as (select a1) select a1', input_table))
+        self.assertEqual(('query parsing', 'Invalid common table expression name: "t"'), run_table_query('with t as (select a1), t as (select a2) select a1', input_table))
+        self.assertEqual(('query parsing', 'Unbalanced parentheses in common table expression "t"'), run_table_query('with t as (select (a1) select a1', input_table))
+
+
+class OpenedStreamsSpy(object):
+    # Collects streams which are opened by rbql_csv module.
+    def __init__(self, opened_streams):
+        self.opened_streams = opened_streams
+
+    def __enter__(self):
+        def spy_open(*args, **kwargs):
+            stream = open(*args, **kwargs)
+            self.opened_streams.append(stream)
+            return stream
+        rbql_csv.open = spy_open
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del rbql_csv.open
+
+
+class TestStreamingQueries(CSVTestCase):
+    def setUp(self):
+        super(TestStreamingQueries, self).setUp()
+        self.lines = ['id,val,country'] + ['{},{},{}'.format(i, i % 11, ['US', 'UK'][i % 2]) for i in range(1, 3000)]
+
+    def test_results_are_the_same_as_query_csv(self):
+        input_path = self.write_table('input.csv', self.lines)
+        for query_text in ['select a.id, int(a.val) * 2 where a.country == "UK"', 'select top 10 a.id order by int(a.val) desc', 'select a.country, count(*), max(a.id) group by a.country', 'select distinct a.val']:
+            warnings = []
+            output_header, output_records = rbql.iter_query_csv(query_text, input_path, ',', 'quoted', 'utf-8', warnings, True)
+            actual = [','.join(output_header)] + [','.join(str(v) for v in record) for record in output_records]
+            self.assertEqual(self.run_csv_query(query_text, input_path, with_headers=True), (actual, warnings))
+
+    def test_records_are_yielded_during_the_scan(self):
+        input_path = self.write_table('input.csv', self.lines)
+        input_iterator = rbql_csv.CSVRecordIterator(open(input_path, 'rb'), 'utf-8', ',', 'quoted', has_header=True)
+        read_lines = []
+        get_row = input_iterator.polymorphic_get_row
+        input_iterator.polymorphic_get_row = lambda: read_lines.append(1) or get_row()
+        warnings = []
+        output_header, output_records = rbql.iter_query('select a.id, a.country where int(a.val) == 5', input_iterator, warnings)
+        self.assertEqual(['id', 'country'], output_header)
+        self.assertEqual(0, len(read_lines))
+        self.assertEqual(['5', 'UK'], next(output_records))
+        self.assertEqual(5, len(read_lines))
+        self.assertEqual(['16', 'US'], next(output_records))
+        self.assertEqual(16, len(read_lines))
+        output_records.close()
+        self.assertEqual(16, len(read_lines))
+
+    def test_resources_are_released_without_iteration(self):
+        input_path = self.write_table('input.csv', self.lines)
+        join_path = self.write_table('join.csv', ['US,1', 'UK,2'])
+        for release in [lambda records: records.close(), lambda records: None]:
+            opened_streams = []
+            with OpenedStreamsSpy(opened_streams):
+                output_header, output_records = rbql.iter_query_csv('select a.id, b2 join {} on a.country == b1'.format(join_path), input_path, ',', 'quoted', 'utf-8', [], True)
+            self.assertEqual(2, len(opened_streams))
+            release(output_records)
+            del output_records
+            self.assertEqual([True, True], [stream.closed for stream in opened_streams])
+
+    def test_warnings_are_added_when_generator_is_exhausted(self):
+        input_path = self.write_table('input.csv', self.lines[:10] + ['10,5'])
+        warnings = []
+        output_header, output_records = rbql.iter_query_csv('select a1', input_path, ',', 'quoted', 'utf-8', warnings, False)
+        self.assertEqual(None, output_header)
+        self.assertEqual(11, len(list(output_records)))
+        self.assertEqual(1, len(warnings))
+
+
+if __name__ == '__main__':
+    unittest.main()
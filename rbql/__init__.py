@@ -1,10 +1,13 @@
 from .rbql_engine import query
 from .rbql_engine import query_table
+from .rbql_engine import prepare
+from .rbql_engine import iter_query
 from .rbql_engine import exception_to_error_info
 
 from ._version import __version__
 
 from .rbql_csv import query_csv
+from .rbql_csv import iter_query_csv
 
 from .rbql_pandas import query_dataframe as query_pandas_dataframe
 
@@ -4,9 +4,21 @@ from __future__ import print_function
 
 import sys
 import os
+import re
+import stat
 import codecs
 import io
+import array
+import shutil
+import itertools
+import operator
+import struct
+import hashlib
+import json
+import tempfile
+import time
 from errno import EPIPE
+from collections import OrderedDict
 
 from . import rbql_engine
 from . import csv_utils
@@ -17,6 +29,7 @@ polymorphic_xrange = range if PY3 else xrange
 
 default_csv_encoding = 'utf-8'
 ansi_reset_color_code = '\u001b[0m'
+follow_poll_interval = 0.5 # Seconds between checks for records appended to the input table in follow mode
 
 debug_mode = False
 
@@ -296,6 +309,31 @@ class CSVWriter(rbql_engine.RBQLOutputWriter):
         self.finish()
 
 
+    def write_snapshot_separator(self):
+        # Snapshots of aggregate results are separated by an empty line.
+        if self.broken_pipe:
+            return
+        try:
+            self.stream.write(self.line_separator)
+        except broken_pipe_exception as exc:
+            if broken_pipe_exception == IOError:
+                if exc.errno != EPIPE:
+                    raise
+            self.broken_pipe = True
+
+
+    def flush(self):
+        if self.broken_pipe:
+            return
+        try:
+            self.stream.flush()
+        except broken_pipe_exception as exc:
+            if broken_pipe_exception == IOError:
+                if exc.errno != EPIPE:
+                    raise
+            self.broken_pipe = True
+
+
     def finish(self):
         if self.broken_pipe:
             return
@@ -328,8 +366,128 @@ class CSVWriter(rbql_engine.RBQLOutputWriter):
         return result
 
 
+class PartitionedCSVWriter(CSVWriter):
+    # Splits output records into files of `output_dir` directory by the value of `partition_column` field in a single pass, the field is kept in the output.
+    # `partition_column` - either name of the column in the output header or 1-based column index.
+    # Records are buffered per partition and at most `max_open_files` files are kept open at the same time, the least recently used file is closed first.
+    def __init__(self, output_dir, partition_column, encoding, delim, policy, line_separator='\n', max_open_files=64, partition_buffer_size=65536, max_buffered_size=16 * 1024 * 1024):
+        CSVWriter.__init__(self, None, False, None, delim, policy, line_separator)
+        self.output_dir = output_dir
+        self.partition_column = partition_column
+        self.output_encoding = encoding
+        self.file_extension = {'\t': '.tsv', ',': '.csv'}.get(delim, '.txt')
+        self.max_open_files = max_open_files
+        self.partition_buffer_size = partition_buffer_size
+        self.max_buffered_size = max_buffered_size
+        self.partition_index = None
+        self.header = None
+        self.partitions = dict()
+        self.used_file_names = set()
+        self.open_files = OrderedDict() # LRU order: the least recently used file goes first.
+        self.buffered_size = 0
+
+    def set_header(self, header):
+        if header is not None and self.partition_column in header:
+            self.partition_index = header.index(self.partition_column)
+        elif re.match('^[1-9][0-9]*$', self.partition_column) is not None:
+            self.partition_index = int(self.partition_column) - 1
+        else:
+            raise rbql_engine.RbqlIOHandlingError('Unable to find partition column "{}" in the output header'.format(self.partition_column))
+        if header is not None:
+            self.header_len = len(header)
+            self.header = header
+
+    def get_partition(self, key):
+        partition = self.partitions.get(key)
+        if partition is not None:
+            return partition
+        safe_name = re.sub('[^-_.a-zA-Z0-9]', '_', key).lstrip('.')
+        if not len(safe_name):
+            safe_name = '_'
+        file_name = safe_name
+        suffix = 1
+        while file_name.lower() in self.used_file_names: # Distinct keys can have the same safe name, also some file systems are case-insensitive.
+            suffix += 1
+            file_name = '{}_{}'.format(safe_name, suffix)
+        self.used_file_names.add(file_name.lower())
+        partition = OutputPartition(os.path.join(self.output_dir, file_name + self.file_extension))
+        self.partitions[key] = partition
+        if self.header is not None:
+            self.stream = partition
+            CSVWriter.write(self, self.header[:])
+            self.buffered_size += partition.size
+        return partition
+
+    def write(self, fields):
+        if self.partition_index >= len(fields):
+            raise rbql_engine.RbqlIOHandlingError('Partition column {} is missing in output record with {} fields'.format(self.partition_index + 1, len(fields)))
+        key = fields[self.partition_index]
+        if key is None:
+            key = ''
+        elif not ((PY3 and isinstance(key, str)) or (not PY3 and isinstance(key, basestring))):
+            key = str(key)
+        partition = self.get_partition(key)
+        size_before = partition.size
+        self.stream = partition
+        CSVWriter.write(self, fields)
+        self.buffered_size += partition.size - size_before
+        if partition.size >= self.partition_buffer_size:
+            self.flush_partition(partition)
+        if self.buffered_size >= self.max_buffered_size:
+            self.flush()
+        return True
+
+    def flush_partition(self, partition):
+        output_file = self.open_files.pop(partition.path, None)
+        if output_file is None:
+            if len(self.open_files) >= self.max_open_files:
+                self.open_files.popitem(last=False)[1].close()
+            # The file is truncated on the first open and appended after it was closed to free the handle.
+            output_file = open(partition.path, 'ab' if partition.created else 'wb')
+            partition.created = True
+        self.open_files[partition.path] = output_file
+        data = ''.join(partition.chunks)
+        output_file.write(data.encode(self.output_encoding) if self.output_encoding is not None else data)
+        self.buffered_size -= partition.size
+        partition.chunks = []
+        partition.size = 0
+
+    def flush(self):
+        for partition in self.partitions.values():
+            if partition.size or not partition.created:
+                self.flush_partition(partition)
+        for output_file in self.open_files.values():
+            output_file.flush()
+
+    def write_snapshot_separator(self):
+        for partition in self.partitions.values():
+            partition.write(self.line_separator)
+            self.buffered_size += len(self.line_separator)
+
+    def close_files(self):
+        while len(self.open_files):
+            self.open_files.popitem()[1].close()
+
+    def finish(self):
+        self.flush()
+        self.close_files()
+
+
+class OutputPartition(object):
+    def __init__(self, path):
+        self.path = path
+        self.chunks = []
+        self.size = 0
+        self.created = False
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+
 class CSVRecordIterator(rbql_engine.RBQLInputIterator):
-    def __init__(self, stream, encoding, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', chunk_size=1024, line_mode=False):
+    def __init__(self, stream, encoding, delim, policy, has_header=False, comment_prefix=None, table_name='input', variable_prefix='a', chunk_size=1024, line_mode=False, follow=False, follow_idle_timeout=None):
+        # `follow` - wait for records appended to the input table at EOF like `tail -f` does. Reading stops after `follow_idle_timeout` seconds without new data (if not None) or on KeyboardInterrupt.
         assert encoding in ['utf-8', 'latin-1', None]
         self.encoding = encoding
         self.stream = encode_input_stream(stream, encoding)
@@ -352,10 +510,30 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         self.polymorphic_get_row = self.get_row_rfc if policy == 'quoted_rfc' else self.get_row_simple
         self.has_header = has_header
         self.first_record_should_be_emitted = False
+        self.required_substrings = None
+        self.required_num_fields = 0
+        self.join_key_index = None
+        self.join_key_filter = None
+        self.num_skipped_records = 0
+        self.record_index = None
+        self.min_record_number = None
+        self.max_record_number = None
+        self.zone_maps = None
+        self.field_constraints = None
+        self.key_indexes = None
+        self.lookup_entries = None # Sorted (record_position, offset, line_number) tuples of records with the requested keys.
+        self.lookup_fields_info = None
+        self.lookup_cursor = 0
+        self.follow = follow
+        self.follow_idle_timeout = follow_idle_timeout
+        self.idle_callback = None
+        self.idle_since = None
 
         if not line_mode:
             self.first_record = None
-            self.first_record = self.get_record()
+            self.first_raw_record = self.read_record_line()
+            if self.first_raw_record is not None:
+                self.first_record = self.split_record_line(self.first_raw_record)
             self.first_record_should_be_emitted = not has_header
 
 
@@ -381,6 +559,115 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
     def get_header(self):
         return self.first_record if self.has_header else None
 
+    def set_raw_line_prefilter(self, required_substrings):
+        self.required_substrings = required_substrings
+
+    def set_required_num_fields(self, num_fields):
+        self.required_num_fields = num_fields
+
+    def set_join_key_prefilter(self, key_index, key_filter):
+        if self.policy in ['simple', 'quoted', 'quoted_rfc']:
+            self.join_key_index = key_index
+            self.join_key_filter = key_filter
+
+    def may_have_join_match(self, line):
+        if self.policy != 'simple' and line.find('"') != -1:
+            return True # Quoted fields require full split.
+        fields = line.split(self.delim, self.join_key_index + 1)
+        if len(fields) <= self.join_key_index:
+            return True # Let the query report the missing key field.
+        return fields[self.join_key_index] in self.join_key_filter
+
+    def pop_num_skipped_records(self):
+        result = self.num_skipped_records
+        self.num_skipped_records = 0
+        return result
+
+    def set_record_index(self, record_index):
+        # `record_index` - CSVRecordIndex of the input file, blocks of records outside of NR range are skipped with a single seek instead of reading them.
+        self.record_index = record_index
+
+    def set_zone_maps(self, zone_maps):
+        # `zone_maps` - CSVZoneMaps of the input file, blocks of records which can't satisfy field constraints are skipped with a single seek.
+        if self.record_index is not None and zone_maps.step == self.record_index.step:
+            self.zone_maps = zone_maps
+
+    def set_record_number_range(self, min_record_number, max_record_number):
+        self.min_record_number = min_record_number
+        self.max_record_number = max_record_number
+
+    def set_idle_callback(self, callback):
+        self.idle_callback = callback
+
+    def set_key_indexes(self, key_indexes):
+        # `key_indexes` - {column_index: CSVKeyIndex} dict, equality and "in" constraints on these columns are resolved with index lookups instead of reading the whole table.
+        self.key_indexes = key_indexes
+
+    def set_field_constraints(self, field_constraints):
+        self.field_constraints = field_constraints
+        if self.key_indexes is None or any(conversion is not None for _, conversion, _, _ in field_constraints):
+            return # Records which are not read could make conversions fail.
+        for column_index, conversion, op, literal in field_constraints:
+            if op in ['==', 'in'] and column_index in self.key_indexes and min(self.key_indexes[column_index].fields_info.keys() or [0]) >= self.required_num_fields:
+                keys = set([literal] if op == '==' else literal)
+                self.lookup_entries = sorted(entry for key in keys for entry in self.key_indexes[column_index].lookup(key))
+                self.lookup_fields_info = self.key_indexes[column_index].fields_info
+                return
+
+    def _may_skip_block(self, block_index):
+        # Blocks are skipped without reading only if all of their records have the fields required by the query and don't have quoting errors, so the query would report the same errors and warnings.
+        fields_info = self.record_index.block_fields_info[block_index]
+        if fields_info is None or min(fields_info.keys()) < self.required_num_fields:
+            return False
+        step = self.record_index.step
+        header_offset = 1 if self.has_header else 0
+        if self.max_record_number is not None and block_index * step + 1 - header_offset > self.max_record_number:
+            return True
+        if self.min_record_number is not None and min((block_index + 1) * step, self.record_index.num_records) - header_offset < self.min_record_number:
+            return True
+        return self.zone_maps is not None and self.field_constraints is not None and not self.zone_maps.block_may_match(block_index, self.field_constraints)
+
+    def _skip_blocks(self):
+        step = self.record_index.step
+        while self.NR % step == 0 and self.NR // step < len(self.record_index.entries) and self._may_skip_block(self.NR // step):
+            for num_fields, record_number in self.record_index.block_fields_info[self.NR // step].items():
+                if num_fields not in self.fields_info:
+                    self.fields_info[num_fields] = record_number
+            block_index = self.NR // step + 1
+            if block_index >= len(self.record_index.entries):
+                self._seek_record(self.record_index.num_records, None, None)
+                return
+            offset, line_number = self.record_index.entries[block_index]
+            self._seek_record(block_index * step, offset, line_number)
+
+    def _seek_record(self, record_position, offset, line_number):
+        # Moves to the record at zero-based `record_position` (header included) which starts at byte `offset`, all records in between are reported as skipped.
+        # Position past the last record with None offset exhausts the stream.
+        header_offset = 1 if self.has_header else 0
+        if self.encoding is None:
+            binary_stream = self.stream
+        else:
+            binary_stream = self.stream.detach() if hasattr(self.stream, 'detach') else self.stream.stream
+        binary_stream.seek(offset if offset is not None else 0, os.SEEK_SET if offset is not None else os.SEEK_END)
+        self.stream = encode_input_stream(binary_stream, self.encoding)
+        self.buffer = ''
+        self.exhausted = False
+        self.num_skipped_records += record_position - max(self.NR, header_offset)
+        if not self.has_header and self.first_record_should_be_emitted:
+            self.first_record_should_be_emitted = False
+            self.num_skipped_records += 1
+        self.NR = record_position
+        if line_number is not None:
+            self.NL = line_number
+
+    def get_table_size(self):
+        try:
+            stat_result = os.fstat(self.stream.fileno())
+        except Exception:
+            return None
+        # Pipes and other special files don't have a meaningful size.
+        return stat_result.st_size if stat.S_ISREG(stat_result.st_mode) else None
+
     def _get_row_from_buffer(self):
         str_before, separator, str_after = csv_utils.extract_line_from_data(self.buffer)
         if separator is None:
@@ -403,14 +690,32 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         while True:
             chunk = self.stream.read(self.chunk_size)
             if not chunk:
+                if self.follow and self._wait_for_appended_data():
+                    continue
                 self.exhausted = True
                 break
+            self.idle_since = None
             chunks.append(chunk)
             if csv_utils.newline_rgx.search(chunk) is not None:
                 break
         self.buffer += ''.join(chunks)
 
 
+    def _wait_for_appended_data(self):
+        # Returns False if the input table wasn't appended during `follow_idle_timeout` or the waiting was interrupted.
+        if self.idle_since is None:
+            self.idle_since = time.time()
+            if self.idle_callback is not None and not self.idle_callback():
+                return False
+        elif self.follow_idle_timeout is not None and time.time() - self.idle_since >= self.follow_idle_timeout:
+            return False
+        try:
+            time.sleep(follow_poll_interval)
+        except KeyboardInterrupt:
+            return False # Finish the query with the records which were read so far.
+        return True
+
+
     def get_row_simple(self):
         try:
             row = self._get_row_from_buffer()
@@ -452,17 +757,67 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
                 return '\n'.join(rows_buffer)
 
 
-    def get_record(self):
-        if self.first_record_should_be_emitted:
-            self.first_record_should_be_emitted = False
-            return self.first_record
+    def _seek_next_lookup_entry(self):
+        # Returns False if there are no more records with the requested keys.
+        while self.lookup_cursor < len(self.lookup_entries):
+            record_position, offset, line_number = self.lookup_entries[self.lookup_cursor]
+            self.lookup_cursor += 1
+            if record_position > self.NR:
+                self._add_lookup_fields_info(record_position)
+                self._seek_record(record_position, offset, line_number)
+            if record_position >= self.NR:
+                return True
+        self._add_lookup_fields_info(None)
+        return False
+
+    def _add_lookup_fields_info(self, end_position):
+        # Records before `end_position` (all records if None) which are not read still contribute to the inconsistent number of fields warning.
+        for num_fields, record_number in self.lookup_fields_info.items():
+            if (end_position is None or record_number <= end_position) and record_number < self.fields_info.get(num_fields, record_number + 1):
+                self.fields_info[num_fields] = record_number
+
+    def read_record_line(self):
         while True:
+            if self.lookup_entries is not None:
+                if not self._seek_next_lookup_entry():
+                    return None
+            elif self.record_index is not None:
+                self._skip_blocks()
             line = self.polymorphic_get_row()
             if line is None:
                 return None
-            if self.comment_prefix is None or not line.startswith(self.comment_prefix):
-                break
-        self.NR += 1
+            if self.comment_prefix is not None and line.startswith(self.comment_prefix):
+                continue
+            record_number = self.NR + 1 - (1 if self.has_header else 0)
+            self.NR += 1
+            if self.min_record_number is not None and record_number < self.min_record_number:
+                should_skip = True
+            elif self.max_record_number is not None and record_number > self.max_record_number:
+                should_skip = True
+            elif self.required_substrings is not None and any(s not in line for s in self.required_substrings):
+                should_skip = True
+            else:
+                should_skip = self.join_key_filter is not None and not self.may_have_join_match(line)
+            if should_skip and self._try_skip_record_line(line):
+                self.num_skipped_records += 1
+                continue
+            return line
+
+
+    def _try_skip_record_line(self, line):
+        # Skipped records are not split into fields when possible, but they still contribute to the warnings.
+        # Returns False if the record doesn't have all of the fields required by the query, such records are never skipped so the query could report the same errors.
+        if self.policy == 'simple' or (self.policy in ['quoted', 'quoted_rfc'] and line.find('"') == -1):
+            num_fields = line.count(self.delim) + 1
+            if num_fields < self.required_num_fields:
+                return False
+            if num_fields not in self.fields_info:
+                self.fields_info[num_fields] = self.NR
+            return True
+        return len(self.split_record_line(line)) >= self.required_num_fields
+
+
+    def split_record_line(self, line):
         record, warning = csv_utils.smart_split(line, self.delim, self.policy, preserve_quotes_and_whitespaces=False)
         if warning:
             if self.first_defective_line is None:
@@ -475,6 +830,41 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         return record
 
 
+    def get_record(self):
+        if self.first_record_should_be_emitted:
+            self.first_record_should_be_emitted = False
+            return self.first_record
+        line = self.read_record_line()
+        if line is None:
+            return None
+        return self.split_record_line(line)
+
+
+    def supports_raw_records(self):
+        return True
+
+
+    def get_raw_record(self, num_key_fields):
+        if self.first_record_should_be_emitted:
+            self.first_record_should_be_emitted = False
+            return (self.first_raw_record, self.first_record, len(self.first_record))
+        line = self.read_record_line()
+        if line is None:
+            return None
+        if self.policy in ['simple', 'quoted', 'quoted_rfc'] and line.find('"') == -1:
+            # Lines without double quotes can't have escaped separators, so we can count fields and extract the leading key fields without splitting the whole line.
+            num_fields = line.count(self.delim) + 1
+            if num_fields not in self.fields_info:
+                self.fields_info[num_fields] = self.NR
+            return (line, line.split(self.delim, num_key_fields), num_fields)
+        record = self.split_record_line(line)
+        return (line, record, len(record))
+
+
+    def split_raw_record(self, raw_record):
+        return csv_utils.smart_split(raw_record, self.delim, self.policy, preserve_quotes_and_whitespaces=False)[0]
+
+
     def _get_all_rows(self):
         result = []
         while True:
@@ -508,77 +898,1602 @@ class CSVRecordIterator(rbql_engine.RBQLInputIterator):
         return result
 
 
+join_index_format_version = 2
+max_cached_join_keys = 100000
+
+
+class UnsupportedIndexError(Exception):
+    pass
+
+
+def get_join_index_path(cache_dir, table_path, encoding, delim, policy, has_header, comment_prefix, key_indices):
+    table_stat = os.stat(table_path)
+    cache_key = repr((join_index_format_version, os.path.abspath(table_path), table_stat.st_size, table_stat.st_mtime, encoding, delim, policy, has_header, comment_prefix, key_indices))
+    return os.path.join(cache_dir, 'rbql_join_index_{}.json'.format(hashlib.sha1(cache_key.encode('utf-8')).hexdigest()))
+
+
+def is_private_cache_dir(cache_dir):
+    # Creates the cache directory if it doesn't exist. Cache files are not trusted if other users can write to the directory.
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        dir_stat = os.stat(cache_dir)
+    except (IOError, OSError):
+        return False
+    if not hasattr(os, 'getuid'):
+        return True # Windows
+    return dir_stat.st_uid == os.getuid() and not dir_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def try_load_json_index(index_path):
+    # Returns None if the index doesn't exist or is not a valid JSON, the caller should also validate the structure of the returned object.
+    try:
+        with open(index_path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+    except Exception:
+        return None
+
+
+def save_json_index(index_path, index):
+    # The index is written to a temporary file first, so concurrent readers never see a partially written index.
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    try:
+        index_dir = os.path.dirname(index_path)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(index).encode('utf-8'))
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.rename(tmp_path, index_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def try_save_join_index(index_path, index):
+    # The cache is an optimization, so failure to save the index is not an error.
+    try:
+        save_json_index(index_path, index)
+    except (IOError, OSError):
+        pass
+
+
+def is_join_key(value):
+    return rbql_engine.is_str6(value) or (isinstance(value, int) and not isinstance(value, bool))
+
+
+def encode_join_index(offsets_map, max_record_len, warnings):
+    # Composite keys are tuples, JSON stores them as lists.
+    offsets = [[list(key) if isinstance(key, tuple) else key, key_offsets] for key, key_offsets in offsets_map.items()]
+    return {'offsets': offsets, 'max_record_len': max_record_len, 'warnings': warnings}
+
+
+def decode_join_index(index):
+    # Returns None if the index doesn't have the expected structure, e.g. if the file was modified by someone else.
+    try:
+        offsets_map = dict()
+        for key, key_offsets in index['offsets']:
+            if isinstance(key, list) and len(key) and all([is_join_key(v) for v in key]):
+                key = tuple(key)
+            elif not is_join_key(key):
+                return None
+            offsets_map[key] = [(int(nr), int(offset)) for nr, offset in key_offsets]
+        max_record_len = index['max_record_len']
+        warnings = index['warnings']
+        if not isinstance(max_record_len, int) or not isinstance(warnings, list) or not all([rbql_engine.is_str6(w) for w in warnings]):
+            return None
+        return (offsets_map, max_record_len, warnings)
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def read_binary_line(stream, encoding):
+    raw_line = stream.readline()
+    if not raw_line:
+        return None
+    try:
+        line = raw_line.decode(encoding)
+    except UnicodeDecodeError:
+        raise rbql_engine.RbqlIOHandlingError('Unable to decode input table as UTF-8. Use binary (latin-1) encoding instead')
+    if line.endswith('\n'):
+        line = line[:-1]
+    if line.endswith('\r'):
+        line = line[:-1]
+    if line.find('\r') != -1:
+        raise UnsupportedIndexError() # Standalone "\r" line separators
+    return line
+
+
+def read_binary_record(stream, encoding, policy, comment_prefix):
+    # Reads a record starting at the current position of a binary stream, multiline records are joined with "\n" like in CSVRecordIterator.
+    at_file_start = stream.tell() == 0
+    first_line = read_binary_line(stream, encoding)
+    if first_line is None:
+        return None
+    if at_file_start:
+        first_line = remove_utf8_bom(first_line, encoding)
+    if policy != 'quoted_rfc' or first_line.count('"') % 2 == 0:
+        return first_line
+    if comment_prefix is not None and first_line.startswith(comment_prefix):
+        return first_line
+    lines = [first_line]
+    while True:
+        line = read_binary_line(stream, encoding)
+        if line is None:
+            break
+        lines.append(line)
+        if line.count('"') % 2 == 1:
+            break
+    return '\n'.join(lines)
+
+
+record_index_format_version = 2
+default_record_index_step = 10000
+
+
+class CSVRecordIndex(object):
+    # Byte offsets and line numbers of every `step`-th record of a CSV file, it allows to start reading the file from an arbitrary record.
+    # Record positions are zero-based and include the header record (if any), but not comment lines.
+    def __init__(self, step, entries, num_records, block_fields_info):
+        self.step = step
+        self.entries = entries # List of (offset, line_number) tuples, where line_number is the number of lines before the record.
+        self.num_records = num_records
+        # For each block of `step` records: {num_fields: record_number} dict with the first record of each length or None if the block has records with quoting errors.
+        # Blocks are skipped without reading only if their records contribute nothing but field counts to the warnings.
+        self.block_fields_info = block_fields_info
+
+
+    def split_record_ranges(self, num_parts, has_header):
+        # Splits data records into `num_parts` contiguous (first_NR, last_NR) ranges which can be processed in parallel with "WHERE NR >= first_NR and NR <= last_NR" queries.
+        num_data_records = self.num_records - 1 if has_header and self.num_records else self.num_records
+        part_size = max(1, (num_data_records + num_parts - 1) // num_parts)
+        return [(first_nr, min(first_nr + part_size - 1, num_data_records)) for first_nr in range(1, num_data_records + 1, part_size)]
+
+
+def is_non_negative_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def encode_fields_info(fields_info):
+    return None if fields_info is None else sorted(fields_info.items())
+
+
+def decode_fields_info(fields_info):
+    # Raises ValueError if `fields_info` is malformed.
+    if fields_info is None:
+        return None
+    result = dict()
+    for num_fields, record_number in fields_info:
+        if not is_non_negative_int(num_fields) or not is_non_negative_int(record_number):
+            raise ValueError('Bad fields info')
+        result[num_fields] = record_number
+    if not len(result):
+        raise ValueError('Bad fields info')
+    return result
+
+
+def encode_record_index(validity_key, record_index):
+    return {'validity_key': list(validity_key), 'step': record_index.step, 'entries': record_index.entries, 'num_records': record_index.num_records, 'block_fields_info': [encode_fields_info(fi) for fi in record_index.block_fields_info]}
+
+
+def decode_record_index(index, validity_key):
+    # Returns None if the index is stale or doesn't have the expected structure, e.g. if the file was modified by someone else.
+    try:
+        if index['validity_key'] != list(validity_key):
+            return None
+        step, num_records, entries = index['step'], index['num_records'], index['entries']
+        if not is_non_negative_int(step) or step == 0 or not is_non_negative_int(num_records) or len(entries) != (num_records + step - 1) // step:
+            return None
+        entries = [(offset, line_number) for offset, line_number in entries]
+        if not all([is_non_negative_int(offset) and is_non_negative_int(line_number) for offset, line_number in entries]):
+            return None
+        block_fields_info = [decode_fields_info(fi) for fi in index['block_fields_info']]
+        if len(block_fields_info) != len(entries):
+            return None
+        return CSVRecordIndex(step, entries, num_records, block_fields_info)
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def range_may_satisfy(min_value, max_value, op, literal):
+    if op == 'in':
+        return any(min_value <= v <= max_value for v in literal)
+    if op == '==':
+        return min_value <= literal <= max_value
+    if op == '!=':
+        return not (min_value == literal == max_value)
+    if op == '<':
+        return min_value < literal
+    if op == '<=':
+        return min_value <= literal
+    if op == '>':
+        return max_value > literal
+    assert op == '>='
+    return max_value >= literal
+
+
+class CSVZoneMaps(object):
+    # Min/max statistics of each column for blocks of `step` records, blocks are aligned with the record index entries.
+    def __init__(self, step, block_stats):
+        self.step = step
+        # For each block: list of per-column (min_value, max_value, numeric_type, min_number, max_number) tuples or None if the block can't be skipped.
+        # numeric_type is "int" or "float" if all values of the column in the block can be converted with int() or float() respectively, otherwise None.
+        self.block_stats = block_stats
+
+
+    def block_may_match(self, block_index, field_constraints):
+        # `field_constraints` - list of (column_index, conversion, op, literal) tuples which all must be satisfied, see RBQLInputIterator.set_field_constraints().
+        column_stats = self.block_stats[block_index] if block_index < len(self.block_stats) else None
+        if column_stats is None:
+            return True
+        for column_index, conversion, op, literal in field_constraints:
+            if conversion is not None and (column_index >= len(column_stats) or not is_proven_conversion(column_stats[column_index][2], conversion)):
+                return True # Conversion could fail for some values of the block, the query should report it.
+        for column_index, conversion, op, literal in field_constraints:
+            if column_index >= len(column_stats):
+                continue # Some records of the block don't have this field.
+            min_value, max_value, numeric_type, min_number, max_number = column_stats[column_index]
+            if conversion is not None:
+                min_value, max_value = min_number, max_number
+            if not range_may_satisfy(min_value, max_value, op, literal):
+                return False
+        return True
+
+
+def is_proven_conversion(numeric_type, conversion):
+    # Values which can be converted with int() can also be converted with float().
+    return numeric_type == 'int' or (numeric_type == 'float' and conversion == 'float')
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def decode_column_stats(column_stats):
+    # Raises ValueError if `column_stats` is malformed.
+    min_value, max_value, numeric_type, min_number, max_number = column_stats
+    if not rbql_engine.is_str6(min_value) or not rbql_engine.is_str6(max_value) or numeric_type not in [None, 'int', 'float']:
+        raise ValueError('Bad column stats')
+    if numeric_type is not None and (not is_number(min_number) or not is_number(max_number)):
+        raise ValueError('Bad column stats')
+    return (min_value, max_value, numeric_type, min_number, max_number)
+
+
+def encode_zone_maps(validity_key, zone_maps):
+    return {'validity_key': list(validity_key), 'step': zone_maps.step, 'block_stats': zone_maps.block_stats}
+
+
+def decode_zone_maps(zone_maps, validity_key):
+    # Returns None if the zone maps are stale or don't have the expected structure.
+    try:
+        if zone_maps['validity_key'] != list(validity_key):
+            return None
+        step = zone_maps['step']
+        if not is_non_negative_int(step) or step == 0:
+            return None
+        block_stats = [None if stats is None else [decode_column_stats(cs) for cs in stats] for stats in zone_maps['block_stats']]
+        return CSVZoneMaps(step, block_stats)
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def get_numeric_value(value, numeric_type):
+    # Returns (numeric_type, number) tuple, numeric_type narrows down from "int" to "float" to None as values that can't be converted are found.
+    if numeric_type == 'int':
+        try:
+            return ('int', int(value))
+        except ValueError:
+            pass
+    try:
+        number = float(value)
+    except ValueError:
+        return (None, None)
+    if number != number:
+        return (None, None) # NaN breaks min/max comparisons.
+    return ('float', number)
+
+
+class BlockStatsCollector(object):
+    def __init__(self, collect_column_stats):
+        self.collect_column_stats = collect_column_stats
+        self.column_stats = []
+        self.min_num_fields = None
+        self.has_defective_records = False
+        self.fields_info = dict()
+
+
+    def add_record(self, fields, is_defective, record_number):
+        self.has_defective_records = self.has_defective_records or is_defective
+        if len(fields) not in self.fields_info:
+            self.fields_info[len(fields)] = record_number
+        self.min_num_fields = len(fields) if self.min_num_fields is None else min(self.min_num_fields, len(fields))
+        if not self.collect_column_stats:
+            return
+        for i, value in enumerate(fields):
+            if i >= len(self.column_stats):
+                numeric_type, number = get_numeric_value(value, 'int')
+                self.column_stats.append([value, value, numeric_type, number, number])
+                continue
+            stats = self.column_stats[i]
+            if value < stats[0]:
+                stats[0] = value
+            if value > stats[1]:
+                stats[1] = value
+            if stats[2] is not None:
+                numeric_type, number = get_numeric_value(value, stats[2])
+                stats[2] = numeric_type
+                if numeric_type is not None:
+                    stats[3] = min(stats[3], number)
+                    stats[4] = max(stats[4], number)
+
+
+    def get_block_stats(self):
+        if self.has_defective_records:
+            return None # Let the query report the quoting error.
+        return [tuple(stats) for stats in self.column_stats[:self.min_num_fields]]
+
+
+    def get_fields_info(self):
+        return None if self.has_defective_records else self.fields_info
+
+
+def get_record_index_path(table_path):
+    return table_path + '.rbql_index'
+
+
+def get_zone_maps_path(table_path):
+    return table_path + '.rbql_zone_maps'
+
+
+def get_record_index_validity_key(table_path, encoding, delim, policy, comment_prefix):
+    table_stat = os.stat(table_path)
+    return (record_index_format_version, table_stat.st_size, table_stat.st_mtime, encoding, delim, policy, comment_prefix)
+
+
+def build_csv_record_index(table_path, encoding, delim, policy, comment_prefix=None, step=default_record_index_step, with_zone_maps=False):
+    # Scans the table and saves the record index into the sidecar file next to the table, see get_record_index_path().
+    # With `with_zone_maps` min/max statistics for the same blocks are collected in the same pass and saved into another sidecar, see get_zone_maps_path().
+    if encoding is None:
+        raise rbql_engine.RbqlIOHandlingError('Record index requires "utf-8" or "latin-1" encoding')
+    comment_prefix = comment_prefix if comment_prefix else None
+    validity_key = get_record_index_validity_key(table_path, encoding, delim, policy, comment_prefix)
+    block_stats = []
+    block_fields_info = []
+    stats_collector = BlockStatsCollector(with_zone_maps)
+    entries = []
+    num_records = 0
+    line_number = 0
+    with open(table_path, 'rb') as stream:
+        while True:
+            offset = stream.tell()
+            try:
+                record = read_binary_record(stream, encoding, policy, comment_prefix)
+            except UnsupportedIndexError:
+                raise rbql_engine.RbqlIOHandlingError('Unable to index "{}": files with "\\r" line separators are not supported'.format(table_path))
+            if record is None:
+                break
+            num_lines = record.count('\n') + 1
+            if comment_prefix is None or not record.startswith(comment_prefix):
+                if num_records % step == 0:
+                    entries.append((offset, line_number))
+                    if num_records:
+                        block_stats.append(stats_collector.get_block_stats())
+                        block_fields_info.append(stats_collector.get_fields_info())
+                        stats_collector = BlockStatsCollector(with_zone_maps)
+                fields, warning = csv_utils.smart_split(record, delim, policy, preserve_quotes_and_whitespaces=False)
+                stats_collector.add_record(fields, warning, num_records + 1)
+                num_records += 1
+            line_number += num_lines
+    if num_records:
+        block_stats.append(stats_collector.get_block_stats())
+        block_fields_info.append(stats_collector.get_fields_info())
+    record_index = CSVRecordIndex(step, entries, num_records, block_fields_info)
+    save_json_index(get_record_index_path(table_path), encode_record_index(validity_key, record_index))
+    if with_zone_maps:
+        save_json_index(get_zone_maps_path(table_path), encode_zone_maps(validity_key, CSVZoneMaps(step, block_stats)))
+    return record_index
+
+
+def load_csv_record_index(table_path, encoding, delim, policy, comment_prefix=None):
+    # Returns None if the table doesn't have an up-to-date record index.
+    comment_prefix = comment_prefix if comment_prefix else None
+    index = try_load_json_index(get_record_index_path(table_path))
+    if index is None:
+        return None
+    return decode_record_index(index, get_record_index_validity_key(table_path, encoding, delim, policy, comment_prefix))
+
+
+def load_csv_zone_maps(table_path, encoding, delim, policy, comment_prefix=None):
+    # Returns None if the table doesn't have up-to-date zone maps for the given dialect.
+    comment_prefix = comment_prefix if comment_prefix else None
+    zone_maps = try_load_json_index(get_zone_maps_path(table_path))
+    if zone_maps is None:
+        return None
+    return decode_zone_maps(zone_maps, get_record_index_validity_key(table_path, encoding, delim, policy, comment_prefix))
+
+
+key_index_entry_format = struct.Struct('<qqqq') # key_start, record_position, offset, line_number
+
+
+def get_key_index_path(table_path, column_index):
+    return '{}.rbql_key_index_{}'.format(table_path, column_index + 1)
+
+
+def get_key_index_validity_key(table_path, encoding, delim, policy, comment_prefix, column_index):
+    return list(get_record_index_validity_key(table_path, encoding, delim, policy, comment_prefix)) + [column_index]
+
+
+class CSVKeyIndex(object):
+    # Key index file layout: 8-byte length of the JSON metadata, the metadata, fixed size entries sorted by utf-8 encoded key and a blob with the keys.
+    # Lookups use binary search over the file, so the index doesn't have to fit into memory.
+    def __init__(self, index_path, num_entries, keys_size, fields_info, entries_offset):
+        self.index_path = index_path
+        self.num_entries = num_entries
+        self.keys_size = keys_size
+        self.fields_info = fields_info # {num_fields: record_number} dict with the first record of each length in the table, so records which are not read still contribute to the warnings.
+        self.entries_offset = entries_offset
+        self.keys_offset = entries_offset + self.num_entries * key_index_entry_format.size
+
+
+    def _read_entry(self, stream, entry_index):
+        # Returns (key, record_position, offset, line_number) tuple.
+        stream.seek(self.entries_offset + entry_index * key_index_entry_format.size)
+        key_start, record_position, offset, line_number = key_index_entry_format.unpack(stream.read(key_index_entry_format.size))
+        key_end = self.keys_size if entry_index + 1 == self.num_entries else key_index_entry_format.unpack(stream.read(key_index_entry_format.size))[0]
+        stream.seek(self.keys_offset + key_start)
+        return (stream.read(key_end - key_start), record_position, offset, line_number)
+
+
+    def lookup(self, key):
+        # Returns sorted list of (record_position, offset, line_number) tuples of records with the `key` field value.
+        key = key.encode('utf-8')
+        result = []
+        with open(self.index_path, 'rb') as stream:
+            lo, hi = 0, self.num_entries
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._read_entry(stream, mid)[0] < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            while lo < self.num_entries:
+                entry_key, record_position, offset, line_number = self._read_entry(stream, lo)
+                if entry_key != key:
+                    break
+                result.append((record_position, offset, line_number))
+                lo += 1
+        return result
+
+
+def build_csv_key_index(table_path, encoding, delim, policy, column_index, comment_prefix=None):
+    # Saves sorted (key, record position, offset, line_number) entries of the `column_index` field of each record into the sidecar file next to the table, see get_key_index_path().
+    # Entries are sorted in memory, so the keys of the column have to fit into memory while the index is being built.
+    if encoding is None:
+        raise rbql_engine.RbqlIOHandlingError('Key index requires "utf-8" or "latin-1" encoding')
+    comment_prefix = comment_prefix if comment_prefix else None
+    validity_key = get_key_index_validity_key(table_path, encoding, delim, policy, comment_prefix, column_index)
+    entries = []
+    fields_info = dict()
+    record_position = 0
+    line_number = 0
+    with open(table_path, 'rb') as stream:
+        while True:
+            offset = stream.tell()
+            try:
+                record = read_binary_record(stream, encoding, policy, comment_prefix)
+            except UnsupportedIndexError:
+                raise rbql_engine.RbqlIOHandlingError('Unable to index "{}": files with "\\r" line separators are not supported'.format(table_path))
+            if record is None:
+                break
+            num_lines = record.count('\n') + 1
+            if comment_prefix is None or not record.startswith(comment_prefix):
+                fields, warning = csv_utils.smart_split(record, delim, policy, preserve_quotes_and_whitespaces=False)
+                if warning:
+                    raise rbql_engine.RbqlIOHandlingError('Unable to index "{}": inconsistent double quote escaping at line {}'.format(table_path, line_number + 1))
+                if column_index >= len(fields):
+                    raise rbql_engine.RbqlIOHandlingError('Unable to index "{}": record at line {} does not have field {}'.format(table_path, line_number + 1, column_index + 1))
+                entries.append((fields[column_index].encode('utf-8'), record_position, offset, line_number))
+                record_position += 1
+                if len(fields) not in fields_info:
+                    fields_info[len(fields)] = record_position
+            line_number += num_lines
+    entries.sort()
+    index_path = get_key_index_path(table_path, column_index)
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            metadata = json.dumps({'validity_key': validity_key, 'num_entries': len(entries), 'keys_size': sum(len(e[0]) for e in entries), 'fields_info': encode_fields_info(fields_info)}).encode('utf-8')
+            f.write(struct.pack('<q', len(metadata)))
+            f.write(metadata)
+            key_start = 0
+            for key, record_position, offset, line_number in entries:
+                f.write(key_index_entry_format.pack(key_start, record_position, offset, line_number))
+                key_start += len(key)
+            for entry in entries:
+                f.write(entry[0])
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.rename(tmp_path, index_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return len(entries)
+
+
+def load_csv_key_indexes(table_path, encoding, delim, policy, comment_prefix=None):
+    # Returns {column_index: CSVKeyIndex} dict with up-to-date key indexes of the table.
+    comment_prefix = comment_prefix if comment_prefix else None
+    table_dir, table_name = os.path.split(table_path)
+    name_prefix = table_name + '.rbql_key_index_'
+    result = dict()
+    try:
+        file_names = [f for f in os.listdir(table_dir or '.') if f.startswith(name_prefix)]
+    except OSError:
+        return result
+    for file_name in file_names:
+        column_number = file_name[len(name_prefix):]
+        if not column_number.isdigit() or int(column_number) < 1:
+            continue
+        column_index = int(column_number) - 1
+        index_path = get_key_index_path(table_path, column_index)
+        key_index = try_load_key_index(index_path, get_key_index_validity_key(table_path, encoding, delim, policy, comment_prefix, column_index))
+        if key_index is not None:
+            result[column_index] = key_index
+    return result
+
+
+def try_load_key_index(index_path, validity_key):
+    # Returns None if the index is stale or doesn't have the expected structure.
+    try:
+        with open(index_path, 'rb') as f:
+            metadata_size = struct.unpack('<q', f.read(8))[0]
+            if metadata_size < 0:
+                return None
+            metadata = json.loads(f.read(metadata_size).decode('utf-8'))
+        if metadata['validity_key'] != validity_key:
+            return None
+        num_entries, keys_size = metadata['num_entries'], metadata['keys_size']
+        if not is_non_negative_int(num_entries) or not is_non_negative_int(keys_size):
+            return None
+        if os.path.getsize(index_path) != 8 + metadata_size + num_entries * key_index_entry_format.size + keys_size:
+            return None
+        fields_info = decode_fields_info(metadata['fields_info']) if num_entries else dict()
+        if fields_info is None:
+            return None
+        return CSVKeyIndex(index_path, num_entries, keys_size, fields_info, 8 + metadata_size)
+    except Exception:
+        return None
+
+
+def set_table_indexes(record_iterator, table_path, encoding, delim, policy, comment_prefix):
+    # Attaches up-to-date sidecar indexes of the table (if any) to the CSVRecordIterator.
+    record_index = load_csv_record_index(table_path, encoding, delim, policy, comment_prefix)
+    if record_index is not None:
+        record_iterator.set_record_index(record_index)
+        zone_maps = load_csv_zone_maps(table_path, encoding, delim, policy, comment_prefix)
+        if zone_maps is not None:
+            record_iterator.set_zone_maps(zone_maps)
+    key_indexes = load_csv_key_indexes(table_path, encoding, delim, policy, comment_prefix)
+    if len(key_indexes):
+        record_iterator.set_key_indexes(key_indexes)
+
+
+columnar_cache_format_version = 2
+columnar_cache_chunk_size = 65536
+int_column_value_rgx = re.compile('^(?:0|-?[1-9][0-9]{0,17})$') # Values that survive str(int(value)) roundtrip and fit into int64
+
+
+def get_int64_typecode():
+    for typecode in ['q', 'l']:
+        try:
+            if array.array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+
+int64_typecode = get_int64_typecode()
+
+
+class ColumnWriter(object):
+    # Column is stored as a blob of utf-8 encoded values and an array of their end offsets in the blob.
+    # Columns which contain only canonical integers are converted to a single int64 array when the table is fully read.
+    def __init__(self, column_path, num_leading_empty_values):
+        self.column_path = column_path
+        self.data_stream = open(column_path + '.data', 'wb')
+        self.offsets_stream = open(column_path + '.offsets', 'wb')
+        self.data_chunks = []
+        self.end_offsets = array.array(int64_typecode)
+        self.data_offset = 0
+        self.is_ascii = True
+        self.is_int = True
+        for _ in range(num_leading_empty_values):
+            self.add_value('')
+
+
+    def add_value(self, value):
+        encoded_value = value.encode('utf-8')
+        if self.is_ascii and len(encoded_value) != len(value):
+            self.is_ascii = False
+        if self.is_int and int_column_value_rgx.match(value) is None:
+            self.is_int = False
+        self.data_chunks.append(encoded_value)
+        self.data_offset += len(encoded_value)
+        self.end_offsets.append(self.data_offset)
+        if len(self.end_offsets) >= columnar_cache_chunk_size:
+            self.flush()
+
+
+    def flush(self):
+        self.data_stream.write(b''.join(self.data_chunks))
+        self.end_offsets.tofile(self.offsets_stream)
+        self.data_chunks = []
+        self.end_offsets = array.array(int64_typecode)
+
+
+    def finish(self, num_values):
+        # Returns column type: "int", "ascii" or "str".
+        self.flush()
+        self.data_stream.close()
+        self.offsets_stream.close()
+        if not self.is_int or not num_values:
+            return 'ascii' if self.is_ascii else 'str'
+        reader = ColumnReader(self.column_path, 'ascii')
+        with open(self.column_path + '.int64', 'wb') as int_stream:
+            for chunk_start in range(0, num_values, columnar_cache_chunk_size):
+                values = reader.read_values(min(columnar_cache_chunk_size, num_values - chunk_start))
+                array.array(int64_typecode, [int(v) for v in values]).tofile(int_stream)
+        reader.close()
+        os.remove(self.column_path + '.data')
+        os.remove(self.column_path + '.offsets')
+        os.rename(self.column_path + '.int64', self.column_path + '.data')
+        return 'int'
+
+
+class ColumnReader(object):
+    def __init__(self, column_path, column_type):
+        self.column_type = column_type
+        self.data_stream = open(column_path + '.data', 'rb')
+        self.offsets_stream = open(column_path + '.offsets', 'rb') if column_type != 'int' else None
+        self.data_offset = 0
+
+
+    def seek(self, position):
+        if self.column_type == 'int':
+            self.data_stream.seek(position * 8)
+            return
+        self.data_offset = 0
+        if position > 0:
+            self.offsets_stream.seek((position - 1) * 8)
+            previous_end_offset = array.array(int64_typecode)
+            previous_end_offset.fromfile(self.offsets_stream, 1)
+            self.data_offset = previous_end_offset[0]
+        self.offsets_stream.seek(position * 8)
+        self.data_stream.seek(self.data_offset)
+
+
+    def read_values(self, num_values):
+        if self.column_type == 'int':
+            values = array.array(int64_typecode)
+            values.fromfile(self.data_stream, num_values)
+            return [str(v) for v in values]
+        end_offsets = array.array(int64_typecode)
+        end_offsets.fromfile(self.offsets_stream, num_values)
+        data = self.data_stream.read(end_offsets[-1] - self.data_offset)
+        base_offset = self.data_offset
+        self.data_offset = end_offsets[-1]
+        if self.column_type == 'ascii':
+            data = data.decode('ascii')
+            result = []
+            start = 0
+            for end_offset in end_offsets:
+                end = end_offset - base_offset
+                result.append(data[start:end])
+                start = end
+            return result
+        result = []
+        start = 0
+        for end_offset in end_offsets:
+            end = end_offset - base_offset
+            result.append(data[start:end].decode('utf-8'))
+            start = end
+        return result
+
+
+    def close(self):
+        self.data_stream.close()
+        if self.offsets_stream is not None:
+            self.offsets_stream.close()
+
+
+def get_columnar_cache_path(cache_dir, table_path):
+    # The cache has a single entry per table, a stale entry is replaced when the table or the CSV dialect changes.
+    return os.path.join(cache_dir, 'rbql_columnar_cache_{}'.format(hashlib.sha1(os.path.abspath(table_path).encode('utf-8')).hexdigest()))
+
+
+def get_columnar_cache_validity_key(table_path, encoding, delim, policy, comment_prefix):
+    table_stat = os.stat(table_path)
+    return [columnar_cache_format_version, os.path.abspath(table_path), table_stat.st_size, table_stat.st_mtime, encoding, delim, policy, comment_prefix, int64_typecode, sys.byteorder]
+
+
+def is_optional_non_negative_int(value):
+    return value is None or is_non_negative_int(value)
+
+
+def decode_columnar_cache_metadata(cache_path, metadata, validity_key):
+    # Returns None if the cache entry is stale or doesn't have the expected structure.
+    try:
+        if metadata['validity_key'] != validity_key:
+            return None
+        if not is_non_negative_int(metadata['num_records']) or not is_non_negative_int(metadata['table_size']):
+            return None
+        if not all([column_type in ['int', 'ascii', 'str'] for column_type in metadata['column_types']]):
+            return None
+        first_record = metadata['first_record']
+        if first_record is not None and not all([rbql_engine.is_str6(value) for value in first_record]):
+            return None
+        if (first_record is None) != (metadata['num_records'] == 0) or not isinstance(metadata['utf8_bom_removed'], bool):
+            return None
+        if not is_optional_non_negative_int(metadata['first_defective_line']) or not is_optional_non_negative_int(metadata['first_defective_record']):
+            return None
+        for i, column_type in enumerate(metadata['column_types']):
+            if not os.path.exists(os.path.join(cache_path, 'column_{}.data'.format(i))) or (column_type != 'int' and not os.path.exists(os.path.join(cache_path, 'column_{}.offsets'.format(i)))):
+                return None
+        if not os.path.exists(os.path.join(cache_path, 'num_fields')):
+            return None
+        return metadata
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def remove_stale_columnar_caches(cache_dir):
+    # Removes cache entries of tables which were deleted or modified, so the cache directory doesn't grow indefinitely.
+    for entry_name in os.listdir(cache_dir):
+        entry_path = os.path.join(cache_dir, entry_name)
+        if not entry_name.startswith('rbql_columnar_cache_') or entry_name.find('.') != -1 or not os.path.isdir(entry_path):
+            continue # Temporary directories of concurrent builds are skipped.
+        metadata = try_load_json_index(os.path.join(entry_path, 'metadata.json'))
+        try:
+            table_path = metadata['validity_key'][1]
+            table_stat = os.stat(table_path)
+            is_stale = metadata['validity_key'][2:4] != [table_stat.st_size, table_stat.st_mtime]
+        except Exception:
+            is_stale = True
+        if is_stale:
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+
+def build_columnar_cache(cache_path, table_path, encoding, delim, policy, comment_prefix):
+    # Splits all records of the table once and stores them column by column, returns the cache metadata.
+    # The first record is stored only in the metadata, so a header doesn't prevent integer columns from being stored as int64 arrays.
+    # The cache is built in a temporary directory first, so concurrent readers never see a partially written cache.
+    validity_key = get_columnar_cache_validity_key(table_path, encoding, delim, policy, comment_prefix)
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    column_writers = []
+    num_fields_stream = None
+    try:
+        num_fields_stream = open(os.path.join(tmp_path, 'num_fields'), 'wb')
+        num_fields = array.array(int64_typecode)
+        num_records = 0
+        first_defective_record = None
+        with open(table_path, 'rb') as stream:
+            record_iterator = CSVRecordIterator(stream, encoding, delim, policy, has_header=False, comment_prefix=comment_prefix)
+            while True:
+                record = record_iterator.get_record()
+                if record is None:
+                    break
+                if first_defective_record is None and record_iterator.first_defective_line is not None:
+                    first_defective_record = num_records
+                for i in range(len(column_writers), len(record)):
+                    column_writers.append(ColumnWriter(os.path.join(tmp_path, 'column_{}'.format(i)), max(num_records - 1, 0)))
+                num_records += 1
+                if num_records == 1:
+                    continue
+                for i, column_writer in enumerate(column_writers):
+                    column_writer.add_value(record[i] if i < len(record) else '')
+                num_fields.append(len(record))
+                if len(num_fields) >= columnar_cache_chunk_size:
+                    num_fields.tofile(num_fields_stream)
+                    num_fields = array.array(int64_typecode)
+        num_fields.tofile(num_fields_stream)
+        num_fields_stream.close()
+        first_record = record_iterator.first_record
+        column_types = [column_writer.finish(num_records - 1) for column_writer in column_writers]
+        metadata = {'validity_key': validity_key, 'num_records': num_records, 'column_types': column_types, 'first_record': first_record, 'table_size': validity_key[2], 'utf8_bom_removed': record_iterator.utf8_bom_removed, 'first_defective_line': record_iterator.first_defective_line, 'first_defective_record': first_defective_record}
+        save_json_index(os.path.join(tmp_path, 'metadata.json'), metadata)
+        if os.path.isdir(cache_path):
+            # Replace the stale entry. Readers which have already opened its files can still read them on POSIX systems.
+            stale_path = '{}.{}.stale'.format(cache_path, os.getpid())
+            os.rename(cache_path, stale_path)
+            shutil.rmtree(stale_path, ignore_errors=True)
+        os.rename(tmp_path, cache_path)
+        return metadata
+    except Exception:
+        for column_writer in column_writers:
+            column_writer.data_stream.close()
+            column_writer.offsets_stream.close()
+        if num_fields_stream is not None:
+            num_fields_stream.close()
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+class ColumnarCacheIterator(rbql_engine.RBQLInputIterator):
+    # Reads records from the columnar cache of a CSV table. Only columns which are referenced in the query are read, other fields of the records are left empty.
+    def __init__(self, cache_path, metadata, has_header=False, table_name='input', variable_prefix='a'):
+        self.cache_path = cache_path
+        self.num_records = metadata['num_records']
+        self.column_types = metadata['column_types']
+        self.first_record = metadata['first_record']
+        self.table_size = metadata['table_size']
+        self.utf8_bom_removed = metadata['utf8_bom_removed']
+        self.first_defective_line = metadata['first_defective_line']
+        self.first_defective_record = metadata['first_defective_record']
+        self.has_header = has_header
+        self.table_name = table_name
+        self.variable_prefix = variable_prefix
+        self.column_indices = None # Indices of columns to read, None means all columns.
+        self.column_readers = None
+        self.num_fields_stream = None
+        self.position = 0 # Position of the next record, header included.
+        self.end_position = self.num_records
+        self.readers_position = None
+        self.required_num_fields = 0
+        self.min_record_number = None
+        self.max_record_number = None
+        self.field_constraints = None
+        self.chunk_start = None
+        self.chunk_records = []
+        self.chunk_num_fields = []
+        self.chunk_fields_info = dict() # {num_fields: chunk_index} dict with the first record of each length in the chunk.
+        self.chunk_selected = [] # Indices of chunk records which can satisfy field constraints.
+        self.chunk_cursor = 0
+        self.num_skipped_records = 0
+        self.fields_info = dict()
+        if self.first_record is not None:
+            self.fields_info[len(self.first_record)] = 1
+
+
+    def handle_query_modifier(self, modifier):
+        if modifier in ['header', 'headers']:
+            self.has_header = True
+        if modifier in ['noheader', 'noheaders']:
+            self.has_header = False
+
+
+    def get_variables_map(self, query_text):
+        variable_map = dict()
+        rbql_engine.parse_basic_variables(query_text, self.variable_prefix, variable_map)
+        rbql_engine.parse_array_variables(query_text, self.variable_prefix, variable_map)
+        if self.has_header and self.first_record is not None:
+            rbql_engine.parse_attribute_variables(query_text, self.variable_prefix, self.first_record, 'CSV header line', variable_map)
+            rbql_engine.parse_dictionary_variables(query_text, self.variable_prefix, self.first_record, variable_map)
+        # Star expressions, NF and UPDATE queries need whole records.
+        if re.search(r'\*|\bNF\b|\brecord_{}\b'.format(self.variable_prefix), query_text) is None and re.search(r'\bupdate\b', query_text, flags=re.IGNORECASE) is None:
+            self.column_indices = sorted(set(v.index for v in variable_map.values() if v.index < len(self.column_types)))
+        return variable_map
+
+
+    def get_header(self):
+        return self.first_record if self.has_header else None
+
+
+    def get_table_size(self):
+        return self.table_size
+
+
+    def pop_num_skipped_records(self):
+        result = self.num_skipped_records
+        self.num_skipped_records = 0
+        return result
+
+
+    def _skip_header(self):
+        if self.has_header and self.position == 0:
+            self.position = 1
+
+
+    def set_required_num_fields(self, num_fields):
+        self.required_num_fields = num_fields
+
+
+    def set_record_number_range(self, min_record_number, max_record_number):
+        self.min_record_number = min_record_number
+        self.max_record_number = max_record_number
+
+
+    def _is_outside_of_record_number_range(self, first_position, last_position):
+        header_offset = 1 if self.has_header else 0
+        if self.min_record_number is not None and last_position + 1 - header_offset < self.min_record_number:
+            return True
+        return self.max_record_number is not None and first_position + 1 - header_offset > self.max_record_number
+
+
+    def set_field_constraints(self, field_constraints):
+        self.field_constraints = field_constraints
+
+
+    def _select_chunk_records(self, columns):
+        # Constraints are necessary conditions of the WHERE expression, so records which don't satisfy them can be skipped without running the main loop.
+        # Records which would make the query fail (because of a missing field or a failed conversion) are always selected, so the query can report the error.
+        compare_functions = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, 'in': lambda value, literals: value in literals}
+        def may_satisfy_converted(value, convert, compare, literal):
+            # Returns None if the conversion fails.
+            try:
+                return compare(convert(value), literal)
+            except ValueError:
+                return None
+        num_values = len(self.chunk_records)
+        selected = None
+        failed_conversions = []
+        if self.min_record_number is not None or self.max_record_number is not None:
+            selected = [not self._is_outside_of_record_number_range(self.chunk_start + i, self.chunk_start + i) for i in range(num_values)]
+        for column_index, conversion, op, literal in self.field_constraints or []:
+            if column_index >= len(columns) or not isinstance(columns[column_index], list):
+                continue
+            compare = compare_functions[op]
+            values = columns[column_index]
+            if conversion is None:
+                matches = [compare(v, literal) for v in values]
+            else:
+                convert = int if conversion == 'int' else float
+                matches = [may_satisfy_converted(v, convert, compare, literal) for v in values]
+                failed_conversions += [i for i, m in enumerate(matches) if m is None]
+            selected = matches if selected is None else [a and b for a, b in zip(selected, matches)]
+        if selected is None:
+            return list(range(num_values))
+        for i in failed_conversions:
+            selected[i] = True
+        if min(self.chunk_fields_info.keys()) < self.required_num_fields:
+            selected = [is_selected or num_fields < self.required_num_fields for is_selected, num_fields in zip(selected, self.chunk_num_fields)]
+        return [i for i, is_selected in enumerate(selected) if is_selected]
+
+
+    def _read_chunk(self):
+        if self.column_readers is None:
+            column_indices = self.column_indices if self.column_indices is not None else range(len(self.column_types))
+            self.column_readers = [ColumnReader(os.path.join(self.cache_path, 'column_{}'.format(i)), self.column_types[i]) for i in column_indices]
+            self.num_fields_stream = open(os.path.join(self.cache_path, 'num_fields'), 'rb')
+        if self.readers_position != self.position:
+            for column_reader in self.column_readers:
+                column_reader.seek(self.position - 1)
+            self.num_fields_stream.seek((self.position - 1) * 8)
+        num_values = min(columnar_cache_chunk_size, self.end_position - self.position)
+        self.chunk_start = self.position
+        self.chunk_num_fields = array.array(int64_typecode)
+        self.chunk_num_fields.fromfile(self.num_fields_stream, num_values)
+        if self.chunk_num_fields.count(len(self.column_types)) == num_values:
+            self.chunk_fields_info = {len(self.column_types): 0}
+        else:
+            self.chunk_fields_info = dict()
+            for i, num_fields in enumerate(self.chunk_num_fields):
+                if num_fields not in self.chunk_fields_info:
+                    self.chunk_fields_info[num_fields] = i
+        self.chunk_cursor = 0
+        if self._is_outside_of_record_number_range(self.position, self.position + num_values - 1) and min(self.chunk_fields_info.keys()) >= self.required_num_fields:
+            # Only the number of fields of the records is needed for the warnings, so the columns are not read.
+            self.chunk_records = [None] * num_values
+            self.chunk_selected = []
+            self.readers_position = None
+            return
+        columns = [itertools.repeat('', num_values) for _ in self.column_types]
+        column_indices = self.column_indices if self.column_indices is not None else range(len(self.column_types))
+        for column_index, column_reader in zip(column_indices, self.column_readers):
+            columns[column_index] = column_reader.read_values(num_values)
+        self.chunk_records = [list(values) for values in zip(*columns)]
+        if self.chunk_num_fields.count(len(self.column_types)) != num_values:
+            for record, num_fields in zip(self.chunk_records, self.chunk_num_fields):
+                del record[num_fields:]
+        self.chunk_selected = self._select_chunk_records(columns)
+        self.readers_position = self.position + num_values
+
+
+    def _skip_chunk_records(self, end_position):
+        # Skipped records still contribute to the inconsistent number of fields warning. Records of the chunk before self.position are already consumed, so their lengths are already in fields_info.
+        for num_fields, chunk_index in self.chunk_fields_info.items():
+            if num_fields not in self.fields_info and self.position <= self.chunk_start + chunk_index < end_position:
+                self.fields_info[num_fields] = self.chunk_start + chunk_index + 1
+        self.num_skipped_records += end_position - self.position
+        self.position = end_position
+
+
+    def get_record(self):
+        while self.chunk_cursor >= len(self.chunk_selected):
+            if self.chunk_start is not None:
+                self._skip_chunk_records(self.chunk_start + len(self.chunk_records))
+                self.chunk_start = None
+            self._skip_header()
+            if self.position >= self.end_position:
+                self.finish()
+                return None
+            if self.position == 0:
+                self.position = 1
+                return list(self.first_record)
+            self._read_chunk()
+        chunk_index = self.chunk_selected[self.chunk_cursor]
+        self.chunk_cursor += 1
+        self._skip_chunk_records(self.chunk_start + chunk_index)
+        self.position = self.chunk_start + chunk_index + 1
+        num_fields = self.chunk_num_fields[chunk_index]
+        if num_fields not in self.fields_info:
+            self.fields_info[num_fields] = self.position
+        return self.chunk_records[chunk_index]
+
+
+    def finish(self):
+        if self.column_readers is not None:
+            for column_reader in self.column_readers:
+                column_reader.close()
+            self.num_fields_stream.close()
+            self.column_readers = None
+            self.readers_position = None
+
+
+    def get_warnings(self):
+        result = list()
+        if self.utf8_bom_removed:
+            result.append('UTF-8 Byte Order Mark (BOM) was found and skipped in {} table'.format(self.table_name))
+        if self.first_defective_record is not None and (self.first_defective_record == 0 or self.position > self.first_defective_record):
+            result.append('Inconsistent double quote escaping in {} table. E.g. at line {}'.format(self.table_name, self.first_defective_line))
+        if len(self.fields_info) > 1:
+            result.append(make_inconsistent_num_fields_warning(self.table_name, self.fields_info))
+        return result
+
+
+def open_columnar_cache_iterator(cache_dir, table_path, encoding, delim, policy, has_header, comment_prefix=None, table_name='input'):
+    # Returns ColumnarCacheIterator for the table or None if the table can't be cached, the cache is built by the first call.
+    # `cache_dir` must be private to the current user, see is_private_cache_dir().
+    if int64_typecode is None or encoding is None:
+        return None
+    comment_prefix = comment_prefix if comment_prefix else None
+    cache_path = get_columnar_cache_path(cache_dir, table_path)
+    try:
+        remove_stale_columnar_caches(cache_dir)
+        validity_key = get_columnar_cache_validity_key(table_path, encoding, delim, policy, comment_prefix)
+        metadata = try_load_json_index(os.path.join(cache_path, 'metadata.json'))
+        metadata = decode_columnar_cache_metadata(cache_path, metadata, validity_key) if metadata is not None else None
+        if metadata is None:
+            metadata = build_columnar_cache(cache_path, table_path, encoding, delim, policy, comment_prefix)
+    except (rbql_engine.RbqlIOHandlingError, IOError, OSError):
+        return None # Let the regular CSV iterator report the error.
+    return ColumnarCacheIterator(cache_path, metadata, has_header, table_name)
+
+
+class IndexedCSVJoinMap(rbql_engine.JoinMapBase):
+    # Keeps only record offsets for each key of the join table, records are read and split only when they match a key from the input table.
+    # The index is stored on disk and reused by subsequent queries as long as the join table and the join parameters don't change.
+    def __init__(self, table_path, index_path, encoding, delim, policy, has_header, comment_prefix, table_name, key_indices, projection=None):
+        super(IndexedCSVJoinMap, self).__init__(None, key_indices, projection)
+        self.table_path = table_path
+        self.index_path = index_path
+        self.encoding = encoding
+        self.delim = delim
+        self.policy = policy
+        self.has_header = has_header
+        self.comment_prefix = comment_prefix
+        self.table_name = table_name
+        self.offsets_map = None
+        self.warnings = []
+        self.records_cache = dict()
+        self.stream = None
+
+
+    def build_index(self):
+        offsets_map = dict()
+        max_record_len = 0
+        fields_info = dict()
+        first_defective_record = None
+        record_num = 0 # Unlike `nr` this also counts the header, like record numbers in CSVRecordIterator warnings.
+        nr = 0
+        with open(self.table_path, 'rb') as stream:
+            while True:
+                offset = stream.tell()
+                record = read_binary_record(stream, self.encoding, self.policy, self.comment_prefix)
+                if record is None:
+                    break
+                if self.comment_prefix is not None and record.startswith(self.comment_prefix):
+                    continue
+                record_num += 1
+                fields, warning = csv_utils.smart_split(record, self.delim, self.policy, preserve_quotes_and_whitespaces=False)
+                if warning and first_defective_record is None:
+                    first_defective_record = record_num
+                    if self.policy == 'quoted_rfc':
+                        raise rbql_engine.RbqlIOHandlingError('Inconsistent double quote escaping in {} table at record {}'.format(self.table_name, record_num))
+                nf = len(fields)
+                if nf not in fields_info:
+                    fields_info[nf] = record_num
+                if self.has_header and record_num == 1:
+                    continue
+                nr += 1
+                max_record_len = max(max_record_len, nf)
+                offsets_map.setdefault(self.polymorphic_get_key(nr, fields), []).append((nr, offset))
+        warnings = []
+        if first_defective_record is not None:
+            warnings.append('Inconsistent double quote escaping in {} table. E.g. at record {}'.format(self.table_name, first_defective_record))
+        if len(fields_info) > 1:
+            warnings.append(make_inconsistent_num_fields_warning(self.table_name, fields_info))
+        return (offsets_map, max_record_len, warnings)
+
+
+    def build(self):
+        index = try_load_json_index(self.index_path)
+        index = decode_join_index(index) if index is not None else None
+        if index is None:
+            index = self.build_index()
+            try_save_join_index(self.index_path, encode_join_index(*index))
+        self.offsets_map, self.max_record_len, self.warnings = index
+        self.stream = open(self.table_path, 'rb')
+
+
+    def get_join_records(self, key):
+        result = self.records_cache.get(key)
+        if result is not None:
+            return result
+        result = []
+        for nr, offset in self.offsets_map.get(key, []):
+            self.stream.seek(offset)
+            fields = csv_utils.smart_split(read_binary_record(self.stream, self.encoding, self.policy, self.comment_prefix), self.delim, self.policy, preserve_quotes_and_whitespaces=False)[0]
+            result.append(self.make_entry(nr, fields))
+        if len(self.records_cache) >= max_cached_join_keys:
+            self.records_cache = dict()
+        self.records_cache[key] = result
+        return result
+
+
+    def get_key_filter(self):
+        return self.offsets_map
+
+
+    def get_warnings(self):
+        return self.warnings
+
+
+    def finish(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+class JSONLinesWriter(object):
+    def __init__(self, path):
+        self.stream = open(path, 'wb')
+
+    def write(self, entry):
+        self.stream.write((json.dumps(entry) + '\n').encode('ascii'))
+
+    def close(self):
+        self.stream.close()
+
+
+class CSVSpillStorage(rbql_engine.RBQLSpillStorage):
+    # Stores partitions of the partitioned join as JSON lines files in a private temporary directory which is created on the first write.
+    def __init__(self):
+        self.tmp_dir = None
+
+    def get_partition_path(self, partition_id):
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.mkdtemp(prefix='rbql_join_')
+        return os.path.join(self.tmp_dir, '{}.jsonl'.format(partition_id))
+
+    def create_partition_writer(self, partition_id):
+        return JSONLinesWriter(self.get_partition_path(partition_id))
+
+    def read_partition(self, partition_id):
+        with open(self.get_partition_path(partition_id), 'rb') as f:
+            for line in f:
+                yield json.loads(line.decode('ascii'))
+
+    def remove_partition(self, partition_id):
+        partition_path = self.get_partition_path(partition_id)
+        if os.path.exists(partition_path):
+            os.remove(partition_path)
+
+    def finish(self):
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+
+
 class FileSystemCSVRegistry(rbql_engine.RBQLTableRegistry):
-    def __init__(self, input_file_dir, delim, policy, encoding, has_header, comment_prefix):
+    # `join_index_cache_dir` - optional directory to store persistent join table indexes which would be reused by subsequent queries.
+    def __init__(self, input_file_dir, delim, policy, encoding, has_header, comment_prefix, join_index_cache_dir=None):
         self.input_file_dir = input_file_dir
         self.delim = delim
         self.policy = policy
         self.encoding = encoding
         self.record_iterator = None
-        self.input_stream = None
+        self.input_streams = []
         self.has_header = has_header
         self.comment_prefix = comment_prefix
         self.table_path = None
+        self.table_paths = []
+        self.join_index_cache_dir = join_index_cache_dir
+        self.join_maps = []
+        self.warnings = []
 
     def get_iterator_by_table_id(self, table_id, single_char_alias):
         self.table_path = find_table_path(self.input_file_dir, table_id)
         if self.table_path is None:
             raise rbql_engine.RbqlIOHandlingError('Unable to find join table "{}"'.format(table_id))
-        self.input_stream = open(self.table_path, 'rb')
-        self.record_iterator = CSVRecordIterator(self.input_stream, self.encoding, self.delim, self.policy, self.has_header, comment_prefix=self.comment_prefix, table_name=table_id, variable_prefix=single_char_alias)
+        self.table_paths.append(self.table_path)
+        self.input_streams.append(open(self.table_path, 'rb'))
+        self.record_iterator = CSVRecordIterator(self.input_streams[-1], self.encoding, self.delim, self.policy, self.has_header, comment_prefix=self.comment_prefix, table_name=table_id, variable_prefix=single_char_alias)
         return self.record_iterator
 
+    def create_join_map(self, record_iterator, key_indices, projection):
+        if self.join_index_cache_dir is None or record_iterator is not self.record_iterator or self.encoding is None:
+            return None
+        if not is_private_cache_dir(self.join_index_cache_dir):
+            self.warnings.append('Join index cache was not used because directory "{}" is not private to the current user'.format(self.join_index_cache_dir))
+            self.join_index_cache_dir = None
+            return None
+        has_header = record_iterator.has_header # Can be changed by `WITH (header)` modifier.
+        index_path = get_join_index_path(self.join_index_cache_dir, self.table_path, self.encoding, self.delim, self.policy, has_header, self.comment_prefix, key_indices)
+        join_map = IndexedCSVJoinMap(self.table_path, index_path, self.encoding, self.delim, self.policy, has_header, self.comment_prefix, record_iterator.table_name, key_indices, projection)
+        try:
+            join_map.build()
+        except UnsupportedIndexError:
+            return None
+        self.join_maps.append(join_map)
+        return join_map
+
+    def create_spill_storage(self):
+        return CSVSpillStorage()
+
     def finish(self):
-        if self.input_stream is not None:
-            self.input_stream.close()
+        for input_stream in self.input_streams:
+            input_stream.close()
+        for join_map in self.join_maps:
+            join_map.finish()
 
     def get_warnings(self):
-        result = []
-        if self.record_iterator is not None and self.has_header:
-            result.append('The first record in JOIN file {} was also treated as header (and skipped)'.format(os.path.basename(self.table_path))) # UT JSON CSV
+        result = list(self.warnings)
+        if self.has_header:
+            for table_path in self.table_paths:
+                result.append('The first record in JOIN file {} was also treated as header (and skipped)'.format(os.path.basename(table_path))) # UT JSON CSV
         return result
 
 
-def query_csv(query_text, input_path, input_delim, input_policy, output_path, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', colorize_output=False):
+def ensure_valid_csv_query_params(query_text, input_delim, input_policy, output_delim, csv_encoding):
+    if input_delim == '"' and input_policy == 'quoted':
+        raise rbql_engine.RbqlIOHandlingError('Double quote delimiter is incompatible with "quoted" policy')
+    if input_delim != ' ' and input_policy == 'whitespace':
+        raise rbql_engine.RbqlIOHandlingError('Only whitespace " " delim is supported with "whitespace" policy')
+
+    if not is_ascii(query_text) and csv_encoding == 'latin-1':
+        raise rbql_engine.RbqlIOHandlingError('To use non-ascii characters in query enable UTF-8 encoding instead of latin-1/binary')
+
+    if (not is_ascii(input_delim) or not is_ascii(output_delim)) and csv_encoding == 'latin-1':
+        raise rbql_engine.RbqlIOHandlingError('To use non-ascii separators enable UTF-8 encoding instead of latin-1/binary')
+
+
+def get_default_user_init_code(user_init_code):
+    default_init_source_path = os.path.join(os.path.expanduser('~'), '.rbql_init_source.py')
+    if user_init_code == '' and os.path.exists(default_init_source_path):
+        return read_user_init_code(default_init_source_path)
+    return user_init_code
+
+
+incremental_state_format_version = 2
+incremental_state_head_size = 65536
+
+
+class TruncatedBinaryStream(io.RawIOBase):
+    # Binary stream which hides the file content after `end_offset`, e.g. an incomplete last line which is still being written.
+    def __init__(self, stream, end_offset):
+        self.stream = stream
+        self.end_offset = end_offset
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buf):
+        size = min(len(buf), max(0, self.end_offset - self.stream.tell()))
+        data = self.stream.read(size)
+        buf[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            self.stream.seek(self.end_offset + offset, os.SEEK_SET)
+        else:
+            self.stream.seek(offset, whence)
+        return self.stream.tell()
+
+    def tell(self):
+        return self.stream.tell()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+
+def get_complete_lines_size(stream):
+    # Returns size of the stream content up to and including the last line separator.
+    stream.seek(0, os.SEEK_END)
+    end_offset = stream.tell()
+    while end_offset > 0:
+        chunk_size = min(end_offset, 65536)
+        stream.seek(end_offset - chunk_size)
+        chunk = stream.read(chunk_size)
+        line_end = chunk.rfind(b'\n')
+        if line_end != -1:
+            end_offset = end_offset - chunk_size + line_end + 1
+            break
+        end_offset -= chunk_size
+    stream.seek(0)
+    return end_offset
+
+
+def get_complete_records_size(stream, start_offset, end_offset, encoding, comment_prefix):
+    # Returns size of the stream content up to and including the last complete "quoted_rfc" record, `start_offset` and `end_offset` must be record and line boundaries respectively.
+    # The last complete line can be inside of a multiline field which is still being written.
+    comment_prefix = comment_prefix.encode(encoding or 'latin-1') if comment_prefix else None
+    stream.seek(start_offset)
+    offset = start_offset
+    result = start_offset
+    in_multiline_field = False
+    while offset < end_offset:
+        line = stream.readline(end_offset - offset)
+        if not line:
+            break
+        offset += len(line)
+        if in_multiline_field or comment_prefix is None or not line.startswith(comment_prefix):
+            if line.count(b'"') % 2 == 1:
+                in_multiline_field = not in_multiline_field
+        if not in_multiline_field:
+            result = offset
+    stream.seek(0)
+    return result
+
+
+def get_head_checksum(stream, size):
+    stream.seek(0)
+    result = hashlib.sha1(stream.read(min(size, incremental_state_head_size))).hexdigest()
+    stream.seek(0)
+    return result
+
+
+def get_join_tables_signature(join_tables_registry):
+    result = []
+    for table_path in join_tables_registry.table_paths:
+        table_stat = os.stat(table_path)
+        result.append([os.path.abspath(table_path), table_stat.st_size, table_stat.st_mtime])
+    return result
+
+
+def get_incremental_state_path(state_dir, query_text, input_path, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, user_init_code):
+    state_key = repr((incremental_state_format_version, os.path.abspath(input_path), query_text, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, user_init_code))
+    return os.path.join(state_dir, 'rbql_incremental_{}.json'.format(hashlib.sha1(state_key.encode('utf-8')).hexdigest()))
+
+
+def decode_incremental_state(state):
+    # Returns None if the state doesn't have the expected structure.
+    try:
+        for name in ['offset', 'record_position', 'line_number']:
+            if not is_non_negative_int(state[name]):
+                return None
+        if not rbql_engine.is_str6(state['head_checksum']) or not isinstance(state['join_tables_signature'], list):
+            return None
+        fields_info = decode_fields_info(state['fields_info']) if len(state['fields_info']) else dict()
+        aggregation_state = rbql_engine.decode_aggregation_state(state['aggregation_state'])
+        if fields_info is None or aggregation_state is None:
+            return None
+        return dict(state, fields_info=fields_info, aggregation_state=aggregation_state)
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def query_csv_incremental(query_text, input_path, input_stream, input_delim, input_policy, output_writer, csv_encoding, output_warnings, with_headers, comment_prefix, user_init_code, join_tables_registry, join_memory_budget, state_dir):
+    # Aggregation state of the query is saved in `state_dir` along with the consumed size of the input file, the next run against the same file with appended records reads only the new records.
+    # The saved state is discarded if the already consumed part of the file was changed.
+    state_path = get_incremental_state_path(state_dir, query_text, input_path, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, user_init_code)
+    end_offset = get_complete_lines_size(input_stream)
+    saved_state = try_load_json_index(state_path)
+    saved_state = decode_incremental_state(saved_state) if saved_state is not None else None
+    if saved_state is not None and (saved_state['offset'] > end_offset or saved_state['head_checksum'] != get_head_checksum(input_stream, saved_state['offset'])):
+        saved_state = None
+    if input_policy == 'quoted_rfc':
+        end_offset = get_complete_records_size(input_stream, saved_state['offset'] if saved_state is not None else 0, end_offset, csv_encoding, comment_prefix)
+    head_checksum = get_head_checksum(input_stream, end_offset)
+    input_iterator = CSVRecordIterator(io.BufferedReader(TruncatedBinaryStream(input_stream, end_offset)), csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix)
+    prepared_query = rbql_engine.prepare(query_text, input_iterator, join_tables_registry, user_init_code, join_memory_budget)
+    try:
+        if not prepared_query.is_aggregate_query():
+            raise rbql_engine.RbqlParsingError('Incremental mode requires an aggregate query')
+        join_tables_signature = get_join_tables_signature(join_tables_registry)
+        aggregation_state = rbql_engine.AggregationState()
+        if saved_state is not None and saved_state['join_tables_signature'] == join_tables_signature:
+            aggregation_state = saved_state['aggregation_state']
+            input_iterator._seek_record(saved_state['record_position'], saved_state['offset'], saved_state['line_number'])
+            input_iterator.pop_num_skipped_records()
+            input_iterator.fields_info.update(saved_state['fields_info'])
+        prepared_query.execute(input_iterator, output_writer, output_warnings, aggregation_state=aggregation_state)
+    finally:
+        prepared_query.finish()
+    try:
+        new_state = {'offset': end_offset, 'head_checksum': head_checksum, 'join_tables_signature': join_tables_signature, 'record_position': input_iterator.NR, 'line_number': input_iterator.NL, 'fields_info': encode_fields_info(input_iterator.fields_info), 'aggregation_state': rbql_engine.encode_aggregation_state(aggregation_state)}
+        save_json_index(state_path, new_state)
+    except Exception as e:
+        output_warnings.append('Unable to save incremental aggregation state: {}'.format(e))
+
+
+def query_csv(query_text, input_path, input_delim, input_policy, output_path, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', colorize_output=False, join_memory_budget=None, join_index_cache_dir=None, columnar_cache_dir=None, incremental_state_dir=None, follow=False, follow_idle_timeout=None, partition_by=None):
+    # `columnar_cache_dir` - optional directory to store split input tables which would be reused by subsequent queries against the same unchanged table.
+    # `incremental_state_dir` - optional directory to store aggregation state of the query, so the next run against the same append-only input file would process only the appended records.
+    # `follow` - keep reading records appended to the input file and stream the output as they arrive, aggregate queries output the current results each time all appended records are processed. See CSVRecordIterator for `follow_idle_timeout`.
+    # `partition_by` - output column name or 1-based index, output records are split into files of `output_path` directory by the value of this column, see PartitionedCSVWriter.
     output_stream, close_output_on_finish = (None, False)
     input_stream, close_input_on_finish = (None, False)
     join_tables_registry = None
+    input_iterator = None
+    output_writer = None
     try:
-        output_stream, close_output_on_finish = (sys.stdout, False) if output_path is None else (open(output_path, 'wb'), True)
+        if partition_by is None:
+            output_stream, close_output_on_finish = (sys.stdout, False) if output_path is None else (open(output_path, 'wb'), True)
+        elif output_path is None:
+            raise rbql_engine.RbqlIOHandlingError('Partitioned output requires an output directory')
+        elif not os.path.isdir(output_path) or len(os.listdir(output_path)):
+            # Files of a previous run would be mixed with the new partitions, so they must be removed by the user.
+            raise rbql_engine.RbqlIOHandlingError('Output directory for partitioned output must exist and be empty: "{}"'.format(output_path))
         input_stream, close_input_on_finish = (sys.stdin, False) if input_path is None else (open(input_path, 'rb'), True)
 
-        if input_delim == '"' and input_policy == 'quoted':
-            raise rbql_engine.RbqlIOHandlingError('Double quote delimiter is incompatible with "quoted" policy')
-        if input_delim != ' ' and input_policy == 'whitespace':
-            raise rbql_engine.RbqlIOHandlingError('Only whitespace " " delim is supported with "whitespace" policy')
-
-        if not is_ascii(query_text) and csv_encoding == 'latin-1':
-            raise rbql_engine.RbqlIOHandlingError('To use non-ascii characters in query enable UTF-8 encoding instead of latin-1/binary')
+        ensure_valid_csv_query_params(query_text, input_delim, input_policy, output_delim, csv_encoding)
+        user_init_code = get_default_user_init_code(user_init_code)
+        if debug_mode:
+            rbql_engine.set_debug_mode()
 
-        if (not is_ascii(input_delim) or not is_ascii(output_delim)) and csv_encoding == 'latin-1':
-            raise rbql_engine.RbqlIOHandlingError('To use non-ascii separators enable UTF-8 encoding instead of latin-1/binary')
+        if partition_by is None:
+            output_writer = CSVWriter(output_stream, close_output_on_finish, csv_encoding, output_delim, output_policy, colorize_output=colorize_output)
+        else:
+            output_writer = PartitionedCSVWriter(output_path, partition_by, csv_encoding, output_delim, output_policy)
+        input_file_dir = None if not input_path else os.path.dirname(input_path)
+        join_tables_registry = FileSystemCSVRegistry(input_file_dir, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, join_index_cache_dir)
+        if follow:
+            if not input_path:
+                raise rbql_engine.RbqlIOHandlingError('Follow mode requires an input file')
+            input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, follow=True, follow_idle_timeout=follow_idle_timeout)
+            # Not a single execution query: building the join hash map on the input table would wait for the end of the input.
+            prepared_query = rbql_engine.prepare(query_text, input_iterator, join_tables_registry, user_init_code, join_memory_budget)
+            try:
+                prepared_query.execute(None, output_writer, output_warnings)
+            finally:
+                prepared_query.finish()
+            return
+        if incremental_state_dir is not None:
+            if not input_path:
+                raise rbql_engine.RbqlIOHandlingError('Incremental mode requires an input file')
+            query_csv_incremental(query_text, input_path, input_stream, input_delim, input_policy, output_writer, csv_encoding, output_warnings, with_headers, comment_prefix, user_init_code, join_tables_registry, join_memory_budget, incremental_state_dir)
+            return
+        if columnar_cache_dir is not None and input_path:
+            if is_private_cache_dir(columnar_cache_dir):
+                input_iterator = open_columnar_cache_iterator(columnar_cache_dir, input_path, csv_encoding, input_delim, input_policy, with_headers, comment_prefix)
+            else:
+                output_warnings.append('Columnar cache was not used because directory "{}" is not private to the current user'.format(columnar_cache_dir))
+        if input_iterator is None:
+            input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix)
+        if input_path and isinstance(input_iterator, CSVRecordIterator):
+            set_table_indexes(input_iterator, input_path, csv_encoding, input_delim, input_policy, comment_prefix)
+        rbql_engine.query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, join_memory_budget=join_memory_budget)
+    finally:
+        if isinstance(input_iterator, ColumnarCacheIterator):
+            input_iterator.finish()
+        if isinstance(output_writer, PartitionedCSVWriter):
+            output_writer.close_files()
+        if close_input_on_finish:
+            input_stream.close()
+        if close_output_on_finish:
+            output_stream.close()
+        if join_tables_registry:
+            join_tables_registry.finish()
+            output_warnings += join_tables_registry.get_warnings()
 
-        default_init_source_path = os.path.join(os.path.expanduser('~'), '.rbql_init_source.py')
-        if user_init_code == '' and os.path.exists(default_init_source_path):
-            user_init_code = read_user_init_code(default_init_source_path)
 
+def query_csv_batch(query_text, input_paths, input_delim, input_policy, output_paths, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', join_memory_budget=None, join_index_cache_dir=None):
+    # Run the same query against multiple input files with identical structure, e.g. daily partitions of the same table.
+    # The query is parsed and compiled and the join table (if any) is loaded only once.
+    if len(input_paths) != len(output_paths):
+        raise rbql_engine.RbqlIOHandlingError('Number of input and output paths must be the same')
+    absolute_output_paths = [os.path.abspath(p) for p in output_paths]
+    if len(set(absolute_output_paths)) != len(absolute_output_paths):
+        raise rbql_engine.RbqlIOHandlingError('Output paths must be different for each input file')
+    if len(set(absolute_output_paths).intersection(os.path.abspath(p) for p in input_paths)):
+        raise rbql_engine.RbqlIOHandlingError('Output paths must be different from the input paths')
+    if not len(input_paths):
+        return
+    ensure_valid_csv_query_params(query_text, input_delim, input_policy, output_delim, csv_encoding)
+    user_init_code = get_default_user_init_code(user_init_code)
+    if debug_mode:
+        rbql_engine.set_debug_mode()
+    join_tables_registry = FileSystemCSVRegistry(os.path.dirname(input_paths[0]), input_delim, input_policy, csv_encoding, with_headers, comment_prefix, join_index_cache_dir)
+    prepared_query = None
+    try:
+        for input_path, output_path in zip(input_paths, output_paths):
+            with open(input_path, 'rb') as input_stream:
+                input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix, table_name=input_path)
+                set_table_indexes(input_iterator, input_path, csv_encoding, input_delim, input_policy, comment_prefix)
+                if prepared_query is None:
+                    prepared_query = rbql_engine.prepare(query_text, input_iterator, join_tables_registry, user_init_code, join_memory_budget)
+                output_writer = CSVWriter(open(output_path, 'wb'), True, csv_encoding, output_delim, output_policy)
+                try:
+                    prepared_query.execute(input_iterator, output_writer, output_warnings)
+                finally:
+                    output_writer.stream.close()
+    finally:
+        if prepared_query is not None:
+            prepared_query.finish()
+        join_tables_registry.finish()
+        output_warnings += join_tables_registry.get_warnings()
+
+
+def query_csv_shared_scan(query_texts, input_path, input_delim, input_policy, output_paths, output_delim, output_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', join_index_cache_dir=None):
+    # Run multiple queries against the same input file reading and splitting it only once, each query writes its result to the corresponding output path.
+    if len(query_texts) != len(output_paths):
+        raise rbql_engine.RbqlIOHandlingError('Number of queries and output paths must be the same')
+    for query_text in query_texts:
+        ensure_valid_csv_query_params(query_text, input_delim, input_policy, output_delim, csv_encoding)
+    user_init_code = get_default_user_init_code(user_init_code)
+    if debug_mode:
+        rbql_engine.set_debug_mode()
+    input_stream, close_input_on_finish = (sys.stdin, False) if input_path is None else (open(input_path, 'rb'), True)
+    output_writers = []
+    join_tables_registry = None
+    try:
         input_file_dir = None if not input_path else os.path.dirname(input_path)
-        join_tables_registry = FileSystemCSVRegistry(input_file_dir, input_delim, input_policy, csv_encoding, with_headers, comment_prefix)
+        join_tables_registry = FileSystemCSVRegistry(input_file_dir, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, join_index_cache_dir)
         input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix)
-        output_writer = CSVWriter(output_stream, close_output_on_finish, csv_encoding, output_delim, output_policy, colorize_output=colorize_output)
-        if debug_mode:
-            rbql_engine.set_debug_mode()
-        rbql_engine.query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code)
+        for output_path in output_paths:
+            output_writers.append(CSVWriter(open(output_path, 'wb'), True, csv_encoding, output_delim, output_policy))
+        rbql_engine.query_shared_scan(query_texts, input_iterator, output_writers, output_warnings, join_tables_registry, user_init_code)
     finally:
         if close_input_on_finish:
             input_stream.close()
-        if close_output_on_finish:
-            output_stream.close()
+        for output_writer in output_writers:
+            output_writer.stream.close()
         if join_tables_registry:
             join_tables_registry.finish()
             output_warnings += join_tables_registry.get_warnings()
 
 
+def iter_query_csv(query_text, input_path, input_delim, input_policy, csv_encoding, output_warnings, with_headers, comment_prefix=None, user_init_code='', join_index_cache_dir=None):
+    # Returns (output_header, output_records) tuple, `output_records` generator yields output records as lists of fields while the query is executed, see rbql_engine.iter_query()
+    # Fields are not converted to strings. The input file is closed when `output_records` is exhausted, closed or garbage collected.
+    ensure_valid_csv_query_params(query_text, input_delim, input_policy, input_delim, csv_encoding)
+    user_init_code = get_default_user_init_code(user_init_code)
+    if debug_mode:
+        rbql_engine.set_debug_mode()
+    input_stream, close_input_on_finish = (sys.stdin, False) if input_path is None else (open(input_path, 'rb'), True)
+    join_tables_registry = None
+    try:
+        input_file_dir = None if not input_path else os.path.dirname(input_path)
+        join_tables_registry = FileSystemCSVRegistry(input_file_dir, input_delim, input_policy, csv_encoding, with_headers, comment_prefix, join_index_cache_dir)
+        input_iterator = CSVRecordIterator(input_stream, csv_encoding, input_delim, input_policy, with_headers, comment_prefix=comment_prefix)
+        output_header, output_records = rbql_engine.iter_query(query_text, input_iterator, output_warnings, join_tables_registry, user_init_code)
+    except Exception:
+        if close_input_on_finish:
+            input_stream.close()
+        if join_tables_registry:
+            join_tables_registry.finish()
+        raise
+    return (output_header, rbql_engine.OutputRecordsIterator(output_records, lambda: close_csv_input(input_stream, close_input_on_finish, join_tables_registry, output_warnings)))
+
+
+def close_csv_input(input_stream, close_input_on_finish, join_tables_registry, output_warnings):
+    if close_input_on_finish:
+        input_stream.close()
+    join_tables_registry.finish()
+    output_warnings += join_tables_registry.get_warnings()
+
+
 def set_debug_mode():
     global debug_mode
     debug_mode = True
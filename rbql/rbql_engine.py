@@ -5,6 +5,7 @@ from __future__ import print_function
 import sys
 import re
 import ast
+import zlib
 from collections import OrderedDict, defaultdict, namedtuple
 
 import random # For usage inside user queries only.
@@ -31,6 +32,8 @@ INNER_JOIN = 'INNER JOIN'
 LEFT_JOIN = 'LEFT JOIN'
 LEFT_OUTER_JOIN = 'LEFT OUTER JOIN'
 STRICT_LEFT_JOIN = 'STRICT LEFT JOIN'
+SEMI_JOIN = 'SEMI JOIN'
+ANTI_JOIN = 'ANTI JOIN'
 ORDER_BY = 'ORDER BY'
 WHERE = 'WHERE'
 LIMIT = 'LIMIT'
@@ -38,7 +41,11 @@ EXCEPT = 'EXCEPT'
 WITH = 'WITH'
 FROM = 'FROM'
 
-default_statement_groups = [[STRICT_LEFT_JOIN, LEFT_OUTER_JOIN, LEFT_JOIN, INNER_JOIN, JOIN], [SELECT], [ORDER_BY], [WHERE], [UPDATE], [GROUP_BY], [LIMIT], [EXCEPT], [FROM]]
+# Aliases of additional join tables in queries with multiple JOIN statements, the first join table is always "b".
+extra_join_table_aliases = ['c', 'd', 'e', 'f', 'g', 'h']
+table_aliases = ['a', 'b'] + extra_join_table_aliases
+
+default_statement_groups = [[STRICT_LEFT_JOIN, LEFT_OUTER_JOIN, LEFT_JOIN, INNER_JOIN, SEMI_JOIN, ANTI_JOIN, JOIN], [SELECT], [ORDER_BY], [WHERE], [UPDATE], [GROUP_BY], [LIMIT], [EXCEPT], [FROM]]
 
 ambiguous_error_msg = 'Ambiguous variable name: "{}" is present both in input and in join tables'
 invalid_keyword_in_aggregate_query_error_msg = '"ORDER BY", "UPDATE" and "DISTINCT" keywords are not allowed in aggregate queries'
@@ -90,12 +97,25 @@ class RBQLContext:
         self.aggregation_stage = 0
         self.aggregation_key_expression = None
         self.functional_aggregators = []
+        self.initial_record_number = 0
+        self.final_record_number = None
+        self.main_loop_generator = None # Main loop which receives input records one by one in shared scan mode.
 
         self.join_map_impl = None
         self.join_map = None
+        self.extra_join_maps = []
+        self.extra_lhs_join_var_expressions = []
+        self.join_memory_budget = None
+        self.single_execution = False
         self.lhs_join_var_expression = None
 
         self.where_expression = None
+        self.where_conjuncts = None # List of (expression, reorderable) tuples, see split_where_conjuncts().
+        self.required_num_fields = 0 # Input records with fewer fields can make the query fail, so optimizations which skip or reorder evaluation must not apply to them.
+        self.raw_line_prefilter = None
+        self.join_key_prefilter_index = None
+        self.record_number_range = None
+        self.field_constraints = None
 
         self.select_expression = None
 
@@ -103,6 +123,19 @@ class RBQLContext:
 
         self.variables_init_code = None
 
+        self.pre_where_cse_code = None
+        self.post_where_cse_code = None
+
+        self.query_modifiers = []
+        self.input_header = None
+        self.output_header = None
+        self.distinct_mode = None
+        self.reverse_sort = None
+
+
+# Query context attributes which are computed during query parsing and don't change during query execution.
+prepared_query_context_attributes = ['top_count', 'like_regex_cache', 'sort_key_expression', 'aggregation_key_expression', 'join_map_impl', 'join_map', 'lhs_join_var_expression', 'extra_join_maps', 'extra_lhs_join_var_expressions', 'where_expression', 'where_conjuncts', 'required_num_fields', 'raw_line_prefilter', 'join_key_prefilter_index', 'record_number_range', 'field_constraints', 'select_expression', 'update_expressions', 'variables_init_code', 'pre_where_cse_code', 'post_where_cse_code', 'query_modifiers', 'input_header', 'output_header', 'distinct_mode', 'reverse_sort']
+
 
 def is_str6(val):
     return (PY3 and isinstance(val, str)) or (not PY3 and isinstance(val, basestring))
@@ -150,7 +183,7 @@ def column_info_from_node(root):
             return None
         if var_name == rbql_star_marker:
             return QueryColumnInfo(table_name=None, column_index=None, column_name=None, is_star=True, alias_name=None)
-        good_column_name_rgx = '^([ab])([0-9][0-9]*)$'
+        good_column_name_rgx = '^([{}])([0-9][0-9]*)$'.format(''.join(table_aliases))
         match_obj = re.match(good_column_name_rgx, var_name)
         if match_obj is not None:
             table_name = match_obj.group(1)
@@ -168,7 +201,7 @@ def column_info_from_node(root):
         if not isinstance(var_root, ast.Name):
             return None
         table_name = get_field(var_root, 'id')
-        if table_name is None or table_name not in ['a', 'b']:
+        if table_name is None or table_name not in table_aliases:
             return None
         if column_name == rbql_star_marker:
             return QueryColumnInfo(table_name=table_name, column_index=None, column_name=None, is_star=True, alias_name=None)
@@ -178,7 +211,7 @@ def column_info_from_node(root):
         if not isinstance(var_root, ast.Name):
             return None
         table_name = get_field(var_root, 'id')
-        if table_name is None or table_name not in ['a', 'b']:
+        if table_name is None or table_name not in table_aliases:
             return None
         slice_root = get_field(root, 'slice')
         if slice_root is None or not isinstance(slice_root, ast.Index):
@@ -458,6 +491,69 @@ class ConstGroupVerifier:
         return self.const_values[key]
 
 
+adaptive_where_num_samples = 1000
+precise_timer = getattr(time, 'perf_counter', time.time)
+
+
+class AdaptiveWhereEvaluator(object):
+    # Evaluates a conjunction of side-effect-free predicates. Cost and rejection rate of each predicate is measured on the first records and then predicates are reordered to evaluate cheap and selective ones first.
+    # Only `reorderable` predicates which can't raise exceptions are moved and never across other predicates, so the result and the raised exceptions are always the same as with the original order,
+    # e.g. in `int(a2) > 10 and a3 == 'x'` the predicates are never reordered, otherwise records with invalid a2 values would be silently skipped.
+    def __init__(self, conjuncts, reorderable, num_samples=adaptive_where_num_samples):
+        self.conjuncts = conjuncts
+        self.reorderable = reorderable
+        self.ordered_conjuncts = conjuncts
+        self.num_samples_left = num_samples
+        self.total_costs = [0.0] * len(conjuncts)
+        self.num_evaluated = [0] * len(conjuncts)
+        self.num_rejected = [0] * len(conjuncts)
+
+    def evaluate(self, has_required_fields):
+        # Predicates are exception-free only for records which have all of the fields referenced by the query, other records are evaluated in the original order.
+        if self.num_samples_left > 0:
+            return self.evaluate_and_sample()
+        for conjunct in (self.ordered_conjuncts if has_required_fields else self.conjuncts):
+            if not conjunct():
+                return False
+        return True
+
+    def evaluate_and_sample(self):
+        self.num_samples_left -= 1
+        result = True
+        for i, conjunct in enumerate(self.conjuncts):
+            start_time = precise_timer()
+            passed = conjunct()
+            self.total_costs[i] += precise_timer() - start_time
+            self.num_evaluated[i] += 1
+            if not passed:
+                self.num_rejected[i] += 1
+                result = False
+                break
+        if self.num_samples_left == 0:
+            self.reorder()
+        return result
+
+    def reorder(self):
+        ranks = []
+        for i in range(len(self.conjuncts)):
+            rank = float('inf')
+            if self.num_rejected[i] > 0:
+                # Expected cost of evaluating the predicate divided by the probability of rejecting the record, the classic ordering for independent predicates.
+                rank = self.total_costs[i] / self.num_rejected[i]
+            ranks.append(rank)
+        # Sorting is stable, so predicates which never rejected a record keep their original relative order at the end of their group.
+        order = []
+        group = []
+        for i in range(len(self.conjuncts)):
+            if self.reorderable[i]:
+                group.append(i)
+                continue
+            order += sorted(group, key=lambda i: ranks[i]) + [i]
+            group = []
+        order += sorted(group, key=lambda i: ranks[i])
+        self.ordered_conjuncts = [self.conjuncts[i] for i in order]
+
+
 def add_to_set(dst_set, value):
     len_before = len(dst_set)
     dst_set.add(value)
@@ -546,14 +642,123 @@ class AggregateWriter(object):
         self.subwriter = subwriter
         self.aggregators = []
         self.aggregation_keys = set()
+        self.num_snapshots = 0
+        self.is_snapshot_current = False # True if nothing was aggregated since the last snapshot
 
     def finish(self):
-        all_keys = sorted(list(self.aggregation_keys))
-        for key in all_keys:
+        if not self.is_snapshot_current:
+            all_keys = sorted(list(self.aggregation_keys))
+            for key in all_keys:
+                out_fields = [ag.get_final(key) for ag in self.aggregators]
+                if not self.subwriter.write(out_fields):
+                    break
+        self.subwriter.finish()
+
+    def write_snapshot(self):
+        # Writes intermediate aggregation results without finishing the aggregation, e.g. while waiting for more records of a growing input table.
+        subwriter = self.subwriter
+        top_count = None
+        if isinstance(subwriter, TopWriter):
+            subwriter, top_count = subwriter.subwriter, subwriter.top_count
+        for key in sorted(list(self.aggregation_keys))[:top_count]:
             out_fields = [ag.get_final(key) for ag in self.aggregators]
-            if not self.subwriter.write(out_fields):
+            if not subwriter.write(out_fields):
                 break
-        self.subwriter.finish()
+        self.num_snapshots += 1
+        self.is_snapshot_current = True
+
+
+class AggregationState(object):
+    # Aggregation state of the query which allows to continue aggregation with more input records later, e.g. with records appended to the input file.
+    def __init__(self):
+        self.aggregators = None
+        self.aggregation_keys = None
+        self.num_records = 0 # NR of the last aggregated record
+
+
+aggregator_classes = {cls.__name__: cls for cls in [MinAggregator, MaxAggregator, SumAggregator, AvgAggregator, VarianceAggregator, MedianAggregator, CountAggregator, ArrayAggAggregator, ConstGroupVerifier]}
+
+
+def encode_state_value(value):
+    # JSON doesn't distinguish tuples (e.g. multicolumn GROUP BY keys) from lists, so tuples are tagged.
+    if isinstance(value, tuple):
+        return {'tuple': [encode_state_value(v) for v in value]}
+    if isinstance(value, list):
+        return [encode_state_value(v) for v in value]
+    if value is None or isinstance(value, (bool, int, float)) or is_str6(value):
+        return value
+    raise RbqlRuntimeError('Unable to save aggregation state with value of type "{}"'.format(type(value).__name__))
+
+
+def decode_state_value(value):
+    # Raises ValueError if `value` is malformed.
+    if isinstance(value, dict):
+        if list(value.keys()) != ['tuple'] or not isinstance(value['tuple'], list):
+            raise ValueError('Bad state value')
+        return tuple(decode_state_value(v) for v in value['tuple'])
+    if isinstance(value, list):
+        return [decode_state_value(v) for v in value]
+    return value
+
+
+def encode_aggregator(aggregator):
+    if isinstance(aggregator, ConstGroupVerifier):
+        return {'type': 'ConstGroupVerifier', 'output_index': aggregator.output_index, 'stats': [[encode_state_value(k), encode_state_value(v)] for k, v in aggregator.const_values.items()]}
+    if isinstance(aggregator, ArrayAggAggregator) and aggregator.post_proc is not None:
+        raise RbqlRuntimeError('Unable to save aggregation state of ARRAY_AGG with a custom function')
+    result = {'type': type(aggregator).__name__, 'stats': [[encode_state_value(k), encode_state_value(v)] for k, v in aggregator.stats.items()]}
+    num_handler = getattr(aggregator, 'num_handler', None)
+    if num_handler is not None:
+        result['num_handler'] = [num_handler.is_int, num_handler.string_detection_done, num_handler.is_str]
+    return result
+
+
+def decode_aggregator(encoded_aggregator):
+    # Raises ValueError, TypeError or KeyError if `encoded_aggregator` is malformed.
+    aggregator_class = aggregator_classes[encoded_aggregator['type']]
+    if aggregator_class is ConstGroupVerifier:
+        if not isinstance(encoded_aggregator['output_index'], int):
+            raise ValueError('Bad aggregator')
+        aggregator = ConstGroupVerifier(encoded_aggregator['output_index'])
+        stats = aggregator.const_values
+    else:
+        aggregator = aggregator_class()
+        stats = aggregator.stats
+    for key, value in encoded_aggregator['stats']:
+        value = decode_state_value(value)
+        if aggregator_class in [AvgAggregator, VarianceAggregator] and (not isinstance(value, tuple) or len(value) != (2 if aggregator_class is AvgAggregator else 3)):
+            raise ValueError('Bad aggregator')
+        if aggregator_class in [MedianAggregator, ArrayAggAggregator] and not isinstance(value, list):
+            raise ValueError('Bad aggregator')
+        stats[decode_state_value(key)] = value
+    if hasattr(aggregator, 'num_handler'):
+        is_int, string_detection_done, is_str = encoded_aggregator['num_handler']
+        aggregator.num_handler.is_int, aggregator.num_handler.string_detection_done, aggregator.num_handler.is_str = bool(is_int), bool(string_detection_done), bool(is_str)
+    return aggregator
+
+
+def encode_aggregation_state(aggregation_state):
+    # Returns JSON-compatible representation of AggregationState, raises RbqlRuntimeError if the state has values which can't be represented.
+    result = {'num_records': aggregation_state.num_records, 'aggregators': None, 'aggregation_keys': None}
+    if aggregation_state.aggregators is not None:
+        result['aggregators'] = [encode_aggregator(aggregator) for aggregator in aggregation_state.aggregators]
+        result['aggregation_keys'] = [encode_state_value(key) for key in aggregation_state.aggregation_keys]
+    return result
+
+
+def decode_aggregation_state(encoded_state):
+    # Returns None if `encoded_state` is malformed.
+    try:
+        aggregation_state = AggregationState()
+        aggregation_state.num_records = encoded_state['num_records']
+        if not isinstance(aggregation_state.num_records, int) or aggregation_state.num_records < 0:
+            return None
+        if encoded_state['aggregators'] is not None:
+            aggregation_state.aggregators = [decode_aggregator(aggregator) for aggregator in encoded_state['aggregators']]
+            aggregation_state.aggregation_keys = set([decode_state_value(key) for key in encoded_state['aggregation_keys']])
+        return aggregation_state
+    except (ValueError, TypeError, KeyError):
+        return None
 
 
 class InnerJoiner(object):
@@ -567,7 +772,7 @@ class InnerJoiner(object):
 class LeftJoiner(object):
     def __init__(self, join_map):
         self.join_map = join_map
-        self.null_record = [(None, join_map.max_record_len, [None] * join_map.max_record_len)]
+        self.null_record = [join_map.make_null_entry()]
 
     def get_rhs(self, lhs_key):
         result = self.join_map.get_join_records(lhs_key)
@@ -587,6 +792,23 @@ class StrictLeftJoiner(object):
         return result
 
 
+class SemiJoiner(object):
+    # Emits each record from A at most once if its key is present in B. Join entries don't have any B fields.
+    def __init__(self, join_map):
+        self.join_map = join_map
+        self.match = [(None, None, [])]
+        self.no_match = []
+
+    def get_rhs(self, lhs_key):
+        return self.match if self.join_map.contains_key(lhs_key) else self.no_match
+
+
+class AntiJoiner(SemiJoiner):
+    # Emits records from A which keys are not present in B.
+    def get_rhs(self, lhs_key):
+        return self.no_match if self.join_map.contains_key(lhs_key) else self.match
+
+
 def select_except(src, except_fields):
     result = list()
     for i, v in enumerate(src):
@@ -626,11 +848,14 @@ def select_aggregated(query_context, key, transparent_values):
         for i, trans_value in enumerate(transparent_values):
             query_context.writer.aggregators[i].increment(key, trans_value)
     query_context.writer.aggregation_keys.add(key)
+    query_context.writer.is_snapshot_current = False
 
 
 PROCESS_SELECT_COMMON = '''
 __RBQLMP__variables_init_code
+__RBQLMP__pre_where_cse_code
 if __RBQLMP__where_expression:
+    __RBQLMP__post_where_cse_code
     out_fields = __RBQLMP__select_expression
     if query_context.aggregation_stage > 0:
         key = __RBQLMP__aggregation_key_expression
@@ -663,6 +888,18 @@ for join_match in join_matches:
 '''
 
 
+# Nested loop for an additional join table in queries with multiple JOIN statements, see generate_extra_join_code().
+PROCESS_SELECT_EXTRA_JOIN = '''
+join_matches_{join_alias} = query_context.extra_join_maps[{extra_join_index}].get_rhs({lhs_join_var_expression})
+for join_match_{join_alias} in join_matches_{join_alias}:
+    {join_alias}NR, {join_alias}NF, record_{join_alias} = join_match_{join_alias}
+    star_fields = {star_fields_expression}
+    __CODE__
+    if stop_flag:
+        break
+'''
+
+
 PROCESS_UPDATE_JOIN = '''
 join_matches = query_context.join_map.get_rhs(__RBQLMP__lhs_join_var_expression)
 if len(join_matches) > 1:
@@ -722,15 +959,17 @@ def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, MIN, MAX
 
     udf = user_namespace
 
-    NR = 0
+    NR = query_context.initial_record_number
     NU = 0
     stop_flag = False
 
+    __RBQLMP__where_evaluator_init_code
+
     while not stop_flag:
-        record_a = query_context.input_iterator.get_record()
+        record_a = __RBQLMP__next_record_expression
         if record_a is None:
             break
-        NR += 1
+        __RBQLMP__record_number_update_code
         NF = len(record_a)
         query_context.unnest_list = None # TODO optimize, don't need to set this every iteration
         try:
@@ -747,8 +986,9 @@ def dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, MIN, MAX
             if str(e).find('RBQLAggregationToken') != -1:
                 raise RbqlParsingError(wrong_aggregation_usage_error) # UT JSON
             raise RbqlRuntimeError('At record ' + str(NR) + ', Details: ' + str(e)) # UT JSON
+    query_context.final_record_number = NR
 
-dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested)
+query_context.main_loop_generator = dummy_wrapper_for_exec(query_context, user_namespace, LIKE, UNNEST, MIN, MAX, COUNT, SUM, AVG, VARIANCE, MEDIAN, ARRAY_AGG, mad_max, mad_min, mad_sum, select_unnested)
 '''
 
 
@@ -775,20 +1015,54 @@ def embed_code(parent_code, child_placeholder, child_code):
     assert False
 
 
-def generate_main_loop_code(query_context):
+def is_partitioned_join(query_context):
+    return isinstance(query_context.join_map_impl, HashJoinMap) and query_context.join_map_impl.is_partitioned()
+
+
+def is_swapped_join(query_context):
+    return isinstance(query_context.join_map_impl, SwappedJoinMap)
+
+
+def generate_extra_join_code(extra_join_index, lhs_join_var_expression):
+    join_alias = extra_join_table_aliases[extra_join_index]
+    star_fields_expression = ' + '.join(['record_{}'.format(alias) for alias in table_aliases[:extra_join_index + 3]])
+    return PROCESS_SELECT_EXTRA_JOIN.format(join_alias=join_alias, extra_join_index=extra_join_index, lhs_join_var_expression=lhs_join_var_expression, star_fields_expression=star_fields_expression)
+
+
+def generate_main_loop_code(query_context, shared_scan=False):
+    # With `shared_scan` the main loop is a generator which receives input records with send() instead of reading them from the input iterator.
     is_select_query = query_context.select_expression is not None
     is_join_query = query_context.join_map is not None
     where_expression = 'True' if query_context.where_expression is None else query_context.where_expression
     aggregation_key_expression = 'None' if query_context.aggregation_key_expression is None else query_context.aggregation_key_expression
     sort_key_expression = 'None' if query_context.sort_key_expression is None else query_context.sort_key_expression
     python_code = embed_code(MAIN_LOOP_BODY, '__USER_INIT_CODE__', query_context.user_init_code)
+    where_evaluator_init_code = 'pass'
+    if query_context.where_conjuncts is not None:
+        where_evaluator_init_code = 'where_evaluator = AdaptiveWhereEvaluator([{}], {})'.format(', '.join(['lambda: ({})'.format(c) for c, _ in query_context.where_conjuncts]), repr([r for _, r in query_context.where_conjuncts]))
+        where_expression = 'where_evaluator.evaluate(NF >= {})'.format(query_context.required_num_fields)
+    python_code = embed_code(python_code, '__RBQLMP__where_evaluator_init_code', where_evaluator_init_code)
+    python_code = embed_expression(python_code, '__RBQLMP__next_record_expression', '(yield)' if shared_scan else 'query_context.input_iterator.get_record()')
+    record_number_update_code = 'NR += 1'
+    if shared_scan:
+        pass # Input prefilters are not used because the input table is shared by multiple queries.
+    elif is_partitioned_join(query_context) or is_swapped_join(query_context):
+        record_number_update_code = 'NR = query_context.input_iterator.get_source_record_number()'
+    elif query_context.raw_line_prefilter is not None or query_context.join_key_prefilter_index is not None or query_context.record_number_range is not None or query_context.field_constraints is not None:
+        record_number_update_code = 'NR += 1 + query_context.input_iterator.pop_num_skipped_records()'
+    python_code = embed_code(python_code, '__RBQLMP__record_number_update_code', record_number_update_code)
     if is_select_query:
         if is_join_query:
-            python_code = embed_code(embed_code(python_code, '__CODE__', PROCESS_SELECT_JOIN), '__CODE__', PROCESS_SELECT_COMMON)
+            python_code = embed_code(python_code, '__CODE__', PROCESS_SELECT_JOIN)
+            for extra_join_index in range(len(query_context.extra_join_maps)):
+                python_code = embed_code(python_code, '__CODE__', generate_extra_join_code(extra_join_index, query_context.extra_lhs_join_var_expressions[extra_join_index]))
+            python_code = embed_code(python_code, '__CODE__', PROCESS_SELECT_COMMON)
             python_code = embed_expression(python_code, '__RBQLMP__lhs_join_var_expression', query_context.lhs_join_var_expression)
         else:
             python_code = embed_code(embed_code(python_code, '__CODE__', PROCESS_SELECT_SIMPLE), '__CODE__', PROCESS_SELECT_COMMON)
         python_code = embed_code(python_code, '__RBQLMP__variables_init_code', query_context.variables_init_code)
+        python_code = embed_code(python_code, '__RBQLMP__pre_where_cse_code', query_context.pre_where_cse_code or 'pass')
+        python_code = embed_code(python_code, '__RBQLMP__post_where_cse_code', query_context.post_where_cse_code or 'pass')
         python_code = embed_expression(python_code, '__RBQLMP__select_expression', query_context.select_expression)
         python_code = embed_expression(python_code, '__RBQLMP__where_expression', where_expression)
         python_code = embed_expression(python_code, '__RBQLMP__aggregation_key_expression', aggregation_key_expression)
@@ -810,7 +1084,12 @@ builtin_min = min
 builtin_sum = sum
 
 
-def compile_and_run(query_context, user_namespace, unit_test_mode=False):
+def compile_main_loop(query_context, shared_scan=False):
+    main_loop_body = generate_main_loop_code(query_context, shared_scan)
+    return compile(main_loop_body, '<main loop>', 'exec')
+
+
+def compile_and_run(query_context, user_namespace, unit_test_mode=False, compiled_main_loop=None):
     def LIKE(text, pattern):
         matcher = query_context.like_regex_cache.get(pattern, None)
         if matcher is None:
@@ -928,8 +1207,8 @@ def compile_and_run(query_context, user_namespace, unit_test_mode=False):
         # Return these 3 functions to be able to unit test them from outside
         return (mad_max, mad_min, mad_sum)
 
-    main_loop_body = generate_main_loop_code(query_context)
-    compiled_main_loop = compile(main_loop_body, '<main loop>', 'exec')
+    if compiled_main_loop is None:
+        compiled_main_loop = compile_main_loop(query_context)
     exec(compiled_main_loop, globals(), locals())
 
 
@@ -999,7 +1278,7 @@ def parse_join_expression(src):
     return (table_id, variable_pairs)
 
 
-def resolve_join_variables(input_variables_map, join_variables_map, variable_pairs, string_literals):
+def resolve_join_variables(input_variables_map, join_variables_map, variable_pairs, string_literals, join_alias='b'):
     lhs_variables = []
     rhs_indices = []
     valid_join_syntax_msg = 'Valid JOIN syntax: <JOIN> /path/to/B/table on a... == b... [and a... == b... [and ... ]]'
@@ -1018,7 +1297,7 @@ def resolve_join_variables(input_variables_map, join_variables_map, variable_pai
             lhs_key_index = input_variables_map.get(join_var_1).index
         else:
             raise RbqlParsingError('Unable to parse JOIN expression: Input table does not have field "{}"\n{}'.format(join_var_1, valid_join_syntax_msg)) # UT JSON
-        if join_var_2 in ['bNR', 'b.NR']:
+        if join_var_2 in ['{}NR'.format(join_alias), '{}.NR'.format(join_alias)]:
             rhs_key_index = -1
         elif join_var_2 in join_variables_map:
             rhs_key_index = join_variables_map.get(join_var_2).index
@@ -1031,7 +1310,7 @@ def resolve_join_variables(input_variables_map, join_variables_map, variable_pai
 
 
 def parse_basic_variables(query_text, prefix, dst_variables_map):
-    assert prefix in ['a', 'b']
+    assert prefix in table_aliases
     rgx = '(?:^|[^_a-zA-Z0-9]){}([1-9][0-9]*)(?:$|(?=[^_a-zA-Z0-9]))'.format(prefix)
     matches = list(re.finditer(rgx, query_text))
     field_nums = list(set([int(m.group(1)) for m in matches]))
@@ -1040,7 +1319,7 @@ def parse_basic_variables(query_text, prefix, dst_variables_map):
 
 
 def parse_array_variables(query_text, prefix, dst_variables_map):
-    assert prefix in ['a', 'b']
+    assert prefix in table_aliases
     rgx = r'(?:^|[^_a-zA-Z0-9]){}\[([1-9][0-9]*)\]'.format(prefix)
     matches = list(re.finditer(rgx, query_text))
     field_nums = list(set([int(m.group(1)) for m in matches]))
@@ -1071,7 +1350,7 @@ def query_probably_has_dictionary_variable(query_text, column_name):
 def parse_dictionary_variables(query_text, prefix, column_names, dst_variables_map):
     # The purpose of this algorithm is to minimize number of variables in varibale_map to improve performance, ideally it should be only variables from the query
     # TODO implement algorithm for honest python f-string parsing
-    assert prefix in ['a', 'b']
+    assert prefix in table_aliases
     if re.search(r'(?:^|[^_a-zA-Z0-9]){}\['.format(prefix), query_text) is None:
         return
     for i in range(len(column_names)):
@@ -1087,7 +1366,7 @@ def parse_attribute_variables(query_text, prefix, column_names, column_names_sou
     # TODO ideally we should either:
     # * not search inside string literals (excluding brackets in f-strings) OR
     # * check if column_name is not among reserved python keywords like "None", "if", "else", etc
-    assert prefix in ['a', 'b']
+    assert prefix in table_aliases
     column_names = {v: i for i, v in enumerate(column_names)}
     rgx = r'(?:^|[^_a-zA-Z0-9]){}\.([_a-zA-Z][_a-zA-Z0-9]*)'.format(prefix)
     matches = list(re.finditer(rgx, query_text))
@@ -1097,7 +1376,7 @@ def parse_attribute_variables(query_text, prefix, column_names, column_names_sou
         if zero_based_idx is not None:
             dst_variables_map['{}.{}'.format(prefix, column_name)] = VariableInfo(initialize=True, index=zero_based_idx)
         else:
-            raise RbqlParsingError('Unable to find column "{}" in {} {}'.format(column_name, {'a': 'input', 'b': 'join'}[prefix], column_names_source))
+            raise RbqlParsingError('Unable to find column "{}" in {} {}'.format(column_name, 'input' if prefix == 'a' else 'join', column_names_source))
 
 
 def map_variables_directly(query_text, column_names, dst_variables_map):
@@ -1117,11 +1396,11 @@ def ensure_no_ambiguous_variables(query_text, input_column_names, join_column_na
 
 
 def generate_common_init_code(query_text, variable_prefix):
-    assert variable_prefix in ['a', 'b']
+    assert variable_prefix in table_aliases
     result = list()
     # TODO [PERFORMANCE] do not initialize RBQLRecord if we don't have `a.` or `a[` prefix in the query
     result.append('{} = RBQLRecord()'.format(variable_prefix))
-    base_var = 'NR' if variable_prefix == 'a' else 'bNR'
+    base_var = 'NR' if variable_prefix == 'a' else '{}NR'.format(variable_prefix)
     attr_var = '{}.NR'.format(variable_prefix)
     if query_text.find(attr_var) != -1:
         result.append('{} = {}'.format(attr_var, base_var))
@@ -1130,16 +1409,20 @@ def generate_common_init_code(query_text, variable_prefix):
     return result
 
 
-def generate_init_statements(query_text, variables_map, join_variables_map):
+def generate_init_statements(query_text, variables_map, join_variables_map, extra_join_variables_maps=None):
+    # `extra_join_variables_maps` - list of variables maps of the additional join tables with "c", "d", ... aliases.
     code_lines = generate_common_init_code(query_text, 'a')
     for var_name, var_info in variables_map.items():
         if var_info.initialize:
             code_lines.append('{} = safe_get(record_a, {})'.format(var_name, var_info.index))
-    if join_variables_map:
-        code_lines += generate_common_init_code(query_text, 'b')
+    join_variables_maps = [join_variables_map] + (extra_join_variables_maps or [])
+    for join_alias, join_variables_map in zip(table_aliases[1:], join_variables_maps):
+        if not join_variables_map:
+            continue
+        code_lines += generate_common_init_code(query_text, join_alias)
         for var_name, var_info in join_variables_map.items():
             if var_info.initialize:
-                code_lines.append('{} = safe_get(record_b, {}) if record_b is not None else None'.format(var_name, var_info.index))
+                code_lines.append('{} = safe_get(record_{}, {}) if record_{} is not None else None'.format(var_name, join_alias, var_info.index, join_alias))
     return '\n'.join(code_lines)
 
 
@@ -1148,12 +1431,12 @@ def replace_star_count(aggregate_expression):
 
 
 def replace_star_vars(rbql_expression):
-    star_matches = list(re.finditer(r'(?:^|,) *(\*|a\.\*|b\.\*) *(?=$|,)', rbql_expression))
+    star_matches = list(re.finditer(r'(?:^|,) *(\*|[{}]\.\*) *(?=$|,)'.format(''.join(table_aliases)), rbql_expression))
     last_pos = 0
     result = ''
     for match in star_matches:
         star_expression = match.group(1)
-        replacement_expression = '] + ' + {'*': 'star_fields', 'a.*': 'record_a', 'b.*': 'record_b'}[star_expression] + ' + ['
+        replacement_expression = '] + ' + ('star_fields' if star_expression == '*' else 'record_' + star_expression[0]) + ' + ['
         if last_pos < match.start():
             result += rbql_expression[last_pos:match.start()]
         result += replacement_expression
@@ -1163,12 +1446,12 @@ def replace_star_vars(rbql_expression):
 
 
 def replace_star_vars_for_ast(rbql_expression):
-    star_matches = list(re.finditer(r'(?:(?<=^)|(?<=,)) *(\*|a\.\*|b\.\*) *(?=$|,)', rbql_expression))
+    star_matches = list(re.finditer(r'(?:(?<=^)|(?<=,)) *(\*|[{}]\.\*) *(?=$|,)'.format(''.join(table_aliases)), rbql_expression))
     last_pos = 0
     result = ''
     for match in star_matches:
         star_expression = match.group(1)
-        replacement_expression = {'*': '__RBQL_INTERNAL_STAR', 'a.*': 'a.__RBQL_INTERNAL_STAR', 'b.*': 'b.__RBQL_INTERNAL_STAR'}[star_expression]
+        replacement_expression = '__RBQL_INTERNAL_STAR' if star_expression == '*' else star_expression[0] + '.__RBQL_INTERNAL_STAR'
         if last_pos < match.start():
             result += rbql_expression[last_pos:match.start()]
         result += replacement_expression
@@ -1238,9 +1521,24 @@ def separate_string_literals(rbql_expression):
     return (format_expression, string_literals)
 
 
+def locate_join_statements(join_statements, rbql_expression):
+    # Query can have multiple JOIN statements. Longer statements go first in the group, so a match inside of an already found statement e.g. "JOIN" in "INNER JOIN" is skipped.
+    result = list()
+    for statement in join_statements:
+        rgxp = r'(?i)(?:^| ){}(?= )'.format(statement.replace(' ', ' *'))
+        for match in re.finditer(rgxp, rbql_expression):
+            if any([start < match.end() and match.start() < end for start, end, _ in result]):
+                continue
+            result.append((match.start(), match.end(), statement))
+    return result
+
+
 def locate_statements(statement_groups, rbql_expression):
     result = list()
     for st_group in statement_groups:
+        if JOIN in st_group:
+            result += locate_join_statements(st_group, rbql_expression)
+            continue
         for statement in st_group:
             rgxp = r'(?i)(?:^| ){}(?= )'.format(statement.replace(' ', ' *'))
             matches = list(re.finditer(rgxp, rbql_expression))
@@ -1255,16 +1553,18 @@ def locate_statements(statement_groups, rbql_expression):
     return sorted(result)
 
 
+common_table_expression_rgx = '(?i)^ *WITH +(?=[_a-zA-Z][_a-zA-Z0-9]* +AS *\\()'
+
+
 def separate_actions(statement_groups, rbql_expression):
     # TODO add more checks:
     # make sure all rbql_expression was separated and SELECT or UPDATE is at the beginning
     rbql_expression = rbql_expression.strip(' ')
     result = dict()
-    # For now support no more than one query modifier per query
-    mobj = re.match('^(.*)  *[Ww][Ii][Tt][Hh] *\(([a-z]{4,20})\) *$', rbql_expression)
+    mobj = re.match('^(.*)  *[Ww][Ii][Tt][Hh] *\(([a-z]{4,20}(?: *, *[a-z]{4,20})*)\) *$', rbql_expression)
     if mobj is not None:
         rbql_expression = mobj.group(1)
-        result[WITH] = mobj.group(2)
+        result[WITH] = [modifier.strip() for modifier in mobj.group(2).split(',')]
     ordered_statements = locate_statements(statement_groups, rbql_expression)
     for i in range(len(ordered_statements)):
         statement_start = ordered_statements[i][0]
@@ -1277,8 +1577,9 @@ def separate_actions(statement_groups, rbql_expression):
 
         statement_params = dict()
 
-        if statement in [STRICT_LEFT_JOIN, LEFT_OUTER_JOIN, LEFT_JOIN, INNER_JOIN, JOIN]:
+        if statement in [STRICT_LEFT_JOIN, LEFT_OUTER_JOIN, LEFT_JOIN, INNER_JOIN, SEMI_JOIN, ANTI_JOIN, JOIN]:
             statement_params['join_subtype'] = statement
+            statement_params['extra_joins'] = []
             statement = JOIN
 
         if statement == UPDATE:
@@ -1310,7 +1611,11 @@ def separate_actions(statement_groups, rbql_expression):
                 span = span[match.end():]
 
         statement_params['text'] = span.strip()
-        result[statement] = statement_params
+        if statement == JOIN and JOIN in result:
+            # Additional JOIN statements are joined with "c", "d", ... aliases.
+            result[JOIN]['extra_joins'].append(statement_params)
+        else:
+            result[statement] = statement_params
     if SELECT not in result and UPDATE not in result:
         raise RbqlParsingError('Query must contain either SELECT or UPDATE statement') # UT JSON
     if SELECT in result and UPDATE in result:
@@ -1318,6 +1623,40 @@ def separate_actions(statement_groups, rbql_expression):
     return result
 
 
+def split_common_table_expressions(query_text):
+    # Splits `WITH name1 AS (query1), name2 AS (query2) main_query` script into ([(name1, query1), (name2, query2)], main_query).
+    query_text = cleanup_query(query_text)
+    format_expression, string_literals = separate_string_literals(query_text)
+    match = re.match(common_table_expression_rgx, format_expression)
+    if match is None:
+        return ([], query_text)
+    result = []
+    pos = match.end()
+    while True:
+        match = re.compile('(?i) *([_a-zA-Z][_a-zA-Z0-9]*) +AS *\\(').match(format_expression, pos)
+        if match is None:
+            raise RbqlParsingError('Unable to parse common table expression: "{}"'.format(combine_string_literals(format_expression[pos:], string_literals).strip())) # UT JSON
+        table_name = match.group(1)
+        if table_name in ['a', 'A'] or table_name in [name for name, _ in result]:
+            raise RbqlParsingError('Invalid common table expression name: "{}"'.format(table_name)) # UT JSON
+        depth = 1
+        pos = match.end()
+        while pos < len(format_expression) and depth > 0:
+            if format_expression[pos] == '(':
+                depth += 1
+            elif format_expression[pos] == ')':
+                depth -= 1
+            pos += 1
+        if depth > 0:
+            raise RbqlParsingError('Unbalanced parentheses in common table expression "{}"'.format(table_name)) # UT JSON
+        result.append((table_name, combine_string_literals(format_expression[match.end():pos - 1], string_literals).strip()))
+        match = re.compile(' *, *').match(format_expression, pos)
+        if match is None:
+            break
+        pos = match.end()
+    return (result, combine_string_literals(format_expression[pos:], string_literals).strip())
+
+
 def find_top(rb_actions):
     if LIMIT in rb_actions:
         try:
@@ -1343,11 +1682,14 @@ def translate_except_expression(except_expression, input_variables_map, string_l
     return (output_header, 'select_except(record_a, [{}])'.format(','.join(skip_indices)))
 
 
-class HashJoinMap:
-    # Other possible flavors: BinarySearchJoinMap, MergeJoinMap
-    def __init__(self, record_iterator, key_indices):
+class JoinMapBase(object):
+    # Set to True if the join map reads the join table during the query execution and therefore can't be used more than once.
+    single_pass = False
+
+    # `projection` - sorted list of B field indices which are referenced by the query. If provided, only these fields are stored in join entries.
+    def __init__(self, record_iterator, key_indices, projection=None):
         self.max_record_len = 0
-        self.hash_map = defaultdict(list)
+        self.projection = projection
         self.record_iterator = record_iterator
         self.key_indices = None
         self.key_index = None
@@ -1374,8 +1716,107 @@ class HashJoinMap:
         return tuple(result)
 
 
+    def make_entry(self, nr, fields):
+        # bNF is the number of fields in the original record even if the record is projected.
+        nf = len(fields)
+        if self.projection is not None:
+            fields = [fields[i] if i < nf else None for i in self.projection]
+        return (nr, nf, fields)
+
+
+    def make_null_entry(self):
+        num_fields = self.max_record_len if self.projection is None else len(self.projection)
+        return (None, self.max_record_len, [None] * num_fields)
+
+
+    def get_key_filter(self):
+        # Reimplement if the join map can provide an object that supports `key in key_filter` test without false negatives, it is used to skip input records without matches.
+        return None
+
+
+    def get_warnings(self):
+        return self.record_iterator.get_warnings()
+
+
+class BloomFilter(object):
+    # Set of keys without false negatives and with a small rate of false positives. Hashing doesn't depend on the Python hash seed, so the filter can be stored on disk.
+    def __init__(self, num_bits, num_hashes=4):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits + 7) // 8)
+
+
+    def get_bit_positions(self, key):
+        data = key.encode('utf-8') if is_str6(key) else str(key).encode('utf-8')
+        h1 = zlib.crc32(data) & 0xffffffff
+        h2 = (zlib.adler32(data) & 0xffffffff) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+
+    def add(self, key):
+        for pos in self.get_bit_positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+
+    def __contains__(self, key):
+        for pos in self.get_bit_positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+# Partitions are written to RBQLSpillStorage provided by the table registry. Number of open partitions is limited, partitions which still don't fit into the memory budget are split recursively.
+grace_join_max_partitions = 256
+grace_join_max_depth = 4
+
+
+def get_approximate_record_size(fields):
+    return sys.getsizeof(fields) + sum([sys.getsizeof(f) for f in fields])
+
+
+def get_num_partitions(table_memory_size, memory_budget):
+    # Twice as many partitions as needed on average, so that an uneven key distribution doesn't overflow most of the partitions.
+    return max(2, min(grace_join_max_partitions, 2 * (table_memory_size // max(1, memory_budget) + 1)))
+
+
+def get_partition_id(table_alias, partition_path):
+    return '{}_{}'.format(table_alias, '_'.join([str(i) for i in partition_path]))
+
+
+def encode_join_key(key):
+    return list(key) if isinstance(key, tuple) else key
+
+
+def decode_join_key(key):
+    return tuple(key) if isinstance(key, list) else key
+
+
+class HashJoinMap(JoinMapBase):
+    # Other possible flavors: BinarySearchJoinMap
+    # If the join table doesn't fit into `memory_budget` (in bytes) and `spill_storage` is provided, both tables are hash-partitioned by the join key and joined partition by partition (grace hash join).
+    # In this mode the input table is read through GraceJoinInputIterator and the output follows the partition order instead of the input order.
+    # If the record iterator supports raw records, the map stores unsplit records and splits them only when they match a key from the input table.
+    def __init__(self, record_iterator, key_indices, memory_budget=None, projection=None, spill_storage=None):
+        super(HashJoinMap, self).__init__(record_iterator, key_indices, projection)
+        self.hash_map = defaultdict(list)
+        self.memory_budget = memory_budget if spill_storage is not None else None
+        self.spill_storage = spill_storage
+        self.num_partitions = None
+        self.partition_sizes = dict()
+        self.subpartitions = dict()
+        self.loaded_partition = None
+        self.raw_map = None
+        self.bloom_filter = None
+
+
     def build(self):
+        if self.memory_budget is None and self.record_iterator.supports_raw_records():
+            self.build_lazy()
+            return
         nr = 0
+        used_memory = 0
+        raw_size = 0
+        table_size = self.record_iterator.get_table_size() if self.memory_budget is not None else None
         while True:
             fields = self.record_iterator.get_record()
             if fields is None:
@@ -1384,15 +1825,474 @@ class HashJoinMap:
             nf = len(fields)
             self.max_record_len = max(self.max_record_len, nf)
             key = self.polymorphic_get_key(nr, fields)
-            self.hash_map[key].append((nr, nf, fields))
+            entry = self.make_entry(nr, fields)
+            self.hash_map[key].append(entry)
+            if self.memory_budget is not None:
+                used_memory += get_approximate_record_size(entry[2])
+                if table_size is not None:
+                    raw_size += sum([len(f) + 1 for f in fields])
+                if used_memory > self.memory_budget:
+                    # Memory size of the whole table is extrapolated from the size of the already loaded part.
+                    table_memory_size = used_memory * table_size // max(1, raw_size) if table_size is not None else used_memory
+                    self.build_partitions(nr, get_num_partitions(table_memory_size, self.memory_budget))
+                    return
+
+
+    def build_lazy(self):
+        self.raw_map = defaultdict(list)
+        num_key_fields = max(self.key_indices if self.key_indices is not None else [self.key_index]) + 1
+        nr = 0
+        while True:
+            raw_record_info = self.record_iterator.get_raw_record(num_key_fields)
+            if raw_record_info is None:
+                break
+            raw_record, leading_fields, nf = raw_record_info
+            nr += 1
+            self.max_record_len = max(self.max_record_len, nf)
+            key = self.polymorphic_get_key(nr, leading_fields)
+            self.raw_map[key].append((nr, raw_record))
+        self.hash_map = dict()
+        self.get_join_records = self.get_lazy_join_records
+
+
+    def get_lazy_join_records(self, key):
+        result = self.hash_map.get(key)
+        if result is not None:
+            return result
+        raw_entries = self.raw_map.get(key)
+        if raw_entries is None:
+            return [] # Don't cache misses to avoid growing the map with unmatched keys from the input table.
+        result = [self.make_entry(nr, self.record_iterator.split_raw_record(raw_record)) for nr, raw_record in raw_entries]
+        self.hash_map[key] = result
+        return result
+
+
+    def is_partitioned(self):
+        return self.num_partitions is not None
+
+
+    def get_partition_index(self, key, depth, num_partitions):
+        # Each level of recursive partitioning uses a different hash function.
+        return hash((depth, key)) % num_partitions
+
+
+    def write_partition_entry(self, writers, partition_path, entry):
+        # Entry is (key, (nr, nf, fields)) tuple.
+        key, (nr, nf, fields) = entry
+        writers[partition_path[-1]].write([encode_join_key(key), nr, nf, fields])
+        self.partition_sizes[partition_path] = self.partition_sizes.get(partition_path, 0) + get_approximate_record_size(fields)
+
+
+    def read_partition_entries(self, partition_path):
+        for key, nr, nf, fields in self.spill_storage.read_partition(get_partition_id('b', partition_path)):
+            yield (decode_join_key(key), (nr, nf, fields))
+
+
+    def build_partitions(self, nr, num_partitions):
+        self.num_partitions = num_partitions
+        # Keys of the partitioned table are not in memory, so we use Bloom filter to skip input records without matches. Filter size is proportional to the memory budget.
+        self.bloom_filter = BloomFilter(max(1 << 20, self.memory_budget))
+        writers = [self.spill_storage.create_partition_writer(get_partition_id('b', (i,))) for i in range(num_partitions)]
+        try:
+            for key, entries in self.hash_map.items():
+                self.bloom_filter.add(key)
+                partition_path = (self.get_partition_index(key, 0, num_partitions),)
+                for entry in entries:
+                    self.write_partition_entry(writers, partition_path, (key, entry))
+            self.hash_map = defaultdict(list)
+            while True:
+                fields = self.record_iterator.get_record()
+                if fields is None:
+                    break
+                nr += 1
+                nf = len(fields)
+                self.max_record_len = max(self.max_record_len, nf)
+                key = self.polymorphic_get_key(nr, fields)
+                self.bloom_filter.add(key)
+                self.write_partition_entry(writers, (self.get_partition_index(key, 0, num_partitions),), (key, self.make_entry(nr, fields)))
+        finally:
+            for writer in writers:
+                writer.close()
+        self.get_join_records = self.get_partitioned_join_records
+
+
+    def get_num_subpartitions(self, partition_path):
+        # Splits the partition if it doesn't fit into the memory budget, returns the number of subpartitions or 0 if the partition should be loaded as is.
+        # Subpartitions are kept for the next executions of the prepared query.
+        if partition_path in self.subpartitions:
+            return self.subpartitions[partition_path]
+        partition_size = self.partition_sizes.get(partition_path, 0)
+        num_subpartitions = 0
+        if partition_size > self.memory_budget and len(partition_path) < grace_join_max_depth:
+            num_subpartitions = get_num_partitions(partition_size, self.memory_budget)
+            subpartition_paths = [partition_path + (i,) for i in range(num_subpartitions)]
+            writers = [self.spill_storage.create_partition_writer(get_partition_id('b', p)) for p in subpartition_paths]
+            try:
+                for entry in self.read_partition_entries(partition_path):
+                    self.write_partition_entry(writers, subpartition_paths[self.get_partition_index(entry[0], len(partition_path), num_subpartitions)], entry)
+            finally:
+                for writer in writers:
+                    writer.close()
+            if max([self.partition_sizes.get(p, 0) for p in subpartition_paths]) >= partition_size:
+                # All records have the same key, splitting doesn't help.
+                num_subpartitions = 0
+                for p in subpartition_paths:
+                    self.spill_storage.remove_partition(get_partition_id('b', p))
+            else:
+                self.spill_storage.remove_partition(get_partition_id('b', partition_path))
+        self.subpartitions[partition_path] = num_subpartitions
+        return num_subpartitions
+
+
+    def load_partition(self, partition_path):
+        if partition_path == self.loaded_partition:
+            return
+        self.hash_map = defaultdict(list)
+        # Entries are loaded in the original order, so matches within a key group keep B record order.
+        for key, entry in self.read_partition_entries(partition_path):
+            self.hash_map[key].append(entry)
+        self.loaded_partition = partition_path
 
 
     def get_join_records(self, key):
         return self.hash_map[key]
 
 
-    def get_warnings(self):
-        return self.record_iterator.get_warnings()
+    def get_key_filter(self):
+        if self.bloom_filter is not None:
+            return self.bloom_filter
+        return self.raw_map if self.raw_map is not None else self.hash_map
+
+
+    def get_partitioned_join_records(self, key):
+        # GraceJoinInputIterator loads the partition of the current input record before returning it.
+        return self.hash_map.get(key, [])
+
+
+    def finish(self):
+        if self.spill_storage is not None:
+            self.spill_storage.finish()
+            self.spill_storage = None
+
+
+class GraceJoinInputIterator(object):
+    # Hash-partitions the input table A by the join key and then returns its records partition by partition, so that each partition of the join table B is loaded only once.
+    def __init__(self, input_iterator, join_map, lhs_join_var_expression):
+        self.input_iterator = input_iterator
+        self.join_map = join_map
+        self.spill_storage = join_map.spill_storage
+        self.get_key = eval('lambda record_a, NR: {}'.format(lhs_join_var_expression), {'safe_join_get': safe_join_get})
+        self.entries = None
+        self.source_record_number = 0
+        self.partition_ids = set()
+
+
+    def get_partition_index(self, NR, record_a, depth, num_partitions):
+        try:
+            return self.join_map.get_partition_index(self.get_key(record_a, NR), depth, num_partitions)
+        except InternalBadFieldError:
+            return 0 # The main loop will report the missing field for this record.
+
+
+    def write_partitions(self, entries, partition_paths):
+        depth = len(partition_paths[0]) - 1
+        partition_ids = [get_partition_id('a', p) for p in partition_paths]
+        self.partition_ids.update(partition_ids)
+        writers = [self.spill_storage.create_partition_writer(partition_id) for partition_id in partition_ids]
+        try:
+            for NR, record_a in entries:
+                writers[self.get_partition_index(NR, record_a, depth, len(writers))].write([NR, record_a])
+        finally:
+            for writer in writers:
+                writer.close()
+
+
+    def read_input_entries(self):
+        NR = 0
+        while True:
+            record_a = self.input_iterator.get_record()
+            if record_a is None:
+                break
+            NR += 1 + self.input_iterator.pop_num_skipped_records()
+            yield (NR, record_a)
+
+
+    def iterate_entries(self):
+        partition_paths = [(i,) for i in range(self.join_map.num_partitions)]
+        self.write_partitions(self.read_input_entries(), partition_paths)
+        pending_paths = list(reversed(partition_paths))
+        while len(pending_paths):
+            partition_path = pending_paths.pop()
+            partition_id = get_partition_id('a', partition_path)
+            num_subpartitions = self.join_map.get_num_subpartitions(partition_path)
+            if num_subpartitions:
+                subpartition_paths = [partition_path + (i,) for i in range(num_subpartitions)]
+                self.write_partitions(self.spill_storage.read_partition(partition_id), subpartition_paths)
+                pending_paths.extend(reversed(subpartition_paths))
+            else:
+                self.join_map.load_partition(partition_path)
+                for entry in self.spill_storage.read_partition(partition_id):
+                    yield entry
+            self.spill_storage.remove_partition(partition_id)
+            self.partition_ids.remove(partition_id)
+
+
+    def get_record(self):
+        if self.entries is None:
+            self.entries = self.iterate_entries()
+        entry = next(self.entries, None)
+        if entry is None:
+            return None
+        self.source_record_number, record = entry
+        return record
+
+
+    def get_source_record_number(self):
+        return self.source_record_number
+
+
+    def finish(self):
+        # Removes input partitions which were not consumed because of an error.
+        if self.entries is not None:
+            self.entries.close()
+            self.entries = None
+        for partition_id in self.partition_ids:
+            self.spill_storage.remove_partition(partition_id)
+        self.partition_ids = set()
+
+
+class KeySetJoinMap(JoinMapBase):
+    # Stores only keys of the join table, used by "SEMI JOIN" and "ANTI JOIN".
+    def __init__(self, record_iterator, key_indices):
+        super(KeySetJoinMap, self).__init__(record_iterator, key_indices)
+        self.key_set = set()
+
+
+    def build(self):
+        use_raw_records = self.record_iterator.supports_raw_records()
+        num_key_fields = max(self.key_indices if self.key_indices is not None else [self.key_index]) + 1
+        nr = 0
+        while True:
+            if use_raw_records:
+                raw_record_info = self.record_iterator.get_raw_record(num_key_fields)
+                fields = raw_record_info[1] if raw_record_info is not None else None
+            else:
+                fields = self.record_iterator.get_record()
+            if fields is None:
+                break
+            nr += 1
+            self.key_set.add(self.polymorphic_get_key(nr, fields))
+
+
+    def contains_key(self, key):
+        return key in self.key_set
+
+
+    def get_key_filter(self):
+        return self.key_set
+
+
+class MergeJoinMap(JoinMapBase):
+    # Streams the join table B together with the input table A, both tables must be sorted by the join key.
+    # Keys are compared as is, i.e. CSV fields are compared lexicographically. Only records of the current B key group are kept in memory.
+    single_pass = True
+
+    def __init__(self, record_iterator, key_indices, projection=None):
+        super(MergeJoinMap, self).__init__(record_iterator, key_indices, projection)
+        self.nr = 0
+        self.next_key = None
+        self.next_entry = None
+        self.has_lhs_key = False
+        self.lhs_key = None
+        self.current_group = []
+
+
+    def advance(self):
+        fields = self.record_iterator.get_record()
+        if fields is None:
+            self.next_entry = None
+            return
+        self.nr += 1
+        nf = len(fields)
+        self.max_record_len = max(self.max_record_len, nf)
+        key = self.polymorphic_get_key(self.nr, fields)
+        if self.next_entry is not None and key < self.next_key:
+            raise RbqlRuntimeError('Join table B is not sorted by the join key: key "{}" at record {} goes after key "{}"'.format(key, self.nr, self.next_key))
+        self.next_key = key
+        self.next_entry = self.make_entry(self.nr, fields)
+
+
+    def build(self):
+        # Only the first record is read ahead, so `max_record_len` is not final and LEFT JOIN null records can't be made by this map, see null_record_depends_on_join_table().
+        self.advance()
+
+
+    def get_join_records(self, key):
+        if self.has_lhs_key:
+            if key == self.lhs_key:
+                return self.current_group
+            if key < self.lhs_key:
+                raise RbqlRuntimeError('Input table A is not sorted by the join key: key "{}" goes after key "{}"'.format(key, self.lhs_key))
+        self.has_lhs_key = True
+        self.lhs_key = key
+        while self.next_entry is not None and self.next_key < key:
+            self.advance()
+        self.current_group = []
+        while self.next_entry is not None and self.next_key == key:
+            self.current_group.append(self.next_entry)
+            self.advance()
+        return self.current_group
+
+
+# Inner joins build the hash map on the input table A instead of the join table B if B is at least this many times larger than A.
+swapped_join_size_ratio = 2
+
+
+class SwappedJoinMap(JoinMapBase):
+    # Inner join plan for join tables which are much larger than the input table: the hash map is built on A records and B is streamed.
+    # Matches are produced in B order, so it is used only in ORDER BY queries which buffer the output anyway. (NR, bNR) tie breaker of the sort key restores the A-then-B order of records with equal sort keys, see SwappedJoinInputIterator.
+    single_pass = True
+
+    def __init__(self, record_iterator, key_indices, input_iterator, input_key_indices, projection=None):
+        super(SwappedJoinMap, self).__init__(record_iterator, key_indices, projection)
+        self.input_iterator = input_iterator
+        self.input_key_indices = input_key_indices
+        self.input_map = dict()
+        self.first_bad_input_entry = None
+        self.use_raw_join_records = record_iterator.supports_raw_records()
+        self.num_join_key_fields = max(key_indices) + 1
+        self.nr = 0
+        self.current_entries = []
+        self.pending_matches = []
+        self.pending_match_pos = 0
+
+
+    def get_input_key(self, fields):
+        if len(self.input_key_indices) == 1:
+            return fields[self.input_key_indices[0]]
+        return tuple([fields[i] for i in self.input_key_indices])
+
+
+    def build(self):
+        # Input entries are [NR, record, is_split] lists, raw input records are split only when they match.
+        use_raw_records = self.input_iterator.supports_raw_records()
+        num_key_fields = max(self.input_key_indices) + 1
+        nr = 0
+        while True:
+            if use_raw_records:
+                raw_record_info = self.input_iterator.get_raw_record(num_key_fields)
+                if raw_record_info is None:
+                    break
+                record, leading_fields, num_fields = raw_record_info
+                is_split = len(leading_fields) == num_fields
+                if is_split:
+                    record = leading_fields
+            else:
+                record = leading_fields = self.input_iterator.get_record()
+                if record is None:
+                    break
+                is_split = True
+            nr += 1
+            if num_key_fields > len(leading_fields):
+                # The main loop will report the missing field for this record.
+                if self.first_bad_input_entry is None:
+                    self.first_bad_input_entry = [nr, record, is_split]
+                continue
+            self.input_map.setdefault(self.get_input_key(leading_fields), []).append([nr, record, is_split])
+
+
+    def advance(self):
+        if self.use_raw_join_records:
+            raw_record_info = self.record_iterator.get_raw_record(self.num_join_key_fields)
+            if raw_record_info is None:
+                return False
+            raw_record, fields, num_fields = raw_record_info
+        else:
+            fields = self.record_iterator.get_record()
+            if fields is None:
+                return False
+            num_fields = len(fields)
+        self.nr += 1
+        self.max_record_len = max(self.max_record_len, num_fields)
+        input_entries = self.input_map.get(self.polymorphic_get_key(self.nr, fields))
+        if input_entries is None:
+            return True
+        if len(fields) != num_fields:
+            fields = self.record_iterator.split_raw_record(raw_record)
+        self.current_entries = [self.make_entry(self.nr, fields)]
+        self.pending_matches = input_entries
+        self.pending_match_pos = 0
+        return True
+
+
+    def get_next_match(self):
+        # Returns (NR, record_a) tuple for the next input record that matches the current join record or None at the end of the join table.
+        entry = self.first_bad_input_entry
+        if entry is not None:
+            self.first_bad_input_entry = None
+        else:
+            while self.pending_match_pos >= len(self.pending_matches):
+                if not self.advance():
+                    return None
+            entry = self.pending_matches[self.pending_match_pos]
+            self.pending_match_pos += 1
+        if not entry[2]:
+            entry[1] = self.input_iterator.split_raw_record(entry[1])
+            entry[2] = True
+        return (entry[0], entry[1])
+
+
+    def get_join_records(self, key):
+        return self.current_entries
+
+
+class SwappedJoinInputIterator(object):
+    # Returns records of the input table A in the order of their matches in the join table B, see SwappedJoinMap.
+    def __init__(self, join_map):
+        self.join_map = join_map
+        self.source_record_number = 0
+
+
+    def get_record(self):
+        match = self.join_map.get_next_match()
+        if match is None:
+            return None
+        self.source_record_number, record = match
+        return record
+
+
+    def get_source_record_number(self):
+        return self.source_record_number
+
+
+    def finish(self):
+        pass
+
+
+aggregate_function_call_rgx = r'(?i)(?:^|[^_a-zA-Z0-9.])(?:MIN|MAX|COUNT|SUM|AVG|VARIANCE|MEDIAN|ARRAY_AGG) *\('
+
+
+def get_swapped_join_input_key_indices(rb_actions, input_iterator, join_record_iterator, lhs_variables, rhs_indices):
+    # Returns key indices of the input table if the inner join should build the hash map on the input table, otherwise None.
+    if SELECT not in rb_actions or rb_actions[JOIN]['join_subtype'] not in [JOIN, INNER_JOIN] or GROUP_BY in rb_actions:
+        return None
+    if ORDER_BY not in rb_actions:
+        return None # Matches are produced in B order, restoring the input order would require buffering the whole output.
+    if re.search(aggregate_function_call_rgx, rb_actions[SELECT]['text']) is not None:
+        return None # Results of some aggregate functions e.g. ARRAY_AGG depend on the order of records.
+    if -1 in rhs_indices:
+        return None
+    input_key_indices = []
+    for lhs_variable in lhs_variables:
+        lhs_key_match = re.match(r'^safe_join_get\(record_a, ([0-9]+)\)$', lhs_variable)
+        if lhs_key_match is None:
+            return None
+        input_key_indices.append(int(lhs_key_match.group(1)))
+    input_size = input_iterator.get_table_size()
+    join_size = join_record_iterator.get_table_size()
+    if input_size is None or join_size is None or join_size <= swapped_join_size_ratio * input_size:
+        return None
+    return input_key_indices
 
 
 def cleanup_query(query_text):
@@ -1408,7 +2308,9 @@ def remove_redundant_input_table_name(query_text):
     return query_text
 
 
-def select_output_header(input_header, join_header, query_column_infos):
+def select_output_header(input_header, join_header, query_column_infos, extra_join_headers=None):
+    # `extra_join_headers` - list of headers of the additional join tables with "c", "d", ... aliases.
+    extra_join_headers = extra_join_headers or []
     if input_header is None:
         assert join_header is None
     query_has_star = False
@@ -1424,6 +2326,7 @@ def select_output_header(input_header, join_header, query_column_infos):
             return None
         input_header = []
         join_header = []
+        extra_join_headers = [[] for _ in extra_join_headers]
     if join_header is None:
         # This means that there is no join table.
         join_header = []
@@ -1434,10 +2337,14 @@ def select_output_header(input_header, join_header, query_column_infos):
         elif qci.is_star:
             if qci.table_name is None:
                 output_header += input_header + join_header
+                for extra_join_header in extra_join_headers:
+                    output_header += extra_join_header
             elif qci.table_name == 'a':
                 output_header += input_header
             elif qci.table_name == 'b':
                 output_header += join_header
+            elif table_aliases.index(qci.table_name) - 2 < len(extra_join_headers):
+                output_header += extra_join_headers[table_aliases.index(qci.table_name) - 2]
         elif qci.column_name is not None:
             output_header.append(qci.column_name)
         elif qci.alias_name is not None:
@@ -1447,6 +2354,8 @@ def select_output_header(input_header, join_header, query_column_infos):
                 output_header.append(input_header[qci.column_index])
             elif qci.table_name == 'b' and qci.column_index < len(join_header):
                 output_header.append(join_header[qci.column_index])
+            elif qci.table_name in extra_join_table_aliases and table_aliases.index(qci.table_name) - 2 < len(extra_join_headers) and qci.column_index < len(extra_join_headers[table_aliases.index(qci.table_name) - 2]):
+                output_header.append(extra_join_headers[table_aliases.index(qci.table_name) - 2][qci.column_index])
             else:
                 output_header.append('col{}'.format(len(output_header) + 1))
         else: # Should never happen
@@ -1454,6 +2363,487 @@ def select_output_header(input_header, join_header, query_column_infos):
     return output_header
 
 
+# Functions and string methods without side effects which are safe to evaluate once per record and reuse the result.
+# User-defined functions and non-deterministic modules like `random` should never be added here.
+pure_function_names = ['int', 'float', 'str', 'len', 'abs', 'round', 'bool']
+pure_method_names = ['lower', 'upper', 'strip', 'lstrip', 'rstrip', 'startswith', 'endswith', 'find', 'rfind', 'count', 'replace', 'title', 'capitalize', 'zfill', 'isdigit', 'isalpha', 'isalnum', 'isspace']
+
+# We need end_col_offset to cut subexpressions out of the original expression text.
+cse_supported = PY3 and sys.version_info >= (3, 8)
+
+
+def is_defined_in_init_code(name, user_init_code):
+    return re.search(r'(?:^|[^_a-zA-Z0-9]){}(?:$|[^_a-zA-Z0-9])'.format(name), user_init_code) is not None
+
+
+def get_pure_function_names(user_init_code):
+    # Builtins can be redefined in the init code.
+    return [f for f in pure_function_names if not is_defined_in_init_code(f, user_init_code)]
+
+
+def get_expression_segment(expression, node):
+    # AST offsets are in bytes of UTF-8 encoded text.
+    return expression.encode('utf-8')[node.col_offset:node.end_col_offset].decode('utf-8')
+
+
+def get_record_variable_name(node):
+    # Returns variable name as it would appear in variables map e.g. `a1`, `a.name`, `b["col name"]` or None if the node is not a record variable.
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id in table_aliases:
+        return '{}.{}'.format(node.value.id, node.attr)
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id in table_aliases:
+        slice_root = node.slice
+        if getattr(ast, 'Index', None) is not None and isinstance(slice_root, ast.Index):
+            slice_root = slice_root.value
+        if not isinstance(slice_root, ast.Constant):
+            return None
+        if is_str6(slice_root.value):
+            return '{}["{}"]'.format(node.value.id, python_string_escape_column_name(slice_root.value, '"'))
+        if isinstance(slice_root.value, int):
+            return '{}[{}]'.format(node.value.id, slice_root.value)
+    return None
+
+
+def is_pure_expression(node, record_variable_names, pure_functions):
+    # Pure expression depends only on record variables and literals and doesn't have side effects.
+    if isinstance(node, ast.Constant):
+        return True
+    variable_name = get_record_variable_name(node)
+    if variable_name is not None:
+        return variable_name in record_variable_names
+    if isinstance(node, ast.Call):
+        if any(not is_pure_expression(arg, record_variable_names, pure_functions) for arg in node.args):
+            return False
+        if any(kw.arg is None or not is_pure_expression(kw.value, record_variable_names, pure_functions) for kw in node.keywords):
+            return False
+        if isinstance(node.func, ast.Name):
+            return node.func.id in pure_functions
+        if isinstance(node.func, ast.Attribute):
+            return node.func.attr in pure_method_names and is_pure_expression(node.func.value, record_variable_names, pure_functions)
+        return False
+    if isinstance(node, (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Subscript, ast.Slice, ast.Tuple, ast.expr_context, ast.operator, ast.unaryop, ast.boolop, ast.cmpop)):
+        return all(is_pure_expression(child, record_variable_names, pure_functions) for child in ast.iter_child_nodes(node))
+    if getattr(ast, 'Index', None) is not None and isinstance(node, ast.Index):
+        return is_pure_expression(node.value, record_variable_names, pure_functions)
+    # Lists, dicts, lambdas, comprehensions, f-strings, etc.
+    return False
+
+
+def is_cse_candidate(node, record_variable_names, pure_functions):
+    if not isinstance(node, (ast.Call, ast.BinOp, ast.UnaryOp, ast.Compare, ast.IfExp, ast.Subscript)):
+        return False
+    if get_record_variable_name(node) is not None:
+        return False
+    if not is_pure_expression(node, record_variable_names, pure_functions):
+        return False
+    # Expressions without record variables are constant and are not worth caching.
+    return any(get_record_variable_name(n) in record_variable_names for n in ast.walk(node))
+
+
+def iterate_subexpressions(node, unconditional):
+    # Yields (subexpression, unconditional) pairs where `unconditional` means that the subexpression is always evaluated when the parent expression is evaluated.
+    yield (node, unconditional)
+    if isinstance(node, (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.JoinedStr)):
+        return
+    if isinstance(node, ast.BoolOp):
+        for i, value in enumerate(node.values):
+            for result in iterate_subexpressions(value, unconditional and i == 0):
+                yield result
+        return
+    if isinstance(node, ast.IfExp):
+        for result in iterate_subexpressions(node.test, unconditional):
+            yield result
+        for branch in [node.body, node.orelse]:
+            for result in iterate_subexpressions(branch, False):
+                yield result
+        return
+    if isinstance(node, ast.Compare):
+        # Chained comparisons short-circuit: `x < y < z` evaluates `z` only if `x < y` is true.
+        for i, operand in enumerate([node.left] + node.comparators):
+            for result in iterate_subexpressions(operand, unconditional and i <= 1):
+                yield result
+        return
+    for child in ast.iter_child_nodes(node):
+        for result in iterate_subexpressions(child, unconditional):
+            yield result
+
+
+def replace_subexpressions(expression, root, replacement_names, record_variable_names, pure_functions):
+    # Replaces the topmost occurrences of the subexpressions from `replacement_names` with the corresponding variable names, returns the new expression text and the list of used keys.
+    encoded_expression = expression.encode('utf-8')
+    replacements = []
+    used_keys = []
+    nodes_to_visit = [root]
+    while len(nodes_to_visit):
+        node = nodes_to_visit.pop()
+        if is_cse_candidate(node, record_variable_names, pure_functions):
+            key = ast.dump(node)
+            if key in replacement_names:
+                replacements.append((node.col_offset, node.end_col_offset, replacement_names[key]))
+                used_keys.append(key)
+                continue
+        if isinstance(node, (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp, ast.JoinedStr)):
+            continue
+        nodes_to_visit.extend(ast.iter_child_nodes(node))
+    for start, end, replacement in sorted(replacements, reverse=True):
+        encoded_expression = encoded_expression[:start] + replacement.encode('utf-8') + encoded_expression[end:]
+    return (encoded_expression.decode('utf-8'), used_keys)
+
+
+def eliminate_common_subexpressions(query_context, record_variable_names):
+    # Finds pure subexpressions which are repeated across WHERE, SELECT, ORDER BY and GROUP BY expressions and evaluates each of them only once per record.
+    # Subexpressions which are unconditionally evaluated by WHERE are computed before WHERE, others - after WHERE, but only if they are unconditionally evaluated by the post-WHERE expressions.
+    # Otherwise we could raise an exception for a record which the original query would skip, e.g. `WHERE a2.isdigit() and int(a2) > 10 ORDER BY int(a2)`.
+    # Returns the list of the new temporary variables.
+    if not cse_supported:
+        return []
+    pure_functions = get_pure_function_names(query_context.user_init_code)
+    post_where_attributes = ['select_expression', 'sort_key_expression', 'aggregation_key_expression']
+    parsed_expressions = dict()
+    for attribute in ['where_expression'] + post_where_attributes:
+        expression = getattr(query_context, attribute)
+        if expression is None:
+            continue
+        try:
+            parsed_expressions[attribute] = ast.parse(expression, mode='eval').body
+        except SyntaxError:
+            return [] # Let the main loop compilation report the syntax error.
+
+    num_occurrences = defaultdict(int)
+    num_post_where_occurrences = defaultdict(int)
+    unconditional_where_keys = set()
+    unconditional_post_where_keys = set()
+    key_to_source = dict()
+    for attribute, root in parsed_expressions.items():
+        for node, unconditional in iterate_subexpressions(root, True):
+            if not is_cse_candidate(node, record_variable_names, pure_functions):
+                continue
+            key = ast.dump(node)
+            num_occurrences[key] += 1
+            if attribute == 'where_expression':
+                if unconditional:
+                    unconditional_where_keys.add(key)
+            else:
+                num_post_where_occurrences[key] += 1
+                if unconditional:
+                    unconditional_post_where_keys.add(key)
+            if key not in key_to_source:
+                key_to_source[key] = get_expression_segment(getattr(query_context, attribute), node)
+
+    pre_where_keys = [k for k in unconditional_where_keys if num_occurrences[k] > 1]
+    post_where_keys = [k for k in unconditional_post_where_keys if k not in unconditional_where_keys and num_post_where_occurrences[k] > 1]
+    if not len(pre_where_keys) and not len(post_where_keys):
+        return []
+    replacement_names = dict()
+    for key in sorted(pre_where_keys) + sorted(post_where_keys):
+        replacement_names[key] = '__rbql_cse_var_{}'.format(len(replacement_names))
+    pre_where_names = {k: replacement_names[k] for k in pre_where_keys}
+
+    used_keys = set()
+    for attribute, root in parsed_expressions.items():
+        available_names = pre_where_names if attribute == 'where_expression' else replacement_names
+        new_expression, used = replace_subexpressions(getattr(query_context, attribute), root, available_names, record_variable_names, pure_functions)
+        setattr(query_context, attribute, new_expression)
+        used_keys.update(used)
+
+    ordered_keys = sorted(used_keys, key=lambda k: replacement_names[k])
+    pre_where_lines = ['{} = {}'.format(replacement_names[k], key_to_source[k]) for k in ordered_keys if k in pre_where_names]
+    post_where_lines = ['{} = {}'.format(replacement_names[k], key_to_source[k]) for k in ordered_keys if k not in pre_where_names]
+    query_context.pre_where_cse_code = '\n'.join(pre_where_lines) if len(pre_where_lines) else None
+    query_context.post_where_cse_code = '\n'.join(post_where_lines) if len(post_where_lines) else None
+    return [replacement_names[k] for k in ordered_keys]
+
+
+def get_required_literal(node, input_variables_map, user_init_code):
+    # Returns string literal which must be present in the field value if the predicate is true.
+    def is_input_variable(node):
+        return get_record_variable_name(node) in input_variables_map
+    def is_str_literal(node):
+        return isinstance(node, ast.Constant) and is_str6(node.value)
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+        lhs, op, rhs = node.left, node.ops[0], node.comparators[0]
+        if isinstance(op, ast.Eq) and is_input_variable(lhs) and is_str_literal(rhs):
+            return rhs.value
+        if isinstance(op, ast.Eq) and is_str_literal(lhs) and is_input_variable(rhs):
+            return lhs.value
+        if isinstance(op, ast.In) and is_str_literal(lhs) and is_input_variable(rhs):
+            return lhs.value
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ['LIKE', 'like'] and len(node.args) == 2 and not len(node.keywords):
+        if is_defined_in_init_code(node.func.id, user_init_code):
+            return None
+        if is_input_variable(node.args[0]) and is_str_literal(node.args[1]):
+            return max(re.split('[_%]', node.args[1].value), key=len)
+    return None
+
+
+def get_raw_line_prefilter(where_expression, input_variables_map, variable_types, user_init_code):
+    # A record can match `a3 == 'ERROR'` or `like(a5, '%timeout%')` only if its raw text contains the literal, so input iterators can skip other records without splitting them.
+    # Literals with double quotes are ignored because they can be escaped in the raw text.
+    # Skipping is allowed only if the whole WHERE expression can't raise an exception, otherwise e.g. `int(a2) > 10 and a3 == 'ERROR'` would silently skip records with invalid a2 values.
+    if not cse_supported or where_expression is None:
+        return None
+    try:
+        root = ast.parse(where_expression, mode='eval').body
+    except SyntaxError:
+        return None
+    if get_exception_free_type(root, variable_types, user_init_code) is None:
+        return None
+    conjuncts = root.values if isinstance(root, ast.BoolOp) and isinstance(root.op, ast.And) else [root]
+    required_substrings = []
+    for conjunct in conjuncts:
+        literal = get_required_literal(conjunct, input_variables_map, user_init_code)
+        if literal and literal.find('"') == -1 and literal not in required_substrings:
+            required_substrings.append(literal)
+    return required_substrings if len(required_substrings) else None
+
+
+def is_int_constant(node):
+    return isinstance(node, ast.Constant) and isinstance(node.value, int) and not isinstance(node.value, bool)
+
+
+def get_record_number_range(where_expression, variable_types, user_init_code):
+    # Returns (min_NR, max_NR) tuple for WHERE expressions like `NR > 1000 and NR <= 2000 and ...`, so input iterators can skip records outside of the range. Either bound can be None.
+    # Like with raw line prefilters, skipping is allowed only if the whole WHERE expression can't raise an exception.
+    if not cse_supported or where_expression is None:
+        return None
+    try:
+        root = ast.parse(where_expression, mode='eval').body
+    except SyntaxError:
+        return None
+    if get_exception_free_type(root, variable_types, user_init_code) is None:
+        return None
+    conjuncts = root.values if isinstance(root, ast.BoolOp) and isinstance(root.op, ast.And) else [root]
+    mirrored_ops = {ast.Gt: ast.Lt, ast.GtE: ast.LtE, ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Eq: ast.Eq}
+    min_record_number = None
+    max_record_number = None
+    for conjunct in conjuncts:
+        if not isinstance(conjunct, ast.Compare):
+            continue
+        operands = [conjunct.left] + conjunct.comparators
+        for i, op in enumerate(conjunct.ops):
+            lhs, rhs, op_type = operands[i], operands[i + 1], type(op)
+            if op_type not in mirrored_ops:
+                continue
+            if is_int_constant(lhs) and isinstance(rhs, ast.Name):
+                lhs, rhs, op_type = rhs, lhs, mirrored_ops[op_type]
+            if not isinstance(lhs, ast.Name) or lhs.id not in ['NR', 'aNR'] or not is_int_constant(rhs):
+                continue
+            lower_bound = {ast.Gt: rhs.value + 1, ast.GtE: rhs.value, ast.Eq: rhs.value}.get(op_type)
+            upper_bound = {ast.Lt: rhs.value - 1, ast.LtE: rhs.value, ast.Eq: rhs.value}.get(op_type)
+            if lower_bound is not None:
+                min_record_number = lower_bound if min_record_number is None else builtin_max(min_record_number, lower_bound)
+            if upper_bound is not None:
+                max_record_number = upper_bound if max_record_number is None else builtin_min(max_record_number, upper_bound)
+    if min_record_number is None and max_record_number is None:
+        return None
+    return (min_record_number, max_record_number)
+
+
+def get_field_constraints(where_expression, input_variables_map, variable_types, user_init_code):
+    # Returns (column_index, conversion, op, literal) tuples for WHERE conjuncts like `a1 >= '2026-10-01'`, `float(a.price) < 10` or `a.id in ('12', '15')`, so input iterators with min/max statistics or key indexes can skip records which can't match.
+    # Like with raw line prefilters, skipping is allowed only if the whole WHERE expression can't raise an exception. The only exception are int() and float() conversions of fields from the constraints: iterators must not skip records if they can't prove that these conversions succeed.
+    if not cse_supported or where_expression is None:
+        return None
+    try:
+        root = ast.parse(where_expression, mode='eval').body
+    except SyntaxError:
+        return None
+    def get_field_operand(node):
+        # Returns (column_index, conversion) tuple or None.
+        conversion = None
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ['int', 'float'] and len(node.args) == 1 and not len(node.keywords):
+            if is_defined_in_init_code(node.func.id, user_init_code):
+                return None
+            conversion, node = node.func.id, node.args[0]
+        variable_info = input_variables_map.get(get_record_variable_name(node))
+        return (variable_info.index, conversion) if variable_info is not None else None
+    def is_matching_literal(node, conversion):
+        if not isinstance(node, ast.Constant):
+            return False
+        if conversion is None:
+            return is_str6(node.value)
+        return isinstance(node.value, (int, float)) and not isinstance(node.value, bool)
+    op_names = {ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>='}
+    mirrored_ops = {'==': '==', '!=': '!=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+    conjuncts = root.values if isinstance(root, ast.BoolOp) and isinstance(root.op, ast.And) else [root]
+    field_constraints = []
+    for conjunct in conjuncts:
+        if not isinstance(conjunct, ast.Compare):
+            continue
+        operands = [conjunct.left] + conjunct.comparators
+        for i, op in enumerate(conjunct.ops):
+            lhs, rhs = operands[i], operands[i + 1]
+            if isinstance(op, ast.In) and isinstance(rhs, (ast.Tuple, ast.List, ast.Set)) and len(rhs.elts):
+                field_operand = get_field_operand(lhs)
+                if field_operand is not None and all(is_matching_literal(e, field_operand[1]) for e in rhs.elts):
+                    field_constraints.append((field_operand[0], field_operand[1], 'in', tuple(e.value for e in rhs.elts)))
+                continue
+            op_name = op_names.get(type(op))
+            if op_name is None:
+                continue
+            field_operand = get_field_operand(lhs)
+            if field_operand is None:
+                lhs, rhs, op_name = rhs, lhs, mirrored_ops[op_name]
+                field_operand = get_field_operand(lhs)
+            if field_operand is None or not is_matching_literal(rhs, field_operand[1]):
+                continue
+            field_constraints.append((field_operand[0], field_operand[1], op_name, rhs.value))
+    if not len(field_constraints):
+        return None
+    converted_columns = set([(column_index, conversion) for column_index, conversion, _, _ in field_constraints if conversion is not None])
+    proven_conversions = set()
+    for node in ast.walk(root):
+        field_operand = get_field_operand(node) if isinstance(node, ast.Call) else None
+        if field_operand is not None and field_operand in converted_columns:
+            proven_conversions.add((field_operand[1], get_record_variable_name(node.args[0])))
+    if get_exception_free_type(root, variable_types, user_init_code, proven_conversions) is None:
+        return None
+    return field_constraints
+
+
+exception_free_str_methods = {'lower': [], 'upper': [], 'strip': [], 'lstrip': [], 'rstrip': [], 'title': [], 'capitalize': [], 'isdigit': [], 'isalpha': [], 'isalnum': [], 'isspace': [], 'startswith': [['str', 'strs']], 'endswith': [['str', 'strs']], 'find': [['str']], 'rfind': [['str']], 'count': [['str']]}
+
+
+def get_exception_free_type(node, variable_types, user_init_code, proven_conversions=()):
+    # Returns type of the expression if its evaluation can't raise an exception, otherwise None.
+    # Types are "str", "num", "any", "strs" (literal collection of strings) and "literals" (literal collection of other constants).
+    # `variable_types` maps record variable names to their types, input fields are "str" because they are present in records which have all of the fields referenced by the query.
+    # `proven_conversions` - (conversion, variable_name) tuples e.g. ("int", "a2"), the caller guarantees that these conversions succeed.
+    def get_type(node):
+        return get_exception_free_type(node, variable_types, user_init_code, proven_conversions)
+    if isinstance(node, ast.Constant):
+        if is_str6(node.value):
+            return 'str'
+        if isinstance(node.value, (int, float)):
+            return 'num'
+        return 'any' if node.value is None else None
+    variable_name = get_record_variable_name(node)
+    if variable_name is not None:
+        return variable_types.get(variable_name)
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        if not all(isinstance(e, ast.Constant) for e in node.elts):
+            return None
+        return 'strs' if all(is_str6(e.value) for e in node.elts) else 'literals'
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return 'num' if get_type(node.operand) is not None else None
+    if isinstance(node, ast.BoolOp):
+        value_types = [get_type(v) for v in node.values]
+        if None in value_types:
+            return None
+        return value_types[0] if len(set(value_types)) == 1 else 'any'
+    if isinstance(node, ast.Compare):
+        operand_types = [get_type(n) for n in [node.left] + node.comparators]
+        if None in operand_types:
+            return None
+        for op, lhs_type, rhs_type in zip(node.ops, operand_types[:-1], operand_types[1:]):
+            if isinstance(op, (ast.Eq, ast.NotEq, ast.Is, ast.IsNot)):
+                continue
+            if isinstance(op, (ast.In, ast.NotIn)) and (rhs_type in ['strs', 'literals'] or lhs_type == rhs_type == 'str'):
+                continue
+            if isinstance(op, (ast.Lt, ast.LtE, ast.Gt, ast.GtE)) and lhs_type == rhs_type and lhs_type in ['str', 'num']:
+                continue
+            return None
+        return 'num'
+    if isinstance(node, ast.Call) and not len(node.keywords):
+        arg_types = [get_type(arg) for arg in node.args]
+        if isinstance(node.func, ast.Name) and not is_defined_in_init_code(node.func.id, user_init_code):
+            if node.func.id == 'len' and arg_types == ['str']:
+                return 'num'
+            if node.func.id in ['LIKE', 'like'] and arg_types == ['str', 'str'] and isinstance(node.args[1], ast.Constant):
+                return 'num'
+            if len(node.args) == 1 and (node.func.id, get_record_variable_name(node.args[0])) in proven_conversions:
+                return 'num'
+        if isinstance(node.func, ast.Attribute) and node.func.attr in exception_free_str_methods and get_type(node.func.value) == 'str':
+            arg_options = exception_free_str_methods[node.func.attr]
+            if len(arg_types) == len(arg_options) and all(t in options for t, options in zip(arg_types, arg_options)):
+                return 'num' if node.func.attr not in ['lower', 'upper', 'strip', 'lstrip', 'rstrip', 'title', 'capitalize'] else 'str'
+    return None
+
+
+def get_record_variable_types(record_variable_names, input_variables_map):
+    variable_types = {name: 'any' for name in record_variable_names}
+    variable_types.update({name: 'str' for name in input_variables_map})
+    variable_types.update({'NR': 'num', 'NF': 'num', 'aNR': 'num', 'a.NR': 'num'})
+    return variable_types
+
+
+def get_required_num_fields(input_variables_map):
+    return builtin_max([v.index + 1 for v in input_variables_map.values()] + [0])
+
+
+def split_where_conjuncts(query_context, record_variable_names, input_variables_map):
+    # Enables adaptive evaluation of WHERE expressions like `like(a7, '%x%') and a2 == 'US'` by splitting them into top-level "and" conjuncts.
+    # Conjuncts can be safely reordered only if they don't have side effects and can't raise exceptions, and reordering makes sense only if some of them involve function calls.
+    if not cse_supported or query_context.where_expression is None:
+        return
+    try:
+        root = ast.parse(query_context.where_expression, mode='eval').body
+    except SyntaxError:
+        return
+    if not isinstance(root, ast.BoolOp) or not isinstance(root.op, ast.And):
+        return
+    pure_functions = get_pure_function_names(query_context.user_init_code) + ['LIKE', 'like']
+    for conjunct in root.values:
+        if not is_pure_expression(conjunct, record_variable_names, pure_functions):
+            return
+    if not any(isinstance(node, ast.Call) for node in ast.walk(root)):
+        return
+    variable_types = get_record_variable_types(record_variable_names, input_variables_map)
+    reorderable = [get_exception_free_type(conjunct, variable_types, query_context.user_init_code) is not None for conjunct in root.values]
+    if not any(reorderable[i] and reorderable[i + 1] for i in range(len(reorderable) - 1)):
+        return
+    query_context.where_conjuncts = [(get_expression_segment(query_context.where_expression, conjunct), is_reorderable) for conjunct, is_reorderable in zip(root.values, reorderable)]
+
+
+def ensure_consistent_join_header(input_header, join_header):
+    if input_header is None and join_header is not None:
+        raise RbqlIOHandlingError('Inconsistent modes: Input table doesn\'t have a header while the Join table has a header')
+    if input_header is not None and join_header is None:
+        raise RbqlIOHandlingError('Inconsistent modes: Input table has a header while the Join table doesn\'t have a header')
+
+
+def null_record_depends_on_join_table(joiner_type, join_projection, format_expression):
+    # LEFT JOIN null records have as many fields as the longest B record (unless B is projected) and their bNF is the length of that record, so they are known only after the whole B table is read.
+    if joiner_type is not LeftJoiner:
+        return False
+    return join_projection is None or re.search(r'(?:^|[^_a-zA-Z0-9.])bNF(?:$|[^_a-zA-Z0-9])', format_expression) is not None
+
+
+def get_join_projection(rb_actions, join_alias, join_variables_map):
+    # Returns (projection, variables_map) tuple, variables in the returned map are indexed by their position in the projected join record.
+    if SELECT in rb_actions and re.search(r'(?:^|,) *(?:\*|{}\.\*) *(?=$|,)'.format(join_alias), rb_actions[SELECT]['text']) is not None:
+        return (None, join_variables_map)
+    # Without star expressions the query can access only join table fields from the join variables map, so the join map can store just these fields.
+    join_projection = sorted(set([info.index for info in join_variables_map.values()]))
+    projected_variables_map = dict()
+    for var_name, var_info in join_variables_map.items():
+        projected_variables_map[var_name] = VariableInfo(initialize=var_info.initialize, index=join_projection.index(var_info.index))
+    return (join_projection, projected_variables_map)
+
+
+def parse_extra_join(join_action, join_alias, query_text, rb_actions, input_variables_map, input_header, tables_registry, query_modifiers, string_literals):
+    # Additional join tables are always loaded into in-memory hash maps (unless the registry provides its own join map) and probed in nested loops of the main loop.
+    rhs_table_id, variable_pairs = parse_join_expression(join_action['text'])
+    join_record_iterator = tables_registry.get_iterator_by_table_id(rhs_table_id, join_alias)
+    if join_record_iterator is None:
+        raise RbqlParsingError('Unable to find join table: "{}"'.format(rhs_table_id))
+    for modifier in query_modifiers:
+        join_record_iterator.handle_query_modifier(modifier)
+    join_variables_map = join_record_iterator.get_variables_map(query_text)
+    join_header = join_record_iterator.get_header()
+    ensure_consistent_join_header(input_header, join_header)
+    lhs_variables, rhs_indices = resolve_join_variables(input_variables_map, join_variables_map, variable_pairs, string_literals, join_alias)
+    join_projection, join_variables_map = get_join_projection(rb_actions, join_alias, join_variables_map)
+    join_map_impl = tables_registry.create_join_map(join_record_iterator, rhs_indices, join_projection)
+    if join_map_impl is None:
+        join_map_impl = HashJoinMap(join_record_iterator, rhs_indices, projection=join_projection)
+        join_map_impl.build()
+    joiner_type = {JOIN: InnerJoiner, INNER_JOIN: InnerJoiner, LEFT_OUTER_JOIN: LeftJoiner, LEFT_JOIN: LeftJoiner, STRICT_LEFT_JOIN: StrictLeftJoiner}[join_action['join_subtype']]
+    lhs_join_var_expression = lhs_variables[0] if len(lhs_variables) == 1 else '({})'.format(', '.join(lhs_variables))
+    return (joiner_type(join_map_impl), lhs_join_var_expression, join_variables_map, join_header)
+
+
 def shallow_parse_input_query(query_text, input_iterator, tables_registry, query_context):
     query_text = cleanup_query(query_text)
     format_expression, string_literals = separate_string_literals(query_text)
@@ -1478,7 +2868,9 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
         raise RbqlParsingError('Queries without context-based input table must contain "FROM" statement')
 
     if WITH in rb_actions:
-        input_iterator.handle_query_modifier(rb_actions[WITH])
+        query_context.query_modifiers = rb_actions[WITH]
+        for modifier in rb_actions[WITH]:
+            input_iterator.handle_query_modifier(modifier)
     input_variables_map = input_iterator.get_variables_map(query_text)
 
     if ORDER_BY in rb_actions and UPDATE in rb_actions:
@@ -1491,33 +2883,83 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
 
 
     input_header = input_iterator.get_header()
+    query_context.input_header = input_header
     join_variables_map = None
     join_header = None
+    extra_join_variables_maps = []
+    extra_join_headers = []
     if JOIN in rb_actions:
         rhs_table_id, variable_pairs = parse_join_expression(rb_actions[JOIN]['text'])
         if tables_registry is None:
             raise RbqlParsingError('JOIN operations are not supported by the application') # UT JSON
+        extra_join_actions = rb_actions[JOIN]['extra_joins']
+        if len(extra_join_actions):
+            if UPDATE in rb_actions:
+                raise RbqlParsingError('Multiple JOIN statements are not allowed in UPDATE queries')
+            if len(extra_join_actions) > len(extra_join_table_aliases):
+                raise RbqlParsingError('Query can not have more than {} JOIN statements'.format(len(extra_join_table_aliases) + 1))
+            if any([action['join_subtype'] in [SEMI_JOIN, ANTI_JOIN] for action in [rb_actions[JOIN]] + extra_join_actions]):
+                raise RbqlParsingError('"{}" and "{}" can not be used together with other JOIN statements'.format(SEMI_JOIN, ANTI_JOIN))
         join_record_iterator = tables_registry.get_iterator_by_table_id(rhs_table_id, 'b')
         if join_record_iterator is None:
             raise RbqlParsingError('Unable to find join table: "{}"'.format(rhs_table_id)) # UT JSON CSV
         if WITH in rb_actions:
-            join_record_iterator.handle_query_modifier(rb_actions[WITH])
+            for modifier in rb_actions[WITH]:
+                join_record_iterator.handle_query_modifier(modifier)
         join_variables_map = join_record_iterator.get_variables_map(query_text)
         join_header = join_record_iterator.get_header()
-        if input_header is None and join_header is not None:
-            raise RbqlIOHandlingError('Inconsistent modes: Input table doesn\'t have a header while the Join table has a header')
-        if input_header is not None and join_header is None:
-            raise RbqlIOHandlingError('Inconsistent modes: Input table has a header while the Join table doesn\'t have a header')
+        ensure_consistent_join_header(input_header, join_header)
 
         # TODO check ambiguous column names here instead of external check.
         lhs_variables, rhs_indices = resolve_join_variables(input_variables_map, join_variables_map, variable_pairs, string_literals)
-        joiner_type = {JOIN: InnerJoiner, INNER_JOIN: InnerJoiner, LEFT_OUTER_JOIN: LeftJoiner, LEFT_JOIN: LeftJoiner, STRICT_LEFT_JOIN: StrictLeftJoiner}[rb_actions[JOIN]['join_subtype']]
+        join_subtype = rb_actions[JOIN]['join_subtype']
+        is_key_only_join = join_subtype in [SEMI_JOIN, ANTI_JOIN]
+        if is_key_only_join:
+            query_without_join = format_expression.replace(rb_actions[JOIN]['text'], ' ')
+            if re.search(r'(?:^|[^_a-zA-Z0-9.])(?:b[0-9]|b\.|b\[|bNR|bNF)', query_without_join) is not None:
+                raise RbqlParsingError('Join table "B" variables can only be used in "ON" expression of "{}" queries'.format(join_subtype))
+            # B variables are not available, so the output header and star expressions include only "A" fields.
+            join_variables_map = dict()
+            join_header = None
+        join_projection, join_variables_map = get_join_projection(rb_actions, 'b', join_variables_map)
+        joiner_type = {JOIN: InnerJoiner, INNER_JOIN: InnerJoiner, LEFT_OUTER_JOIN: LeftJoiner, LEFT_JOIN: LeftJoiner, STRICT_LEFT_JOIN: StrictLeftJoiner, SEMI_JOIN: SemiJoiner, ANTI_JOIN: AntiJoiner}[join_subtype]
         query_context.lhs_join_var_expression = lhs_variables[0] if len(lhs_variables) == 1 else '({})'.format(', '.join(lhs_variables))
-        query_context.join_map_impl = HashJoinMap(join_record_iterator, rhs_indices)
-        query_context.join_map_impl.build()
+        if is_key_only_join:
+            query_context.join_map_impl = KeySetJoinMap(join_record_iterator, rhs_indices)
+            query_context.join_map_impl.build()
+        # `WITH (sorted)` declares that both tables are sorted by the join key. Tables joined by record numbers (`NR == bNR`) are always sorted.
+        # Merge join consumes the join table, so prepared queries which can be executed multiple times use the hash map instead.
+        elif query_context.single_execution and ('sorted' in query_context.query_modifiers or (lhs_variables == ['NR'] and rhs_indices == [-1])) and not null_record_depends_on_join_table(joiner_type, join_projection, format_expression):
+            query_context.join_map_impl = MergeJoinMap(join_record_iterator, rhs_indices, join_projection)
+            query_context.join_map_impl.build()
+        else:
+            query_context.join_map_impl = tables_registry.create_join_map(join_record_iterator, rhs_indices, join_projection)
+            swapped_join_input_key_indices = None
+            if query_context.join_map_impl is None and query_context.single_execution:
+                swapped_join_input_key_indices = get_swapped_join_input_key_indices(rb_actions, input_iterator, join_record_iterator, lhs_variables, rhs_indices)
+            if swapped_join_input_key_indices is not None:
+                query_context.join_map_impl = SwappedJoinMap(join_record_iterator, rhs_indices, input_iterator, swapped_join_input_key_indices, join_projection)
+                query_context.join_map_impl.build()
+            elif query_context.join_map_impl is None:
+                # UPDATE queries must preserve the input order, so they can't use partitioned join.
+                memory_budget = query_context.join_memory_budget if SELECT in rb_actions else None
+                spill_storage = tables_registry.create_spill_storage() if memory_budget is not None else None
+                query_context.join_map_impl = HashJoinMap(join_record_iterator, rhs_indices, memory_budget, join_projection, spill_storage)
+                query_context.join_map_impl.build()
         query_context.join_map = joiner_type(query_context.join_map_impl)
+        if SELECT in rb_actions and join_subtype in [JOIN, INNER_JOIN, SEMI_JOIN] and len(lhs_variables) == 1 and not is_swapped_join(query_context):
+            # Input records without matches don't produce any output in these joins, so the input iterator can skip them after extracting just the key field.
+            lhs_key_match = re.match(r'^safe_join_get\(record_a, ([0-9]+)\)$', lhs_variables[0])
+            if lhs_key_match is not None:
+                query_context.join_key_prefilter_index = int(lhs_key_match.group(1))
+        for join_alias, extra_join_action in zip(extra_join_table_aliases, extra_join_actions):
+            extra_join_map, extra_lhs_join_var_expression, extra_join_variables_map, extra_join_header = parse_extra_join(extra_join_action, join_alias, query_text, rb_actions, input_variables_map, input_header, tables_registry, query_context.query_modifiers, string_literals)
+            query_context.extra_join_maps.append(extra_join_map)
+            query_context.extra_lhs_join_var_expressions.append(extra_lhs_join_var_expression)
+            extra_join_variables_maps.append(extra_join_variables_map)
+            extra_join_headers.append(extra_join_header)
 
-    query_context.variables_init_code = combine_string_literals(generate_init_statements(format_expression, input_variables_map, join_variables_map), string_literals)
+    query_context.variables_init_code = combine_string_literals(generate_init_statements(format_expression, input_variables_map, join_variables_map, extra_join_variables_maps), string_literals)
 
 
     if WHERE in rb_actions:
@@ -1530,7 +2972,7 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
     if UPDATE in rb_actions:
         update_expression = translate_update_expression(rb_actions[UPDATE]['text'], input_variables_map, string_literals)
         query_context.update_expressions = combine_string_literals(update_expression, string_literals)
-        query_context.writer.set_header(input_header)
+        query_context.output_header = input_header
 
 
     if SELECT in rb_actions:
@@ -1546,20 +2988,41 @@ def shallow_parse_input_query(query_text, input_iterator, tables_registry, query
             # We need to add string literals back in order to have relevant errors in case of exceptions during parsing
             combined_select_expression_for_ast = combine_string_literals(select_expression_for_ast, string_literals)
             column_infos = ast_parse_select_expression_to_column_infos(combined_select_expression_for_ast)
-            output_header = select_output_header(input_header, join_header, column_infos)
+            output_header = select_output_header(input_header, join_header, column_infos, extra_join_headers)
         query_context.select_expression = select_expression
-        query_context.writer.set_header(output_header)
+        query_context.output_header = output_header
 
-        if query_context.top_count is not None:
-            query_context.writer = TopWriter(query_context.writer, query_context.top_count)
         if 'distinct_count' in rb_actions[SELECT]:
-            query_context.writer = UniqCountWriter(query_context.writer)
+            query_context.distinct_mode = 'distinct_count'
         elif 'distinct' in rb_actions[SELECT]:
-            query_context.writer = UniqWriter(query_context.writer)
+            query_context.distinct_mode = 'distinct'
 
     if ORDER_BY in rb_actions:
         query_context.sort_key_expression = '({})'.format(combine_string_literals(rb_actions[ORDER_BY]['text'], string_literals))
-        query_context.writer = SortedWriter(query_context.writer, reverse_sort=rb_actions[ORDER_BY]['reverse'])
+        query_context.reverse_sort = rb_actions[ORDER_BY]['reverse']
+
+    if is_swapped_join(query_context):
+        # Swapped joins are used only in ORDER BY queries. Sorting is stable, so (NR, bNR) tie breaker gives exactly the same output as the join with the hash map on B, also with "DESC" order.
+        query_context.sort_key_expression = '({}, NR, bNR)'.format(combine_string_literals(rb_actions[ORDER_BY]['text'], string_literals))
+
+    query_context.required_num_fields = get_required_num_fields(input_variables_map)
+    record_variable_names = set(['NR', 'NF', 'aNR', 'a.NR', 'bNR', 'bNF', 'b.NR'])
+    record_variable_names.update(input_variables_map.keys())
+    if join_variables_map is not None:
+        record_variable_names.update(join_variables_map.keys())
+    for join_alias, extra_join_variables_map in zip(extra_join_table_aliases, extra_join_variables_maps):
+        record_variable_names.update(['{}NR'.format(join_alias), '{}NF'.format(join_alias), '{}.NR'.format(join_alias)])
+        record_variable_names.update(extra_join_variables_map.keys())
+
+    if SELECT in rb_actions and not is_swapped_join(query_context):
+        variable_types = get_record_variable_types(record_variable_names, input_variables_map)
+        query_context.raw_line_prefilter = get_raw_line_prefilter(query_context.where_expression, input_variables_map, variable_types, query_context.user_init_code)
+        query_context.record_number_range = get_record_number_range(query_context.where_expression, variable_types, query_context.user_init_code)
+        query_context.field_constraints = get_field_constraints(query_context.where_expression, input_variables_map, variable_types, query_context.user_init_code)
+
+    if SELECT in rb_actions:
+        record_variable_names.update(eliminate_common_subexpressions(query_context, record_variable_names))
+    split_where_conjuncts(query_context, record_variable_names, input_variables_map)
 
 
 def make_inconsistent_num_fields_warning(table_name, inconsistent_records_info):
@@ -1573,15 +3036,273 @@ def make_inconsistent_num_fields_warning(table_name, inconsistent_records_info):
     return warn_msg
 
 
-def query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None):
-    query_context = RBQLContext(input_iterator, output_writer, user_init_code)
-    shallow_parse_input_query(query_text, input_iterator, join_tables_registry, query_context)
-    compile_and_run(query_context, user_namespace)
+def init_writer_chain(query_context, output_writer):
+    output_writer.set_header(query_context.output_header)
+    query_context.writer = output_writer
+    if query_context.top_count is not None:
+        query_context.writer = TopWriter(query_context.writer, query_context.top_count)
+    if query_context.distinct_mode == 'distinct_count':
+        query_context.writer = UniqCountWriter(query_context.writer)
+    elif query_context.distinct_mode == 'distinct':
+        query_context.writer = UniqWriter(query_context.writer)
+    if query_context.sort_key_expression is not None:
+        query_context.writer = SortedWriter(query_context.writer, reverse_sort=query_context.reverse_sort)
+
+
+def write_intermediate_results(query_context, output_writer):
+    # Returns False if the query doesn't need more input records.
+    if isinstance(query_context.writer, AggregateWriter) and not query_context.writer.is_snapshot_current:
+        if query_context.writer.num_snapshots > 0:
+            output_writer.write_snapshot_separator()
+        query_context.writer.write_snapshot()
+    output_writer.flush()
+    if isinstance(query_context.writer, TopWriter) and query_context.writer.NW >= query_context.writer.top_count:
+        return False
+    return True
+
+
+class RBQLPreparedQuery:
+    # Parsed and compiled query which can be executed multiple times against different input tables with the same structure.
+    def __init__(self, query_context, compiled_main_loop):
+        self.query_context = query_context
+        self.compiled_main_loop = compiled_main_loop
+        self.num_executions = 0
+
+    def get_output_header(self):
+        return self.query_context.output_header
+
+    def is_aggregate_query(self):
+        # Aggregate functions are detected only during execution, so this check is based on the query text.
+        query_context = self.query_context
+        if query_context.select_expression is None:
+            return False
+        return query_context.aggregation_key_expression is not None or re.search(aggregate_function_call_rgx, query_context.select_expression) is not None
+
+    def execute(self, input_iterator, output_writer, output_warnings, user_namespace=None, aggregation_state=None):
+        # `input_iterator` can be None to use the input table which was used to prepare the query.
+        # `aggregation_state` - AggregationState of the previous execution of the aggregate query to continue from, it is updated when the execution finishes.
+        prepared_context = self.query_context
+        if prepared_context.join_map_impl is not None and prepared_context.join_map_impl.single_pass and self.num_executions > 0:
+            raise RbqlIOHandlingError('Queries with streaming JOIN ("WITH (sorted)" or "NR == bNR") can be executed only once')
+        self.num_executions += 1
+        if input_iterator is None:
+            input_iterator = prepared_context.input_iterator
+        elif input_iterator is not prepared_context.input_iterator:
+            for modifier in prepared_context.query_modifiers:
+                input_iterator.handle_query_modifier(modifier)
+            if input_iterator.get_header() != prepared_context.input_header:
+                raise RbqlIOHandlingError('Header of the input table doesn\'t match the header of the table which was used to prepare the query')
+        query_context = RBQLContext(input_iterator, output_writer, prepared_context.user_init_code)
+        for attribute in prepared_query_context_attributes:
+            setattr(query_context, attribute, getattr(prepared_context, attribute))
+        init_writer_chain(query_context, output_writer)
+        if aggregation_state is not None:
+            query_context.initial_record_number = aggregation_state.num_records
+            if aggregation_state.aggregators is not None:
+                query_context.writer = AggregateWriter(query_context.writer)
+                query_context.writer.aggregators = aggregation_state.aggregators
+                query_context.writer.aggregation_keys = aggregation_state.aggregation_keys
+                query_context.aggregation_stage = 2
+        input_iterator.set_required_num_fields(query_context.required_num_fields)
+        if query_context.raw_line_prefilter is not None:
+            input_iterator.set_raw_line_prefilter(query_context.raw_line_prefilter)
+        if query_context.record_number_range is not None:
+            input_iterator.set_record_number_range(*query_context.record_number_range)
+        if query_context.field_constraints is not None:
+            input_iterator.set_field_constraints(query_context.field_constraints)
+        if query_context.join_key_prefilter_index is not None:
+            key_filter = query_context.join_map_impl.get_key_filter()
+            if key_filter is not None:
+                input_iterator.set_join_key_prefilter(query_context.join_key_prefilter_index, key_filter)
+        input_iterator.set_idle_callback(lambda: write_intermediate_results(query_context, output_writer))
+        if is_partitioned_join(query_context):
+            query_context.input_iterator = GraceJoinInputIterator(input_iterator, query_context.join_map_impl, query_context.lhs_join_var_expression)
+        elif is_swapped_join(query_context):
+            query_context.input_iterator = SwappedJoinInputIterator(query_context.join_map_impl)
+        try:
+            compile_and_run(query_context, user_namespace, compiled_main_loop=self.compiled_main_loop)
+        finally:
+            if query_context.input_iterator is not input_iterator:
+                query_context.input_iterator.finish()
+        if aggregation_state is not None:
+            aggregation_state.num_records = query_context.final_record_number
+            if isinstance(query_context.writer, AggregateWriter):
+                aggregation_state.aggregators = query_context.writer.aggregators
+                aggregation_state.aggregation_keys = query_context.writer.aggregation_keys
+        if isinstance(query_context.writer, AggregateWriter) and query_context.writer.num_snapshots > 0 and not query_context.writer.is_snapshot_current:
+            output_writer.write_snapshot_separator()
+        query_context.writer.finish()
+        output_warnings.extend(input_iterator.get_warnings())
+        if query_context.join_map_impl is not None:
+            output_warnings.extend(query_context.join_map_impl.get_warnings())
+        for extra_join_map in query_context.extra_join_maps:
+            output_warnings.extend(extra_join_map.join_map.get_warnings())
+        output_warnings.extend(output_writer.get_warnings())
+
+    def start_shared_scan(self, output_writer, user_namespace=None):
+        # Returns the query context with the main loop generator which should receive records of the input table which was used to prepare the query, see query_shared_scan()
+        prepared_context = self.query_context
+        if prepared_context.join_map_impl is not None and prepared_context.join_map_impl.single_pass and self.num_executions > 0:
+            raise RbqlIOHandlingError('Queries with streaming JOIN ("WITH (sorted)" or "NR == bNR") can be executed only once')
+        self.num_executions += 1
+        query_context = RBQLContext(prepared_context.input_iterator, output_writer, prepared_context.user_init_code)
+        for attribute in prepared_query_context_attributes:
+            setattr(query_context, attribute, getattr(prepared_context, attribute))
+        init_writer_chain(query_context, output_writer)
+        compile_and_run(query_context, user_namespace, compiled_main_loop=compile_main_loop(prepared_context, shared_scan=True))
+        next(query_context.main_loop_generator) # Run the init code and wait for the first record.
+        return query_context
+
+    def finish(self):
+        # Removes temporary files of the partitioned join.
+        if is_partitioned_join(self.query_context):
+            self.query_context.join_map_impl.finish()
+
+
+def prepare(query_text, input_iterator, join_tables_registry=None, user_init_code='', join_memory_budget=None, single_execution=False):
+    # Parse and compile the query once to execute it against multiple input tables, e.g. against daily partitions of the same table.
+    # `input_iterator` provides table structure (header and number of fields), it can also be None if the query has "FROM" statement.
+    # `join_memory_budget` - approximate memory limit in bytes for the join table, larger join tables are processed with partitioned join which doesn't preserve the input order.
+    # `single_execution` - set to True if the query will be executed only once with the same `input_iterator`, this allows inner joins to read the input table during preparation and build the hash map on it if the join table is much larger.
+    if re.match(common_table_expression_rgx, query_text) is not None:
+        raise RbqlParsingError('Common table expressions ("WITH name AS (...)") can only be used with non-prepared queries') # UT JSON
+    query_context = RBQLContext(input_iterator, None, user_init_code)
+    query_context.join_memory_budget = join_memory_budget
+    query_context.single_execution = single_execution
+    try:
+        shallow_parse_input_query(query_text, input_iterator, join_tables_registry, query_context)
+        compiled_main_loop = compile_main_loop(query_context)
+    except Exception:
+        if is_partitioned_join(query_context):
+            query_context.join_map_impl.finish()
+        raise
+    return RBQLPreparedQuery(query_context, compiled_main_loop)
+
+
+def query(query_text, input_iterator, output_writer, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None, join_memory_budget=None):
+    common_table_expressions, main_query_text = split_common_table_expressions(query_text)
+    if len(common_table_expressions):
+        query_with_common_table_expressions(common_table_expressions, main_query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace, join_memory_budget)
+        return
+    prepared_query = prepare(query_text, input_iterator, join_tables_registry, user_init_code, join_memory_budget, single_execution=True)
+    try:
+        prepared_query.execute(None, output_writer, output_warnings, user_namespace)
+    finally:
+        prepared_query.finish()
+
+
+def iter_query(query_text, input_iterator, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None):
+    # Returns (output_header, output_records) tuple. The query is parsed immediately, but executed only while `output_records` generator is consumed: output records are yielded as soon as they are produced, so large results don't have to fit in memory.
+    # Queries with ORDER BY, DISTINCT or aggregate functions still keep their results in memory until all input records are processed. `output_warnings` are added when the generator is exhausted.
+    # Resources of the query are released when `output_records` is exhausted, closed or garbage collected, see OutputRecordsIterator.
+    prepared_query = prepare(query_text, input_iterator, join_tables_registry, user_init_code)
+    return (prepared_query.get_output_header(), OutputRecordsIterator(iterate_output_records(prepared_query, output_warnings, user_namespace), prepared_query.finish))
+
+
+class OutputRecordsIterator(object):
+    # Generator-like iterator which calls `release_resources` exactly once: when the records are exhausted, an error is raised, close() is called or the iterator is garbage collected.
+    # Unlike a plain generator it releases the resources even if it was closed or dropped before the first record was requested.
+    def __init__(self, output_records, release_resources):
+        self.output_records = output_records
+        self.release_resources = release_resources
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.output_records is None:
+            raise StopIteration()
+        try:
+            return next(self.output_records)
+        except BaseException:
+            self.close()
+            raise
+
+    next = __next__ # Python 2
+
+    def close(self):
+        if self.output_records is None:
+            return
+        output_records = self.output_records
+        self.output_records = None
+        try:
+            output_records.close()
+        finally:
+            self.release_resources()
+
+    def __del__(self):
+        self.close()
+
+
+def iterate_output_records(prepared_query, output_warnings, user_namespace):
+    output_records = []
+    output_writer = TableWriter(output_records)
+    query_context = prepared_query.start_shared_scan(output_writer, user_namespace)
+    input_iterator = query_context.input_iterator
+    while True:
+        try:
+            query_context.main_loop_generator.send(input_iterator.get_record())
+        except StopIteration:
+            break
+        if len(output_records):
+            for record in output_records:
+                yield record
+            del output_records[:]
     query_context.writer.finish()
-    output_warnings.extend(query_context.input_iterator.get_warnings())
+    for record in output_records:
+        yield record
+    output_warnings.extend(input_iterator.get_warnings())
     if query_context.join_map_impl is not None:
         output_warnings.extend(query_context.join_map_impl.get_warnings())
-    output_warnings.extend(output_writer.get_warnings())
+    for extra_join_map in query_context.extra_join_maps:
+        output_warnings.extend(extra_join_map.join_map.get_warnings())
+
+
+def query_shared_scan(query_texts, input_iterator, output_writers, output_warnings, join_tables_registry=None, user_init_code='', user_namespace=None):
+    # Execute multiple queries during a single scan of the input table: each input record is read and split only once and then passed to all of the queries.
+    # Queries which don't need more records (e.g. because of LIMIT) drop out of the scan early.
+    if len(query_texts) != len(output_writers):
+        raise RbqlIOHandlingError('Number of queries and output writers must be the same')
+    prepared_queries = []
+    try:
+        for query_text in query_texts:
+            prepared_query = prepare(query_text, input_iterator, join_tables_registry, user_init_code)
+            prepared_queries.append(prepared_query)
+            if prepared_query.query_context.input_iterator is not input_iterator:
+                raise RbqlParsingError('Queries with FROM statement can not share the input table scan') # UT JSON
+            if prepared_query.query_context.query_modifiers != prepared_queries[0].query_context.query_modifiers:
+                raise RbqlParsingError('All queries sharing the input table scan must have the same "WITH (...)" modifiers') # UT JSON
+        query_contexts = [prepared_query.start_shared_scan(output_writer, user_namespace) for prepared_query, output_writer in zip(prepared_queries, output_writers)]
+        active_generators = [query_context.main_loop_generator for query_context in query_contexts]
+        while len(active_generators):
+            record = input_iterator.get_record()
+            if record is None:
+                break
+            still_active_generators = []
+            for i, main_loop_generator in enumerate(active_generators):
+                try:
+                    # Output writers can modify fields in-place, so each query except the last one gets its own copy of the record.
+                    main_loop_generator.send(record if i + 1 == len(active_generators) else record[:])
+                    still_active_generators.append(main_loop_generator)
+                except StopIteration:
+                    pass
+            active_generators = still_active_generators
+        for main_loop_generator in active_generators:
+            try:
+                main_loop_generator.send(None)
+            except StopIteration:
+                pass
+        for query_context, output_writer in zip(query_contexts, output_writers):
+            query_context.writer.finish()
+            if query_context.join_map_impl is not None:
+                output_warnings.extend(query_context.join_map_impl.get_warnings())
+            for extra_join_map in query_context.extra_join_maps:
+                output_warnings.extend(extra_join_map.join_map.get_warnings())
+            output_warnings.extend(output_writer.get_warnings())
+        output_warnings.extend(input_iterator.get_warnings())
+    finally:
+        for prepared_query in prepared_queries:
+            prepared_query.finish()
 
 
 class RBQLInputIterator:
@@ -1601,6 +3322,40 @@ class RBQLInputIterator:
     def get_header(self):
         return None # Reimplement if your class can provide input header
 
+    def set_raw_line_prefilter(self, required_substrings):
+        pass # Reimplement if your class can cheaply skip records which raw text doesn't contain all of the `required_substrings`
+
+    def set_required_num_fields(self, num_fields):
+        pass # Reimplement if your class can skip records with prefilters: records with fewer than `num_fields` fields should never be skipped, so the query could report the same errors as without prefilters. Skipped records should still be included in warnings e.g. about inconsistent number of fields
+
+    def set_join_key_prefilter(self, key_index, key_filter):
+        pass # Reimplement if your class can cheaply extract field with `key_index` and skip records for which `field in key_filter` is False
+
+    def supports_raw_records(self):
+        return False # Reimplement together with get_raw_record() and split_raw_record() if your class can return records in unsplit form, this way join tables would split records only when they match
+
+    def get_raw_record(self, num_key_fields):
+        # Should return None at the end of the table or (raw_record, leading_fields, num_fields) tuple, where `leading_fields` contains at least the first `num_key_fields` fields of the record.
+        raise NotImplementedError('Unable to call the interface method')
+
+    def split_raw_record(self, raw_record):
+        raise NotImplementedError('Unable to call the interface method')
+
+    def pop_num_skipped_records(self):
+        return 0 # Reimplement if your class can skip records. Should return number of records skipped since the previous call
+
+    def set_record_number_range(self, min_record_number, max_record_number):
+        pass # Reimplement if your class can cheaply skip records with NR outside of [min_record_number, max_record_number] range (either bound can be None). Skipped records must be reported by pop_num_skipped_records()
+
+    def set_field_constraints(self, field_constraints):
+        pass # Reimplement if your class can cheaply skip records which can't satisfy all of the (column_index, conversion, op, literal) constraints, e.g. using min/max statistics. conversion is None, "int" or "float"; op is one of "==", "!=", "<", "<=", ">", ">=" or "in" with a tuple of literals. Skipped records must be reported by pop_num_skipped_records()
+
+    def set_idle_callback(self, callback):
+        pass # Reimplement if your class can wait for more input records, e.g. for records appended to a growing file. `callback` should be called when all currently available records are consumed and the iterator starts waiting, it returns False if the query doesn't need more records
+
+    def get_table_size(self):
+        return None # Reimplement if your class can cheaply estimate the table size in bytes, e.g. file size. Inner joins use it to build the hash map on the smaller table
+
 
 class RBQLOutputWriter:
     def write(self, fields):
@@ -1615,6 +3370,12 @@ class RBQLOutputWriter:
     def set_header(self, header):
         pass # Reimplement if your class can handle output headers in a meaningful way
 
+    def flush(self):
+        pass # Reimplement if your class buffers output records, it is called when the input iterator starts waiting for more input records
+
+    def write_snapshot_separator(self):
+        pass # Reimplement if your class can delimit intermediate results of aggregate queries, it is called before each snapshot of the results except the first one
+
 
 class RBQLTableRegistry:
     # table_id - external table identifier like filename for csv files or variable name for pandas dataframes.
@@ -1622,6 +3383,15 @@ class RBQLTableRegistry:
     def get_iterator_by_table_id(self, table_id, single_char_alias):
         raise NotImplementedError('Unable to call the interface method')
 
+    def create_join_map(self, record_iterator, key_indices, projection):
+        # Reimplement if your class can provide a more efficient join map for the join table, e.g. a persistent index. See JoinMapBase for the join map interface and `projection` meaning.
+        # Should return an already built join map or None to use the default in-memory HashJoinMap.
+        return None
+
+    def create_spill_storage(self):
+        # Reimplement if your class can store temporary data e.g. in files, see RBQLSpillStorage. Without spill storage join tables are loaded into memory regardless of the join memory budget.
+        return None
+
     def finish(self):
         pass # Reimplement if your class needs to do something on finish e.g. cleanup
 
@@ -1629,6 +3399,23 @@ class RBQLTableRegistry:
         return [] # Reimplement if your class can produce warnings
 
 
+class RBQLSpillStorage:
+    # Temporary storage for partitions of the partitioned join. `partition_id` is a string, entries are lists of strings, numbers, None values and nested lists.
+    def create_partition_writer(self, partition_id):
+        # Should return an object with write(entry) and close() methods, the partition is overwritten if it already exists.
+        raise NotImplementedError('Unable to call the interface method')
+
+    def read_partition(self, partition_id):
+        # Should return an iterable of the partition entries in the order in which they were written.
+        raise NotImplementedError('Unable to call the interface method')
+
+    def remove_partition(self, partition_id):
+        raise NotImplementedError('Unable to call the interface method')
+
+    def finish(self):
+        pass # Reimplement if your class needs to do something on finish e.g. cleanup
+
+
 class TableIterator(RBQLInputIterator):
     def __init__(self, table, column_names=None, normalize_column_names=True, variable_prefix='a'):
         self.table = table
@@ -1700,6 +3487,62 @@ class ListTableRegistry(RBQLTableRegistry):
         return None
 
 
+class CommonTableRegistry(RBQLTableRegistry):
+    # Resolves names of common table expressions to their in-memory results, other tables are resolved by `registry`.
+    def __init__(self, registry):
+        self.registry = registry
+        self.common_tables = ListTableRegistry([])
+
+    def add_table(self, table_id, table, column_names):
+        self.common_tables.table_infos.append(ListTableInfo(table_id, table, column_names))
+
+    def get_iterator_by_table_id(self, table_id, single_char_alias):
+        record_iterator = self.common_tables.get_iterator_by_table_id(table_id, single_char_alias)
+        if record_iterator is None and self.registry is not None:
+            record_iterator = self.registry.get_iterator_by_table_id(table_id, single_char_alias)
+        return record_iterator
+
+    def create_join_map(self, record_iterator, key_indices, projection):
+        return self.registry.create_join_map(record_iterator, key_indices, projection) if self.registry is not None else None
+
+    def create_spill_storage(self):
+        return self.registry.create_spill_storage() if self.registry is not None else None
+
+
+def has_from_statement(query_text):
+    format_expression = remove_redundant_input_table_name(separate_string_literals(cleanup_query(query_text))[0])
+    return FROM in separate_actions(default_statement_groups, format_expression)
+
+
+def query_with_common_table_expressions(common_table_expressions, query_text, input_iterator, output_writer, output_warnings, join_tables_registry, user_init_code, user_namespace, join_memory_budget):
+    # Results of common table expressions are kept in memory and can be used by the subsequent statements with FROM and JOIN.
+    # Statements without FROM read the input table, it is read into memory only if there are multiple such statements.
+    statements = common_table_expressions + [(None, query_text)]
+    tables_registry = CommonTableRegistry(join_tables_registry)
+    input_table = None
+    if input_iterator is not None and len([text for _, text in statements if not has_from_statement(text)]) > 1:
+        format_expression = separate_string_literals(cleanup_query(query_text))[0]
+        for modifier in separate_actions(default_statement_groups, format_expression).get(WITH, []):
+            input_iterator.handle_query_modifier(modifier)
+        input_table = []
+        while True:
+            record = input_iterator.get_record()
+            if record is None:
+                break
+            input_table.append(record)
+        output_warnings.extend(input_iterator.get_warnings())
+    for table_id, statement_text in statements:
+        statement_input_iterator = None
+        if not has_from_statement(statement_text):
+            statement_input_iterator = input_iterator if input_table is None else TableIterator(input_table, input_iterator.get_header())
+        statement_output_writer = output_writer
+        if table_id is not None:
+            statement_output_writer = TableWriter([])
+        query(statement_text, statement_input_iterator, statement_output_writer, output_warnings, tables_registry, user_init_code, user_namespace, join_memory_budget)
+        if table_id is not None:
+            tables_registry.add_table(table_id, statement_output_writer.table, statement_output_writer.header)
+
+
 def query_table(query_text, input_table, output_table, output_warnings, join_table=None, input_column_names=None, join_column_names=None, output_column_names=None, normalize_column_names=True, user_init_code=''):
     if not normalize_column_names and input_column_names is not None and join_column_names is not None:
         ensure_no_ambiguous_variables(query_text, input_column_names, join_column_names)
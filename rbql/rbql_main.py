@@ -83,11 +83,20 @@ def run_with_python_csv(args, is_interactive):
     out_delim, out_policy = args.output_delim, args.output_policy
 
     user_init_code = rbql_csv.read_user_init_code(args.init_source_file) if args.init_source_file is not None else ''
+    join_memory_budget = args.join_memory_budget * 1024 * 1024 if args.join_memory_budget is not None else None
 
     warnings = []
     error_type, error_msg = None, None
     try:
-        rbql_csv.query_csv(query, input_path, delim, policy, output_path, out_delim, out_policy, csv_encoding, warnings, with_headers, args.comment_prefix, user_init_code, args.color)
+        if args.scan_query:
+            scan_queries = [q for q, _ in args.scan_query]
+            output_paths = [p for _, p in args.scan_query]
+            rbql_csv.query_csv_shared_scan(scan_queries, input_path, delim, policy, output_paths, out_delim, out_policy, csv_encoding, warnings, with_headers, args.comment_prefix, user_init_code, args.join_index_cache)
+        elif args.batch_input:
+            output_paths = [os.path.join(args.batch_output_dir, os.path.basename(p)) for p in args.batch_input]
+            rbql_csv.query_csv_batch(query, args.batch_input, delim, policy, output_paths, out_delim, out_policy, csv_encoding, warnings, with_headers, args.comment_prefix, user_init_code, join_memory_budget, args.join_index_cache)
+        else:
+            rbql_csv.query_csv(query, input_path, delim, policy, output_path, out_delim, out_policy, csv_encoding, warnings, with_headers, args.comment_prefix, user_init_code, args.color, join_memory_budget, args.join_index_cache, args.columnar_cache, args.incremental_state, args.follow, args.follow_idle_timeout, args.partition_by)
     except Exception as e:
         if args.debug_mode:
             raise
@@ -364,6 +373,10 @@ To learn how to use rbql to query an sqlite database, run this command:
 
   $ rbql sqlite --help
 
+To learn how to build a record index for a large CSV file, run this command:
+
+  $ rbql index --help
+
 '''
 
 csv_epilog = '''
@@ -388,6 +401,16 @@ def csv_main():
     parser.add_argument('--encoding', help='manually set csv encoding', default=rbql_csv.default_csv_encoding, choices=['latin-1', 'utf-8'])
     parser.add_argument('--output', metavar='FILE', help='write output table to FILE instead of stdout')
     parser.add_argument('--color', action='store_true', help='colorize columns in output in non-interactive mode')
+    parser.add_argument('--batch-input', metavar='FILE', nargs='+', help='run the same query against each of the FILEs. All files must have the same structure. Requires "--batch-output-dir"')
+    parser.add_argument('--batch-output-dir', metavar='DIR', help='write the result of the query for each "--batch-input" file to DIR under the same file name')
+    parser.add_argument('--join-memory-budget', metavar='MB', type=int, help='if the join table needs more than MB megabytes of memory, join it partition by partition using temporary files. Output order of such queries follows partition order')
+    parser.add_argument('--join-index-cache', metavar='DIR', help='store join table indexes in DIR and reuse them in subsequent queries while the join table is unchanged. DIR must not be writable by other users')
+    parser.add_argument('--columnar-cache', metavar='DIR', help='store split input table in DIR and reuse it in subsequent queries while the input table is unchanged. Speeds up repeated queries against large tables, e.g. in interactive mode. DIR must not be writable by other users')
+    parser.add_argument('--scan-query', metavar=('QUERY', 'FILE'), nargs=2, action='append', help='run QUERY and write its result to FILE. The option can be repeated: all queries are executed during a single pass over the input table')
+    parser.add_argument('--partition-by', metavar='COLUMN', help='split output records into files of "--output" directory (which must exist and be empty), one file per distinct value of COLUMN. COLUMN is either a name from the output header or a 1-based output column index')
+    parser.add_argument('--follow', action='store_true', help='keep reading records appended to the input file like "tail -f" and output the results as they arrive. Aggregate queries output the current results each time all appended records are processed, snapshots of the results are separated by an empty line. Press Ctrl+C to stop')
+    parser.add_argument('--follow-idle-timeout', metavar='SEC', type=float, help='stop "--follow" mode if nothing was appended to the input file during SEC seconds')
+    parser.add_argument('--incremental-state', metavar='DIR', help='store aggregation state of the query in DIR, the next run of the same aggregate query would read only records appended to the input file since the previous run')
     parser.add_argument('--version', action='store_true', help='print RBQL version and exit')
     parser.add_argument('--init-source-file', metavar='FILE', help=argparse.SUPPRESS) # Path to init source file to use instead of ~/.rbql_init_source.py
     parser.add_argument('--debug-mode', action='store_true', help=argparse.SUPPRESS) # Run in debug mode
@@ -397,6 +420,57 @@ def csv_main():
         print(_version.__version__)
         return
 
+    if args.batch_input is not None:
+        if args.query is None or args.batch_output_dir is None:
+            show_error('generic', '"--batch-input" option requires "--query" and "--batch-output-dir" options', is_interactive=False)
+            sys.exit(1)
+        if args.input is not None or args.output is not None or args.color:
+            show_error('generic', '"--batch-input" is not compatible with "--input", "--output" and "--color" options', is_interactive=False)
+            sys.exit(1)
+        if not os.path.isdir(args.batch_output_dir):
+            show_error('generic', 'Output directory does not exist: {}'.format(args.batch_output_dir), is_interactive=False)
+            sys.exit(1)
+        batch_input_names = [os.path.basename(p) for p in args.batch_input]
+        duplicate_names = sorted(set(name for name in batch_input_names if batch_input_names.count(name) > 1))
+        if len(duplicate_names):
+            show_error('generic', 'Results of "--batch-input" files are written under the same file name, but multiple files are named "{}"'.format(duplicate_names[0]), is_interactive=False)
+            sys.exit(1)
+    elif args.batch_output_dir is not None:
+        show_error('generic', '"--batch-output-dir" can only be used together with "--batch-input"', is_interactive=False)
+        sys.exit(1)
+
+    if args.scan_query is not None:
+        if args.query is not None or args.output is not None or args.batch_input is not None or args.color:
+            show_error('generic', '"--scan-query" is not compatible with "--query", "--output", "--batch-input" and "--color" options', is_interactive=False)
+            sys.exit(1)
+        if args.follow or args.incremental_state is not None or args.columnar_cache is not None:
+            show_error('generic', '"--scan-query" is not compatible with "--follow", "--incremental-state" and "--columnar-cache" options', is_interactive=False)
+            sys.exit(1)
+
+    if args.partition_by is not None:
+        if args.output is None or not os.path.isdir(args.output):
+            show_error('generic', '"--partition-by" option requires "--output" option with path to an existing empty directory', is_interactive=False)
+            sys.exit(1)
+        if args.query is None or args.color:
+            show_error('generic', '"--partition-by" option requires "--query" option and is not compatible with "--color" option', is_interactive=False)
+            sys.exit(1)
+
+    if args.follow and (args.input is None or args.query is None):
+        show_error('generic', '"--follow" option requires "--input" and "--query" options', is_interactive=False)
+        sys.exit(1)
+
+    if args.follow and args.incremental_state is not None:
+        show_error('generic', '"--follow" is not compatible with "--incremental-state" option', is_interactive=False)
+        sys.exit(1)
+
+    if args.follow_idle_timeout is not None and not args.follow:
+        show_error('generic', '"--follow-idle-timeout" can only be used together with "--follow"', is_interactive=False)
+        sys.exit(1)
+
+    if args.incremental_state is not None and args.input is None:
+        show_error('generic', '"--incremental-state" option requires "--input" option', is_interactive=False)
+        sys.exit(1)
+
     if args.color and os.name == 'nt':
         show_error('generic', '--color option is not supported for Windows terminals', is_interactive=False)
         sys.exit(1)
@@ -417,8 +491,10 @@ def csv_main():
             args.delim = args.delim.decode(args.encoding)
         if args.query is not None:
             args.query = args.query.decode(args.encoding)
+        if args.scan_query is not None:
+            args.scan_query = [(q.decode(args.encoding), p) for q, p in args.scan_query]
 
-    is_interactive_mode = args.query is None
+    is_interactive_mode = args.query is None and args.scan_query is None
     if is_interactive_mode:
         if args.color:
             show_error('generic', '"--color" option is not compatible with interactive mode. Output and Input files preview would be colorized anyway', is_interactive=False)
@@ -500,11 +576,75 @@ def sqlite_main():
             sys.exit(1)
 
 
+index_tool_description = '''
+Build record index for a large CSV file
+The index stores byte offsets of every Nth record in a sidecar "FILE.rbql_index" file next to the table and is ignored after the table is modified or queried with another delimiter or policy.
+Queries with "NR" range conditions like "select * where NR > 1000000 and NR <= 1000100" use the index to skip blocks of records outside of the range without reading them.
+Blocks are skipped only if the WHERE expression can't raise an exception and all records of the block have the fields used in the query, so the results, errors and warnings are the same as without the index.
+With "--column N" option a sorted key index of the N-th column is built instead, queries with conditions like "a.order_id == '12345'" or "aN in ('12', '15')" use it to read only the matching records.
+With "--zone-maps" option min/max values of each column are also collected for every block of records, so queries like "select * where a1 >= '2026-10-01'" or "select * where float(a.price) < 10" can skip blocks which can't match.
+
+Usage example:
+  $ rbql index --input input.csv --delim , --policy quoted_rfc --split 4
+  $ rbql index --input input.csv --delim , --zone-maps
+  $ rbql index --input input.csv --delim , --column 3
+
+'''
+
+
+def index_main():
+    parser = argparse.ArgumentParser(prog='rbql index', formatter_class=argparse.RawDescriptionHelpFormatter, description=index_tool_description)
+    parser.add_argument('--input', metavar='FILE', required=True, help='csv table to index')
+    parser.add_argument('--delim', help='delimiter character or multicharacter string, e.g. "," or "###"', default=',')
+    parser.add_argument('--policy', help='CSV split policy', choices=policy_names)
+    parser.add_argument('--with-headers', action='store_true', help='indicates that input table has header, affects only "--split" ranges')
+    parser.add_argument('--comment-prefix', metavar='PREFIX', help='ignore lines that start with the comment PREFIX, e.g. "#" or ">>"')
+    parser.add_argument('--encoding', help='manually set csv encoding', default=rbql_csv.default_csv_encoding, choices=['latin-1', 'utf-8'])
+    parser.add_argument('--step', metavar='N', type=int, default=rbql_csv.default_record_index_step, help='store offset of every N-th record')
+    parser.add_argument('--zone-maps', action='store_true', help='also collect min/max values of each column for every N-th record block')
+    parser.add_argument('--column', metavar='N', type=int, help='build sorted key index of the N-th column (1-based) for point lookups')
+    parser.add_argument('--split', metavar='N', type=int, help='print N contiguous NR ranges of roughly equal size which can be queried in parallel')
+    args = parser.parse_args()
+
+    if args.step < 1 or (args.split is not None and args.split < 1) or (args.column is not None and args.column < 1):
+        show_error('generic', '"--step", "--split" and "--column" values must be positive', is_interactive=False)
+        sys.exit(1)
+    if args.column is not None and (args.zone_maps or args.split is not None):
+        show_error('generic', '"--column" is not compatible with "--zone-maps" and "--split" options', is_interactive=False)
+        sys.exit(1)
+    delim = rbql_csv.normalize_delim(args.delim)
+    policy = args.policy if args.policy is not None else get_default_policy(delim)
+    if args.column is not None:
+        try:
+            num_keys = rbql_csv.build_csv_key_index(args.input, args.encoding, delim, policy, args.column - 1, args.comment_prefix)
+        except Exception as e:
+            error_type, error_msg = rbql_engine.exception_to_error_info(e)
+            show_error(error_type, error_msg, is_interactive=False)
+            sys.exit(1)
+        print('Indexed {} keys: {}'.format(num_keys, rbql_csv.get_key_index_path(args.input, args.column - 1)))
+        return
+    try:
+        record_index = rbql_csv.build_csv_record_index(args.input, args.encoding, delim, policy, args.comment_prefix, args.step, args.zone_maps)
+    except Exception as e:
+        error_type, error_msg = rbql_engine.exception_to_error_info(e)
+        show_error(error_type, error_msg, is_interactive=False)
+        sys.exit(1)
+    print('Indexed {} records: {}'.format(record_index.num_records, rbql_csv.get_record_index_path(args.input)))
+    if args.zone_maps:
+        print('Zone maps: {}'.format(rbql_csv.get_zone_maps_path(args.input)))
+    if args.split is not None:
+        for first_nr, last_nr in record_index.split_record_ranges(args.split, args.with_headers):
+            print('NR >= {} and NR <= {}'.format(first_nr, last_nr))
+
+
 def main():
     if len(sys.argv) > 1:
         if sys.argv[1] == 'sqlite':
             del sys.argv[1]
             sqlite_main()
+        elif sys.argv[1] == 'index':
+            del sys.argv[1]
+            index_main()
         elif sys.argv[1] == 'csv':
             del sys.argv[1]
             csv_main()
@@ -28,7 +28,7 @@ class SqliteRecordIterator(rbql_engine.RBQLInputIterator):
         if re.match('^[a-zA-Z0-9_]*$', table_name) is None:
             raise rbql_engine.RbqlIOHandlingError('Unable to use "{}": input table name can contain only alphanumeric characters and underscore'.format(table_name))
         try:
-            self.cursor.execute('SELECT * FROM {};'.format(table_name))
+            self.cursor.execute('SELECT * FROM {};'.format(quote_identifier(table_name)))
         except sqlite3.OperationalError as e:
             if str(e).find('no such table') != -1:
                 raise rbql_engine.RbqlIOHandlingError('no such table "{}"'.format(table_name))
@@ -69,14 +69,109 @@ class SqliteRecordIterator(rbql_engine.RBQLInputIterator):
         return []
 
 
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class SqliteJoinMap(rbql_engine.JoinMapBase):
+    # Probes the join table with parameterized queries instead of loading it into memory. The table must already have an index on the join key, RBQL never modifies the database.
+    # Join records are fetched in rowid order and "bNR" is the rowid of the record, so tables with gaps in rowids (e.g. after deletions) are joined in memory.
+    def __init__(self, db_connection, record_iterator, key_indices, projection=None):
+        super(SqliteJoinMap, self).__init__(record_iterator, key_indices, projection)
+        self.db_connection = db_connection
+        self.table_name = record_iterator.table_name
+        self.column_names = record_iterator.get_header()
+        self.max_record_len = len(self.column_names)
+        self.key_columns = [self.column_names[i] for i in key_indices]
+        self.cursor = None
+        self.probe_query = None
+        self.records_cache = dict()
+
+    def has_key_index(self):
+        # Only indexes with the default BINARY collation can be used, other collations e.g. NOCASE would make probe queries scan the whole table.
+        for index_info in self.cursor.execute('PRAGMA index_list({})'.format(quote_identifier(self.table_name))).fetchall():
+            index_name, is_partial = index_info[1], index_info[4]
+            if is_partial:
+                continue
+            index_columns = self.cursor.execute('PRAGMA index_xinfo({})'.format(quote_identifier(index_name))).fetchall()
+            if len(index_columns) and index_columns[0][2] in self.key_columns and index_columns[0][4] == 'BINARY':
+                return True
+        return False
+
+    def has_consecutive_rowids(self):
+        # "bNR" of the in-memory join is the 1-based position of the record in rowid order, it is the same as rowid only if rowids are 1, 2, ..., N.
+        table_name = quote_identifier(self.table_name)
+        min_rowid = self.cursor.execute('SELECT min(rowid) FROM {}'.format(table_name)).fetchone()[0]
+        max_rowid = self.cursor.execute('SELECT max(rowid) FROM {}'.format(table_name)).fetchone()[0]
+        num_records = self.cursor.execute('SELECT count(*) FROM {}'.format(table_name)).fetchone()[0]
+        return num_records == 0 or (min_rowid == 1 and max_rowid == num_records)
+
+    def build(self):
+        self.cursor = self.db_connection.cursor()
+        self.cursor.execute('SELECT rowid FROM {} LIMIT 1'.format(quote_identifier(self.table_name))) # Fails for "WITHOUT ROWID" tables.
+        if not self.has_key_index() or not self.has_consecutive_rowids():
+            raise rbql_csv.UnsupportedIndexError()
+        # The join table is not read through the record iterator.
+        self.record_iterator.cursor.close()
+        value_columns = self.column_names if self.projection is None else [self.column_names[i] for i in self.projection]
+        selected_columns = ', '.join([quote_identifier(c) for c in self.key_columns + value_columns])
+        # "IS" works like "==" but also matches NULL keys and can use indexes. Explicit BINARY collation overrides the column collation, so the index can be used.
+        key_condition = ' AND '.join(['{} COLLATE BINARY IS ?'.format(quote_identifier(c)) for c in self.key_columns])
+        self.probe_query = 'SELECT rowid, {} FROM {} WHERE {} ORDER BY rowid'.format(selected_columns, quote_identifier(self.table_name), key_condition)
+
+    def get_join_records(self, key):
+        result = self.records_cache.get(key)
+        if result is not None:
+            return result
+        key_values = [key] if self.key_indices is None else list(key)
+        num_key_columns = len(key_values)
+        result = []
+        for row in self.cursor.execute(self.probe_query, key_values):
+            # SQLite applies type affinity and column collations when comparing values, so we have to check the keys again to match the same records as the in-memory join.
+            if list(row[1:num_key_columns + 1]) != key_values:
+                continue
+            result.append((row[0], self.max_record_len, list(row[num_key_columns + 1:])))
+        if len(self.records_cache) >= rbql_csv.max_cached_join_keys:
+            self.records_cache = dict()
+        self.records_cache[key] = result
+        return result
+
+    def finish(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+
+
 class SqliteDbRegistry(rbql_engine.RBQLTableRegistry):
     def __init__(self, db_connection):
         self.db_connection = db_connection
+        self.record_iterator = None
+        self.join_maps = []
 
     def get_iterator_by_table_id(self, table_id, single_char_alias):
         self.record_iterator = SqliteRecordIterator(self.db_connection, table_id, single_char_alias)
         return self.record_iterator
 
+    def create_join_map(self, record_iterator, key_indices, projection):
+        import sqlite3
+        if record_iterator is not self.record_iterator:
+            return None
+        if min(key_indices) < 0 or max(key_indices) >= len(record_iterator.get_header()):
+            return None # Let the default join map handle "bNR" keys and report missing fields.
+        join_map = SqliteJoinMap(self.db_connection, record_iterator, key_indices, projection)
+        try:
+            join_map.build()
+        except (sqlite3.OperationalError, rbql_csv.UnsupportedIndexError):
+            join_map.finish()
+            return None # E.g. "WITHOUT ROWID" table or a table without a suitable index.
+        self.join_maps.append(join_map)
+        return join_map
+
+    def finish(self):
+        for join_map in self.join_maps:
+            join_map.finish()
+        self.join_maps = []
+
 
 def query_sqlite_to_csv(query_text, db_connection, input_table_name, output_path, output_delim, output_policy, output_csv_encoding, output_warnings, user_init_code='', colorize_output=False):
     output_stream, close_output_on_finish = (None, False)
@@ -101,5 +196,7 @@ def query_sqlite_to_csv(query_text, db_connection, input_table_name, output_path
     finally:
         if close_output_on_finish:
             output_stream.close()
+        if join_tables_registry:
+            join_tables_registry.finish()
 
 
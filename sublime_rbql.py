@@ -24,10 +24,10 @@ def system_has_node_js():
     return exit_code == 0 and len(out_data) and len(err_data) == 0
 
 
-def execute_python(src_table_path, encoding, query, input_delim, input_policy, out_delim, out_policy, dst_table_path, with_headers):
+def execute_python(src_table_path, encoding, query, input_delim, input_policy, out_delim, out_policy, dst_table_path, with_headers, join_index_cache_dir=None, columnar_cache_dir=None):
     try:
         warnings = []
-        rbql.query_csv(query, src_table_path, input_delim, input_policy, dst_table_path, out_delim, out_policy, encoding, warnings, with_headers)
+        rbql.query_csv(query, src_table_path, input_delim, input_policy, dst_table_path, out_delim, out_policy, encoding, warnings, with_headers, join_index_cache_dir=join_index_cache_dir, columnar_cache_dir=columnar_cache_dir)
         return (None, None, warnings)
     except Exception as e:
         error_type, error_msg = rbql.exception_to_error_info(e)
@@ -72,7 +72,7 @@ def execute_js(src_table_path, encoding, query, input_delim, input_policy, out_d
     return (error_type, error_msg, warnings)
 
 
-def converged_execute(meta_language, src_table_path, query, input_delim, input_policy, out_delim, out_policy, encoding, with_headers):
+def converged_execute(meta_language, src_table_path, query, input_delim, input_policy, out_delim, out_policy, encoding, with_headers, use_join_index_cache=False, use_columnar_cache=False):
     try:
         tmp_dir = tempfile.gettempdir()
         table_name = os.path.basename(src_table_path)
@@ -82,7 +82,11 @@ def converged_execute(meta_language, src_table_path, query, input_delim, input_p
         dst_table_path = os.path.join(tmp_dir, dst_table_name)
         assert meta_language in ['python', 'js'], 'Meta language must be "python" or "js"'
         if meta_language == 'python':
-            exec_result = execute_python(src_table_path, encoding, query, input_delim, input_policy, out_delim, out_policy, dst_table_path, with_headers)
+            # Cache directories are per-user, RBQL doesn't use cache directories which other users can write to.
+            user_suffix = '_{}'.format(os.getuid()) if hasattr(os, 'getuid') else ''
+            join_index_cache_dir = os.path.join(tmp_dir, 'rbql_join_index_cache' + user_suffix) if use_join_index_cache else None
+            columnar_cache_dir = os.path.join(tmp_dir, 'rbql_columnar_cache' + user_suffix) if use_columnar_cache else None
+            exec_result = execute_python(src_table_path, encoding, query, input_delim, input_policy, out_delim, out_policy, dst_table_path, with_headers, join_index_cache_dir, columnar_cache_dir)
         else:
             exec_result = execute_js(src_table_path, encoding, query, input_delim, input_policy, out_delim, out_policy, dst_table_path, with_headers)
         error_type, error_details, warnings = exec_result